@@ -31,7 +31,13 @@ if not 'bert_repo' in sys.path:
 ###################################
 ##### IMPORT REMAINING MODULES ####
 ###################################
-from vac_utils import performance_metrics, get_predictions_output, append_to_csv, save_to_json
+from vac_utils import performance_metrics, save_predictions, HiddenStateWriter, build_experiment_definitions, plan_experiments
+from feature_cache import FeatureCache, features_to_arrays, FEATURE_NAMES
+from bucketing import parse_bucket_lengths, bucket_indices, schedule_train_steps
+from results_store import ResultsStore
+from parallel_tokenization import run_sharded, shared_array
+from wordpiece_cache import cache_wordpieces
+from text_dedup import dedup_rows, duplicate_groups, dedup_stats
 import tensorflow as tf
 import numpy as np
 import modeling
@@ -47,10 +53,12 @@ BERT_MODEL_NAME = 'bert_model.ckpt'
 BERT_MODEL_FILE = os.path.join(BERT_MODEL_DIR, BERT_MODEL_NAME)
 TEMP_OUTPUT_BASEDIR = 'gs://perepublic/finetuned_models/'
 LOG_CSV_DIR = 'log_csv/'
-PREDICTIONS_JSON_DIR = 'predictions_json/'
-HIDDEN_STATE_JSON_DIR = 'hidden_state_json/'
+PREDICTIONS_DIR = 'predictions/'
+HIDDEN_STATE_DIR = 'hidden_states/'
+FEATURE_CACHE_DIR = 'feature_cache/'
+RESULTS_DB = os.path.join(LOG_CSV_DIR, 'results.db')
 
-logdirs = [LOG_CSV_DIR, PREDICTIONS_JSON_DIR, HIDDEN_STATE_JSON_DIR]
+logdirs = [LOG_CSV_DIR, PREDICTIONS_DIR, HIDDEN_STATE_DIR, FEATURE_CACHE_DIR]
 
 for d in logdirs:
     if not os.path.exists(d):
@@ -67,6 +75,16 @@ EVAL_BATCH_SIZE = 8
 # PREDICT_BATCH_SIZE = 64
 PREDICT_BATCH_SIZE = 8
 WARMUP_PROPORTION = 0.1
+# Examples are padded to the shortest of these lengths they fit in, so every prediction (and with --train_buckets every training) step runs with one of a few static shapes
+SEQ_LENGTH_BUCKETS = '32,64,128'
+# With --train_buckets, training alternates between the length buckets (in shuffled order) this many times
+TRAIN_BUCKET_ROUNDS = 10
+# Number of bootstrap resamples for the confidence intervals of the scores (0 disables them)
+BOOTSTRAP_RESAMPLES = 1000
+# Number of processes used for tokenization
+TOKENIZE_WORKERS = 1
+# Number of tokens in the wordpiece LRU cache (0 disables it)
+WORDPIECE_CACHE_SIZE = 100000
 
 ##############################
 ############ CONFIG ##########
@@ -144,216 +162,48 @@ class vaccineStanceProcessor(run_classifier.DataProcessor):
 ##### DEFINE EXPERIMENTS #####
 ##############################
 
-experiment_definitions = {
-    "1": {
-        "name": "zeroshot-cb-annot-en-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "2": {
-        "name": "zeroshot-cb-annot-en-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "3": {
-        "name": "zeroshot-cb-annot-en-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "4": {
-        "name": "zeroshot-cb-annot-en-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "5": {
-        "name": "zeroshot-cb-annot-en-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "6": {
-        "name": "translate-cb-annot-en-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "7": {
-        "name": "translate-cb-annot-de-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "8": {
-        "name": "translate-cb-annot-es-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-es",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "9": {
-        "name": "translate-cb-annot-fr-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-fr",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "10": {
-        "name": "translate-cb-annot-pt-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-pt",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "11": {
-        "name": "multitranslate-cb-annot-en-de-fr-es-pt-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "12": {
-        "name": "multitranslate-cb-annot-en-de-fr-es-pt-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "13": {
-        "name": "multitranslate-cb-annot-en-de-fr-es-pt-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "14": {
-        "name": "multitranslate-cb-annot-en-de-fr-es-pt-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "15": {
-        "name": "multitranslate-cb-annot-en-de-fr-es-pt-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "16": {
-        "name": "zeroshot-small-cb-annot-en-sm-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "17": {
-        "name": "zeroshot-small-cb-annot-en-sm-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "18": {
-        "name": "zeroshot-small-cb-annot-en-sm-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "19": {
-        "name": "zeroshot-small-cb-annot-en-sm-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "20": {
-        "name": "zeroshot-small-cb-annot-en-sm-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "21": {
-        "name": "translate-small-cb-annot-en-sm-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-sm",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "22": {
-        "name": "translate-small-cb-annot-de-sm-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de-sm",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "23": {
-        "name": "translate-small-cb-annot-es-sm-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-es-sm",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "24": {
-        "name": "translate-small-cb-annot-fr-sm-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-fr-sm",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "25": {
-        "name": "translate-small-cb-annot-pt-sm-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-pt-sm",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "26": {
-        "name": "multitranslate-small-cb-annot-en-de-fr-es-pt-sm-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-sm",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "27": {
-        "name": "multitranslate-small-cb-annot-en-de-fr-es-pt-sm-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-sm",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "28": {
-        "name": "multitranslate-small-cb-annot-en-de-fr-es-pt-sm-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-sm",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "29": {
-        "name": "multitranslate-small-cb-annot-en-de-fr-es-pt-sm-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-sm",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "30": {
-        "name": "multitranslate-small-cb-annot-en-de-fr-es-pt-sm-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-sm",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "31": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-os-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-os",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "32": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-os-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-os",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "33": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-os-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-os",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "34": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-os-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-os",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "35": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-os-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-os",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    },
-    "36": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-us-cb-annot-en",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-us",
-        "eval_annot_dataset": "cb-annot-en"
-    },
-    "37": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-us-cb-annot-de",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-us",
-        "eval_annot_dataset": "cb-annot-en-de"
-    },
-    "38": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-us-cb-annot-es",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-us",
-        "eval_annot_dataset": "cb-annot-en-es"
-    },
-    "39": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-us-cb-annot-fr",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-us",
-        "eval_annot_dataset": "cb-annot-en-fr"
-    },
-    "40": {
-        "name": "balanced-cb-annot-en-de-fr-es-pt-us-cb-annot-pt",
-        "train_annot_dataset": "cb-annot-en-de-fr-es-pt-us",
-        "eval_annot_dataset": "cb-annot-en-pt"
-    }
+EVAL_ANNOT_DATASETS = {
+    'en': 'cb-annot-en',
+    'de': 'cb-annot-en-de',
+    'es': 'cb-annot-en-es',
+    'fr': 'cb-annot-en-fr',
+    'pt': 'cb-annot-en-pt'
 }
+ALL_LANGUAGES = ['en', 'de', 'es', 'fr', 'pt']
+
+# Every row is one trained model which gets evaluated on each of its eval languages.
+# Experiments are numbered in the order of this matrix. Rows can set `hyperparameters`
+# (learning_rate, num_train_steps) to override the defaults.
+experiment_matrix = [
+    {'prefix': 'zeroshot', 'train_annot_dataset': 'cb-annot-en', 'train_name': 'cb-annot-en', 'eval': ALL_LANGUAGES},
+    {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en', 'train_name': 'cb-annot-en', 'eval': ['en']},
+    {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en-de', 'train_name': 'cb-annot-de', 'eval': ['de']},
+    {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en-es', 'train_name': 'cb-annot-es', 'eval': ['es']},
+    {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en-fr', 'train_name': 'cb-annot-fr', 'eval': ['fr']},
+    {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en-pt', 'train_name': 'cb-annot-pt', 'eval': ['pt']},
+    {'prefix': 'multitranslate', 'train_annot_dataset': 'cb-annot-en-de-fr-es-pt', 'train_name': 'cb-annot-en-de-fr-es-pt', 'eval': ALL_LANGUAGES},
+    {'prefix': 'zeroshot-small', 'train_annot_dataset': 'cb-annot-en-sm', 'train_name': 'cb-annot-en-sm', 'eval': ALL_LANGUAGES},
+    {'prefix': 'translate-small', 'train_annot_dataset': 'cb-annot-en-sm', 'train_name': 'cb-annot-en-sm', 'eval': ['en']},
+    {'prefix': 'translate-small', 'train_annot_dataset': 'cb-annot-en-de-sm', 'train_name': 'cb-annot-de-sm', 'eval': ['de']},
+    {'prefix': 'translate-small', 'train_annot_dataset': 'cb-annot-en-es-sm', 'train_name': 'cb-annot-es-sm', 'eval': ['es']},
+    {'prefix': 'translate-small', 'train_annot_dataset': 'cb-annot-en-fr-sm', 'train_name': 'cb-annot-fr-sm', 'eval': ['fr']},
+    {'prefix': 'translate-small', 'train_annot_dataset': 'cb-annot-en-pt-sm', 'train_name': 'cb-annot-pt-sm', 'eval': ['pt']},
+    {'prefix': 'multitranslate-small', 'train_annot_dataset': 'cb-annot-en-de-fr-es-pt-sm', 'train_name': 'cb-annot-en-de-fr-es-pt-sm', 'eval': ALL_LANGUAGES},
+    {'prefix': 'balanced', 'train_annot_dataset': 'cb-annot-en-de-fr-es-pt-os', 'train_name': 'cb-annot-en-de-fr-es-pt-os', 'eval': ALL_LANGUAGES},
+    {'prefix': 'balanced', 'train_annot_dataset': 'cb-annot-en-de-fr-es-pt-us', 'train_name': 'cb-annot-en-de-fr-es-pt-us', 'eval': ALL_LANGUAGES}
+]
+
+experiment_definitions = build_experiment_definitions(experiment_matrix, EVAL_ANNOT_DATASETS)
 
 ###########################
 ##### RUN EXPERIMENTS #####
 ###########################
 
 
-def run_experiment(experiments, use_tpu, tpu_address, repeat, num_train_steps, username, comment, store_last_layer):
+def run_experiment(experiments, use_tpu, tpu_address, repeat, num_train_steps, username, comment, store_last_layer, seq_buckets=SEQ_LENGTH_BUCKETS, bootstrap_resamples=BOOTSTRAP_RESAMPLES, tokenize_workers=TOKENIZE_WORKERS, bert_model_dir=BERT_MODEL_DIR, train_buckets=False):
     logger.info(f'Getting ready to run the following experiments for {repeat} repeats: {experiments}')
+    bucket_lengths = parse_bucket_lengths(seq_buckets, MAX_SEQ_LENGTH)
+    logger.info(f'Using sequence length buckets {bucket_lengths}')
 
     def get_run_config(output_dir):
         return tf.contrib.tpu.RunConfig(
@@ -379,197 +229,231 @@ def run_experiment(experiments, use_tpu, tpu_address, repeat, num_train_steps, u
         exp_list = [str(s) for s in exp_list]
         return exp_list
 
+    def get_features(annot_dataset, set_type):
+        """Returns padded feature arrays for a dataset split, tokenizing only on a cache miss"""
+        data_file = os.path.join('data', annot_dataset, f'{set_type}.tsv')
+        def _create_features():
+            if set_type == 'train':
+                examples = processor.get_train_examples(os.path.join('data', annot_dataset))
+            else:
+                examples = processor.get_dev_examples(os.path.join('data', annot_dataset))
+            if tokenize_workers > 1:
+                return convert_examples_to_arrays(examples, label_list, MAX_SEQ_LENGTH, get_tokenizer(), tokenize_workers)
+            features = run_classifier.convert_examples_to_features(
+                examples, label_list, MAX_SEQ_LENGTH, get_tokenizer())
+            if WORDPIECE_CACHE_SIZE > 0:
+                get_tokenizer().wordpiece_tokenizer.log_stats()
+            return features_to_arrays(features, [e.guid for e in examples])
+        return feature_cache.get_or_create(data_file, vocab_file, LOWER_CASED, MAX_SEQ_LENGTH, _create_features)
+
+    def get_tokenizer():
+        nonlocal tokenizer
+        if tokenizer is None:
+            tokenizer = tokenization.FullTokenizer(vocab_file=vocab_file, do_lower_case=LOWER_CASED)
+            cache_wordpieces(tokenizer, max_size=WORDPIECE_CACHE_SIZE)
+        return tokenizer
+
     experiments = parse_experiments_argument(experiments)
-    last_completed_train = ""
+    plan = plan_experiments(experiments, experiment_definitions)
+    logger.info(f'***** Planned {len(plan)} training runs for {len(experiments)} experiments *****')
+    for train_annot_dataset, hyperparameters, exp_nrs in plan:
+        logger.info(f'  Train on {train_annot_dataset} {hyperparameters or ""} and evaluate experiments {", ".join(exp_nrs)}')
     completed_train_dirs = []
-
-    for exp_nr in experiments:
-        logger.info(f"***** Starting Experiment {exp_nr} *******")
-        logger.info(f"***** {experiment_definitions[exp_nr]['name']} ******")
-        logger.info("***********************************************")
-
-        #Get a unique ID for every experiment run
-        experiment_id = str(uuid.uuid4())
+    logger.info(f'Fine-tuning BERT from {bert_model_dir}')
+    vocab_file = os.path.join(bert_model_dir, 'vocab.txt')
+    feature_cache = FeatureCache(FEATURE_CACHE_DIR, open_fn=tf.gfile.GFile)
+    tokenizer = None
+    processor = vaccineStanceProcessor()
+    label_list = processor.get_labels()
+    label_mapping = dict(zip(range(len(label_list)), label_list))
+    if tokenize_workers > 1:
+        # tokenization forks worker processes, which is only safe before the first estimator has started TensorFlow's threads.
+        # All planned datasets are tokenized into the feature cache now, the training runs only load them.
+        datasets = [(train_annot_dataset, 'train') for train_annot_dataset, _, _ in plan] + \
+                [(experiment_definitions[exp_nr]['eval_annot_dataset'], 'dev') for _, _, exp_nrs in plan for exp_nr in exp_nrs]
+        for annot_dataset, set_type in dict.fromkeys(datasets):
+            get_features(annot_dataset, set_type)
+
+    for train_annot_dataset, hyperparameters, exp_nrs in plan:
+        #Get a unique ID for every experiment run. The model is trained under the ID of the first experiment in the group
+        experiment_ids = {exp_nr: str(uuid.uuid4()) for exp_nr in exp_nrs}
+        experiment_id = experiment_ids[exp_nrs[0]]
+        learning_rate = hyperparameters.get('learning_rate', LEARNING_RATE)
+        train_steps = hyperparameters.get('num_train_steps', num_train_steps)
 
         ###########################
         ######### TRAINING ########
         ###########################
 
-        #We should only train a new model if a similar model hasnt just been trained. Save considerable computation time
-        train_annot_dataset = experiment_definitions[exp_nr][
-            "train_annot_dataset"]
-
+        #Every distinct model is only trained once and then evaluated on all its eval datasets. Saves considerable computation time
+        #Set a fresh new output directory every time training starts, and set the cache to this directory
+        temp_output_dir = os.path.join(
+            TEMP_OUTPUT_BASEDIR,experiment_id)
 
-        if train_annot_dataset != last_completed_train:
-            #Set a fresh new output directory every time training starts, and set the cache to this directory
-            temp_output_dir = os.path.join(
-                TEMP_OUTPUT_BASEDIR,experiment_id)
+        os.environ['TFHUB_CACHE_DIR'] = temp_output_dir
+        logger.info(f"***** Setting temporary dir {temp_output_dir} **")
+        logger.info(f"***** Train started in {temp_output_dir} **")
 
-            os.environ['TFHUB_CACHE_DIR'] = temp_output_dir
-            logger.info(f"***** Setting temporary dir {temp_output_dir} **")
-            logger.info(f"***** Train started in {temp_output_dir} **")
-
-            tokenizer = tokenization.FullTokenizer(vocab_file=os.path.join(
-                BERT_MODEL_DIR, 'vocab.txt'),
-                                                   do_lower_case=LOWER_CASED)
-
-
-            if tpu_address:
-                tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(tpu_address)
-            else:
-                tpu_cluster_resolver = None
-
-            processor = vaccineStanceProcessor()
-            label_list = processor.get_labels()
-            label_mapping = dict(zip(range(len(label_list)), label_list))
-
-            train_examples = processor.get_train_examples(
-                os.path.join('data', train_annot_dataset))
-            num_warmup_steps = int(num_train_steps * WARMUP_PROPORTION)
-
-            #Initiation
-
-            bert_config = modeling.BertConfig.from_json_file(os.path.join(BERT_MODEL_DIR, 'bert_config.json'))
-            model_fn = model_fn_builder(
-                bert_config=bert_config,
-                num_labels=len(label_list),
-                init_checkpoint=BERT_MODEL_FILE,
-                learning_rate=LEARNING_RATE,
-                num_train_steps=num_train_steps,
-                num_warmup_steps=num_warmup_steps,
-                use_tpu=use_tpu,
-                use_one_hot_embeddings=True,
-                extract_last_layer=store_last_layer
-                )
-
-            estimator = tf.contrib.tpu.TPUEstimator(
-                use_tpu=use_tpu,
-                model_fn=model_fn,
-                config=get_run_config(temp_output_dir),
-                train_batch_size=TRAIN_BATCH_SIZE,
-                eval_batch_size=EVAL_BATCH_SIZE,
-                predict_batch_size=PREDICT_BATCH_SIZE,
+        if tpu_address:
+            tpu_cluster_resolver = tf.contrib.cluster_resolver.TPUClusterResolver(tpu_address)
+        else:
+            tpu_cluster_resolver = None
+
+        num_warmup_steps = int(train_steps * WARMUP_PROPORTION)
+
+        #Initiation
+
+        bert_config = modeling.BertConfig.from_json_file(os.path.join(bert_model_dir, 'bert_config.json'))
+        model_fn = model_fn_builder(
+            bert_config=bert_config,
+            num_labels=len(label_list),
+            init_checkpoint=os.path.join(bert_model_dir, BERT_MODEL_NAME),
+            learning_rate=learning_rate,
+            num_train_steps=train_steps,
+            num_warmup_steps=num_warmup_steps,
+            use_tpu=use_tpu,
+            use_one_hot_embeddings=True,
+            extract_last_layer=store_last_layer
             )
 
-            train_features = run_classifier.convert_examples_to_features(
-                train_examples, label_list, MAX_SEQ_LENGTH, tokenizer)
-
-            logger.info('***** Fine tuning BERT base model normally takes a few minutes. Please wait...')
-            logger.info('***** Started training using {} at {} *****'.format(train_annot_dataset, datetime.datetime.now()))
-            logger.info('  Num examples = {}'.format(len(train_examples)))
-            logger.info('  Batch size = {}'.format(TRAIN_BATCH_SIZE))
-            logger.info('  Train steps = {}'.format(num_train_steps))
-            logger.info('  Number of training steps = {}'.format(num_train_steps))
-
-            tf.logging.info('  Num steps = %d', num_train_steps)
-            train_input_fn = run_classifier.input_fn_builder(
+        estimator = tf.contrib.tpu.TPUEstimator(
+            use_tpu=use_tpu,
+            model_fn=model_fn,
+            config=get_run_config(temp_output_dir),
+            train_batch_size=TRAIN_BATCH_SIZE,
+            eval_batch_size=EVAL_BATCH_SIZE,
+            predict_batch_size=PREDICT_BATCH_SIZE,
+        )
+
+        train_features = get_features(train_annot_dataset, 'train')
+
+        logger.info('***** Fine tuning BERT base model normally takes a few minutes. Please wait...')
+        logger.info('***** Started training using {} at {} *****'.format(train_annot_dataset, datetime.datetime.now()))
+        logger.info('  Num examples = {}'.format(len(train_features['label_ids'])))
+        logger.info('  Batch size = {}'.format(TRAIN_BATCH_SIZE))
+        logger.info('  Train steps = {}'.format(train_steps))
+        logger.info('  Number of training steps = {}'.format(train_steps))
+
+        tf.logging.info('  Num steps = %d', train_steps)
+        if train_buckets:
+            # every bucket is a separate train call (static shapes), alternating in short rounds of shuffled bucket order
+            train_bucket_indices = bucket_indices(train_features['input_mask'], bucket_lengths)
+            train_schedule = [(bucket_lengths[bucket], train_bucket_indices[bucket], steps) for bucket, steps in
+                              schedule_train_steps([len(b) for b in train_bucket_indices], train_steps, rounds=TRAIN_BUCKET_ROUNDS, seed=repeat)]
+        else:
+            # a single train call over all examples at the full sequence length, buckets are only used for prediction
+            train_schedule = [(MAX_SEQ_LENGTH, None, train_steps)]
+        completed_steps = 0
+        for seq_length, indices, steps in train_schedule:
+            logger.info(f'  Training {steps} steps with sequence length {seq_length}')
+            train_input_fn = input_fn_builder(
                 features=train_features,
-                seq_length=MAX_SEQ_LENGTH,
                 is_training=True,
-                drop_remainder=True)
-
-            estimator.train(input_fn=train_input_fn, max_steps=num_train_steps)
-            logger.info('***** Finished training using {} at {} *****'.format(train_annot_dataset, datetime.datetime.now()))
-
-            last_completed_train = train_annot_dataset
-            completed_train_dirs.append(temp_output_dir)
-
-            ######################################
-            ######### TRAINING PREDICTION ########
-            ######################################
-            train_pred_input_fn = run_classifier.input_fn_builder(
-                features=train_features,
-                seq_length=MAX_SEQ_LENGTH,
-                is_training=False,
-                drop_remainder=False)
+                drop_remainder=True,
+                seq_length=seq_length,
+                indices=indices)
+            completed_steps += steps
+            estimator.train(input_fn=train_input_fn, max_steps=completed_steps)
+        logger.info('***** Finished training using {} at {} *****'.format(train_annot_dataset, datetime.datetime.now()))
+
+        completed_train_dirs.append(temp_output_dir)
+
+        ######################################
+        ######### TRAINING PREDICTION ########
+        ######################################
+        hidden_state_writer = None
+        if store_last_layer:
+            hidden_state_writer = HiddenStateWriter(os.path.join(HIDDEN_STATE_DIR, f'train_{experiment_id}.npy'), len(train_features['guid']))
+        predictions = predict_bucketed(estimator, train_features, bucket_lengths, hidden_state_writer=hidden_state_writer)
+        probabilities = predictions['probabilities']
+        y_true = train_features['label_ids'].tolist()
+        guid = train_features['guid']
+        save_predictions(os.path.join(PREDICTIONS_DIR, f'train_{experiment_id}.npz'), guid, probabilities, y_true=y_true,
+                         label_mapping=label_mapping, experiment_id=experiment_id, dataset='train')
+
+        for exp_nr in exp_nrs:
+            logger.info(f"***** Starting Experiment {exp_nr} *******")
+            logger.info(f"***** {experiment_definitions[exp_nr]['name']} ******")
+            logger.info("***********************************************")
+            experiment_id = experiment_ids[exp_nr]
+
+            #############################
+            ######### EVALUATING ########
+            #############################
+            eval_annot_dataset = experiment_definitions[exp_nr][
+                "eval_annot_dataset"]
+
+            eval_features = get_features(eval_annot_dataset, 'dev')
+            num_eval_examples = len(eval_features['label_ids'])
+            logger.info('***** Started evaluation of {} at {} *****'.format(
+                experiment_definitions[exp_nr]["name"], datetime.datetime.now()))
+            logger.info('Num examples = {}'.format(num_eval_examples))
+            logger.info('Batch size = {}'.format(EVAL_BATCH_SIZE))
+            if num_eval_examples == 0:
+                logger.warning(f'No dev examples in {eval_annot_dataset}, skipping evaluation of experiment {exp_nr}')
+                continue
 
-            predictions = estimator.predict(input_fn=train_pred_input_fn)
-            probabilities, last_layer = list(zip(*[[p['probabilities'], p['last_layer']] for p in predictions]))
-            probabilities = np.array(probabilities)
+            # A single predict pass gives loss, probabilities and hidden states. The last batch is padded, so every example is scored once.
+            hidden_state_writer = None
             if store_last_layer:
-                # extract state for CLS token 
-                last_layer = [_l[0] for _l in last_layer]
-            else:
-                last_layer = None
-            y_true = [e.label_id for e in train_features]
-            guid = [e.guid for e in train_examples]
-            predictions_output = get_predictions_output(experiment_id, guid, probabilities, y_true, cls_hidden_state=last_layer, label_mapping=label_mapping, dataset='train')
-            save_to_json(predictions_output ,os.path.join(PREDICTIONS_JSON_DIR, f'train_{experiment_id}.json'))
-
-        #############################
-        ######### EVALUATING ########
-        #############################
-        eval_annot_dataset = experiment_definitions[exp_nr][
-            "eval_annot_dataset"]
-
-        eval_examples = processor.get_dev_examples(
-            os.path.join('data', eval_annot_dataset))
-        eval_features = run_classifier.convert_examples_to_features(
-            eval_examples, label_list, MAX_SEQ_LENGTH, tokenizer)
-        logger.info('***** Started evaluation of {} at {} *****'.format(
-            experiment_definitions[exp_nr]["name"], datetime.datetime.now()))
-        logger.info('Num examples = {}'.format(len(eval_examples)))
-        logger.info('Batch size = {}'.format(EVAL_BATCH_SIZE))
-
-        # Eval will be slightly WRONG on the TPU because it will truncate the last batch.
-        eval_steps = int(len(eval_examples) / EVAL_BATCH_SIZE)
-        eval_input_fn = run_classifier.input_fn_builder(
-            features=eval_features,
-            seq_length=MAX_SEQ_LENGTH,
-            is_training=False,
-            drop_remainder=True)
-        result = estimator.evaluate(input_fn=eval_input_fn, steps=eval_steps)
-
-        logger.info(
-            '***** Finished first half of evaluation of {} at {} *****'.format(
-                experiment_definitions[exp_nr]["name"],
-                datetime.datetime.now()))
-
-        output_eval_file = os.path.join(temp_output_dir, 'eval_results.txt')
-        with tf.gfile.GFile(output_eval_file, 'w') as writer:
-            logger.info('***** Eval results *****')
-            for key in sorted(result.keys()):
-                logger.info('  {} = {}'.format(key, str(result[key])))
-                writer.write('%s = %s\n' % (key, str(result[key])))
-
-        predictions = estimator.predict(eval_input_fn)
-        probabilities = np.array([p['probabilities'] for p in predictions])
-        y_pred = np.argmax(probabilities, axis=1)
-        y_true = [e.label_id for e in eval_features]
-        guid = [e.guid for e in eval_examples]
-        scores = performance_metrics(y_true,
-                                     y_pred,
-                                     label_mapping=label_mapping)
-        logger.info('Final scores:')
-        logger.info(scores)
-        logger.info('***** Finished second half of evaluation of {} at {} *****'.
-              format(experiment_definitions[exp_nr]["name"],
-                     datetime.datetime.now()))
-
-        # write full dev prediction output
-        predictions_output = get_predictions_output(experiment_id, guid, probabilities, y_true, label_mapping=label_mapping, dataset='dev')
-        save_to_json(predictions_output, os.path.join(PREDICTIONS_JSON_DIR, f'dev_{experiment_id}.json'))
-
-        # Write log to Training Log File
-        data = {
-            'Experiment_Name': experiment_definitions[exp_nr]["name"],
-            'Experiment_Id':experiment_id,
-            'Date': format(datetime.datetime.now()),
-            'User': username,
-            'Model': BERT_MODEL_NAME,
-            'Num_Train_Steps': num_train_steps,
-            'Train_Annot_Dataset': train_annot_dataset,
-            'Eval_Annot_Dataset': eval_annot_dataset,
-            'Learning_Rate': LEARNING_RATE,
-            'Max_Seq_Length': MAX_SEQ_LENGTH,
-            'Eval_Loss': result['eval_loss'],
-            'Loss': result['loss'],
-            'Comment': comment,
-            **scores
-        }
-
-        append_to_csv(data, os.path.join(LOG_CSV_DIR,'fulltrainlog.csv'))
-        logger.info(f"***** Completed Experiment {exp_nr} *******")
+                hidden_state_writer = HiddenStateWriter(os.path.join(HIDDEN_STATE_DIR, f'dev_{experiment_id}.npy'), num_eval_examples)
+            predictions = predict_bucketed(estimator, eval_features, bucket_lengths, hidden_state_writer=hidden_state_writer)
+            probabilities = predictions['probabilities']
+            y_pred = np.argmax(probabilities, axis=1)
+            y_true = eval_features['label_ids'].tolist()
+            guid = eval_features['guid']
+            eval_loss = float(np.mean(predictions['per_example_loss']))
+            result = {
+                'eval_accuracy': float(np.mean(y_pred == eval_features['label_ids'])),
+                'eval_loss': eval_loss,
+                'loss': eval_loss,
+                'global_step': estimator.get_variable_value('global_step')
+            }
+
+            output_eval_file = os.path.join(temp_output_dir, 'eval_results.txt')
+            with tf.gfile.GFile(output_eval_file, 'w') as writer:
+                logger.info('***** Eval results *****')
+                for key in sorted(result.keys()):
+                    logger.info('  {} = {}'.format(key, str(result[key])))
+                    writer.write('%s = %s\n' % (key, str(result[key])))
+
+            scores = performance_metrics(y_true,
+                                         y_pred,
+                                         label_mapping=label_mapping,
+                                         bootstrap_resamples=bootstrap_resamples)
+            logger.info('Final scores:')
+            logger.info(scores)
+            logger.info('***** Finished evaluation of {} at {} *****'.
+                  format(experiment_definitions[exp_nr]["name"],
+                         datetime.datetime.now()))
+
+            # write full dev prediction output
+            save_predictions(os.path.join(PREDICTIONS_DIR, f'dev_{experiment_id}.npz'), guid, probabilities, y_true=y_true,
+                             label_mapping=label_mapping, experiment_id=experiment_id, dataset='dev')
+
+            # Write log to Training Log File
+            data = {
+                'Experiment_Name': experiment_definitions[exp_nr]["name"],
+                'Experiment_Id':experiment_id,
+                'Date': format(datetime.datetime.now()),
+                'User': username,
+                'Model': BERT_MODEL_NAME if bert_model_dir == BERT_MODEL_DIR else os.path.join(bert_model_dir, BERT_MODEL_NAME),
+                'Num_Train_Steps': train_steps,
+                'Train_Annot_Dataset': train_annot_dataset,
+                'Eval_Annot_Dataset': eval_annot_dataset,
+                'Learning_Rate': learning_rate,
+                'Max_Seq_Length': MAX_SEQ_LENGTH,
+                # sequence lengths trained with, to compare bucketed with unbucketed training
+                'Train_Seq_Lengths': ','.join(map(str, bucket_lengths)) if train_buckets else str(MAX_SEQ_LENGTH),
+                'Eval_Loss': result['eval_loss'],
+                'Loss': result['loss'],
+                'Comment': comment,
+                **scores
+            }
+
+            with ResultsStore(RESULTS_DB) as results_store:
+                results_store.insert(data)
+            logger.info(f"***** Completed Experiment {exp_nr} *******")
 
     logger.info(f"***** Completed all experiments in {repeat} repeats. We should now clean up all remaining files *****")
     for c in completed_train_dirs:
@@ -577,6 +461,103 @@ def run_experiment(experiments, use_tpu, tpu_address, repeat, num_train_steps, u
         logger.info("gsutil -m rm -r " + c)
         os.system("gsutil -m rm -r " + c)
 
+def convert_examples_to_arrays(examples, label_list, max_seq_length, tokenizer, num_workers):
+    """
+    Same as `run_classifier.convert_examples_to_features` followed by `features_to_arrays`, but shards of examples
+    are converted in `num_workers` forked processes, which write their rows straight into shared arrays.
+    """
+    num_examples = len(examples)
+    arrays = {name: shared_array((num_examples,) if name == 'label_ids' else (num_examples, max_seq_length), np.int32) for name in FEATURE_NAMES}
+    def _fill(start, end):
+        for ex_index in range(start, end):
+            feature = run_classifier.convert_single_example(ex_index, examples[ex_index], label_list, max_seq_length, tokenizer)
+            arrays['input_ids'][ex_index] = feature.input_ids
+            arrays['input_mask'][ex_index] = feature.input_mask
+            arrays['segment_ids'][ex_index] = feature.segment_ids
+            arrays['label_ids'][ex_index] = feature.label_id
+        if hasattr(tokenizer.wordpiece_tokenizer, 'log_stats'):
+            tokenizer.wordpiece_tokenizer.log_stats()
+    run_sharded(_fill, num_examples, num_workers)
+    arrays['guid'] = np.array([e.guid for e in examples], dtype=str)
+    return arrays
+
+def input_fn_builder(features, is_training, drop_remainder, seq_length=None, indices=None, pad_remainder=False):
+    """
+    Creates an `input_fn` closure from padded feature arrays to be passed to TPUEstimator.
+    If given, only the examples in `indices` are used and sequences are cut to a static `seq_length`.
+    With `pad_remainder` the last batch is filled up with fake examples (`is_real_example` = 0), so
+    all batches are full and no real example is dropped.
+    """
+    if indices is None:
+        indices = np.arange(len(features['label_ids']))
+    if seq_length is None:
+        seq_length = features['input_ids'].shape[1]
+    def input_fn(params):
+        """The actual input function."""
+        batch_size = params['batch_size']
+        ids = indices
+        is_real_example = np.ones(len(ids), dtype=np.int32)
+        if pad_remainder:
+            num_padding = -len(ids) % batch_size
+            ids = np.concatenate([ids, np.repeat(ids[:1], num_padding)])
+            is_real_example = np.concatenate([is_real_example, np.zeros(num_padding, dtype=np.int32)])
+        d = tf.data.Dataset.from_tensor_slices({
+            'is_real_example': is_real_example,
+            **{name: features[name][ids, :seq_length] if features[name].ndim == 2 else features[name][ids]
+               for name in FEATURE_NAMES}})
+        if is_training:
+            d = d.repeat()
+            d = d.shuffle(buffer_size=100)
+        d = d.batch(batch_size=batch_size, drop_remainder=drop_remainder)
+        return d
+    return input_fn
+
+def predict_bucketed(estimator, features, bucket_lengths, hidden_state_writer=None):
+    """
+    Runs `estimator.predict` once per length bucket, so every call compiles against a single static shape.
+    The last batch of every bucket is padded with fake examples which are filtered out again, so every
+    example is scored exactly once. Identical examples (same tokens and label) are only predicted once.
+    Returns the stacked prediction outputs in the original example order, an empty dict if there are no examples.
+    CLS hidden states are not returned but streamed into `hidden_state_writer` at their original indices.
+    """
+    unique_index, inverse = dedup_rows(*(features[name] for name in FEATURE_NAMES))
+    dedup_stats(len(inverse), len(unique_index), what='examples')
+    if len(unique_index) == 0:
+        if hidden_state_writer is not None:
+            hidden_state_writer.close()
+        return {}
+    unique_features = {name: features[name][unique_index] for name in FEATURE_NAMES}
+    # original indices of every unique example
+    duplicates = duplicate_groups(inverse)
+    outputs = {}
+    all_indices = []
+    for bucket, indices in enumerate(bucket_indices(unique_features['input_mask'], bucket_lengths)):
+        if len(indices) == 0:
+            continue
+        input_fn = input_fn_builder(
+            features=unique_features,
+            is_training=False,
+            drop_remainder=True,
+            seq_length=bucket_lengths[bucket],
+            indices=indices,
+            pad_remainder=True)
+        # real examples come in the order of `indices`, padding comes last
+        num_real = 0
+        for p in estimator.predict(input_fn=input_fn):
+            if not p['is_real_example']:
+                continue
+            cls_hidden_state = p.pop('cls_hidden_state', None)
+            if hidden_state_writer is not None and cls_hidden_state is not None:
+                hidden_state_writer.write(duplicates[indices[num_real]], cls_hidden_state)
+            num_real += 1
+            for key, value in p.items():
+                outputs.setdefault(key, []).append(value)
+        all_indices.append(indices)
+    if hidden_state_writer is not None:
+        hidden_state_writer.close()
+    order = np.argsort(np.concatenate(all_indices), kind='stable')
+    return {key: np.array(values)[order][inverse] for key, values in outputs.items()}
+
 def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate, num_train_steps, num_warmup_steps, use_tpu, use_one_hot_embeddings, extract_last_layer=False):
     """Returns `model_fn` closure for TPUEstimator."""
     def model_fn(features, labels, mode, params):
@@ -640,12 +621,17 @@ def model_fn_builder(bert_config, num_labels, init_checkpoint, learning_rate, nu
                     eval_metrics=eval_metrics,
                     scaffold_fn=scaffold_fn)
         else:
-            last_layer = None
+            # Loss is part of the predictions, so a single predict pass also serves as evaluation
+            predictions = {
+                    "probabilities": probabilities,
+                    "per_example_loss": per_example_loss,
+                    "is_real_example": is_real_example}
             if extract_last_layer:
-                last_layer = model.get_all_encoder_layers()[-1]
+                # only the CLS token leaves the device
+                predictions['cls_hidden_state'] = model.get_sequence_output()[:, 0, :]
             output_spec = tf.contrib.tpu.TPUEstimatorSpec(
                     mode=mode,
-                    predictions={"probabilities": probabilities, 'last_layer': last_layer},
+                    predictions=predictions,
                     scaffold_fn=scaffold_fn)
         return output_spec
     return model_fn
@@ -722,7 +708,30 @@ def parse_args(args):
         '--store_last_layer',
         action='store_true',
         default=False,
-        help='Store last layer of encoder')
+        help='Store the CLS hidden state of the last encoder layer (float16, in {})'.format(HIDDEN_STATE_DIR))
+    parser.add_argument(
+        '--seq_buckets',
+        help='Comma-separated sequence lengths examples are bucketed into. Default is {}'.format(SEQ_LENGTH_BUCKETS),
+        default=SEQ_LENGTH_BUCKETS)
+    parser.add_argument(
+        '--train_buckets',
+        action='store_true',
+        default=False,
+        help='Also train in sequence length buckets, as {} rounds of separate train calls per bucket. By default buckets are only used for prediction.'.format(TRAIN_BUCKET_ROUNDS))
+    parser.add_argument(
+        '--tokenize_workers',
+        help='Number of processes used for tokenization. Default is {}'.format(TOKENIZE_WORKERS),
+        default=TOKENIZE_WORKERS,
+        type=int)
+    parser.add_argument(
+        '--bootstrap_resamples',
+        help='Number of bootstrap resamples for the confidence intervals of the scores, 0 disables them. Default is {}'.format(BOOTSTRAP_RESAMPLES),
+        default=BOOTSTRAP_RESAMPLES,
+        type=int)
+    parser.add_argument(
+        '--bert_model_dir',
+        help='Directory with bert_config.json, vocab.txt and {} to fine-tune from, e.g. the tf/ directory written by target-translate/pretrain.py --tf-checkpoint. Default is {}'.format(BERT_MODEL_NAME, BERT_MODEL_DIR),
+        default=BERT_MODEL_DIR)
     parser.add_argument(
         '--comment',
         help='Optional. Add a Comment to the logfile for internal reference.',
@@ -745,7 +754,8 @@ def main(args):
 
     for repeat in range(args.repeats):
         run_experiment(args.experiments, use_tpu, tpu_address, repeat+1, args.num_train_steps,
-                       args.username, args.comment, args.store_last_layer)
+                       args.username, args.comment, args.store_last_layer, args.seq_buckets, args.bootstrap_resamples, args.tokenize_workers,
+                       args.bert_model_dir, args.train_buckets)
         logger.info(f'*** Completed repeats {repeat + 1}')
 
 
@@ -0,0 +1,45 @@
+import numpy as np
+
+def parse_bucket_lengths(buckets, max_seq_length):
+    """Returns sorted bucket lengths from a comma-separated string. The last bucket always is `max_seq_length`."""
+    bucket_lengths = sorted(set(int(b) for b in buckets.split(',') if b.strip()))
+    bucket_lengths = [b for b in bucket_lengths if b < max_seq_length]
+    return bucket_lengths + [max_seq_length]
+
+def bucket_indices(input_mask, bucket_lengths):
+    """Assigns every example to the shortest bucket its real tokens fit into. Returns the example indices of each bucket."""
+    lengths = np.asarray(input_mask).sum(axis=1)
+    bucket_ids = np.searchsorted(bucket_lengths, lengths, side='left')
+    bucket_ids = np.minimum(bucket_ids, len(bucket_lengths) - 1)
+    return [np.flatnonzero(bucket_ids == b) for b in range(len(bucket_lengths))]
+
+def schedule_train_steps(bucket_sizes, num_train_steps, rounds=1, seed=None):
+    """
+    Distributes training steps over buckets proportionally to their number of examples. The steps of each
+    bucket are split into `rounds` rounds, so training alternates between buckets. With a `seed` the bucket
+    order is shuffled in every round, so that training does not always end on the longest bucket.
+    Returns a list of (bucket, steps) in the order they should be trained.
+    """
+    bucket_sizes = np.asarray(bucket_sizes, dtype=float)
+    steps = _split_proportionally(num_train_steps, bucket_sizes)
+    steps_by_round = [_split_proportionally(s, np.ones(rounds)) for s in steps]
+    random_state = np.random.RandomState(seed) if seed is not None else None
+    schedule = []
+    for r in range(rounds):
+        order = np.arange(len(bucket_sizes))
+        if random_state is not None:
+            random_state.shuffle(order)
+        for b in order:
+            if steps_by_round[b][r] > 0:
+                schedule.append((int(b), int(steps_by_round[b][r])))
+    return schedule
+
+def _split_proportionally(total, weights):
+    """Splits an integer `total` proportionally to `weights` (largest remainder method)"""
+    if weights.sum() == 0:
+        return np.zeros(len(weights), dtype=int)
+    exact = total * weights / weights.sum()
+    parts = np.floor(exact).astype(int)
+    remainder = total - parts.sum()
+    parts[np.argsort(-(exact - parts), kind='stable')[:remainder]] += 1
+    return parts
@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# languages in the order they are concatenated for the multilingual datasets
+LANGUAGES = ['en', 'pt', 'fr', 'de', 'es']
+MULTILINGUAL_NAME = 'cb-annot-en-de-fr-es-pt'
+UNANNOTATED_DIR = 'cb-unannotated'
+COLUMNS = ['id', 'label', 'a', 'text']
+STATE_FILE = '.build_state.json'
+# bump to rebuild every dataset after changing a derivation
+BUILD_VERSION = 1
+SAMPLE_SIZE = 1000
+NUM_UNANNOTATED = 10000
+RANDOM_STATE = 42
+
+
+def annotated_column(lang):
+    """Text column of the annotation sheet (English originals and their translations)"""
+    return 'cb-annot-en' if lang == 'en' else 'cb-annot-en-' + lang
+
+def unannotated_column(lang):
+    return 'cb-en' if lang == 'en' else 'cb-en-' + lang
+
+def read_sheet(f_name):
+    """Reads a CSV or TSV export of a Google sheet, all cells as strings like gspread returns them"""
+    df = pd.read_csv(f_name, sep='\t' if f_name.endswith('.tsv') else ',', dtype=str, keep_default_na=False)
+    df['a'] = 'a'
+    return df
+
+def frame_digest(df):
+    """Content hash of a DataFrame (column names and values, not the index)"""
+    h = hashlib.sha1(json.dumps(list(map(str, df.columns))).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+#
+# Derivations. Every function returns a new DataFrame and leaves its inputs untouched.
+#
+def select_group(df, group):
+    return df[df['group'] == group]
+
+def with_language(df, lang):
+    """Suffixes the ids with the language, so the same tweet in different languages has different ids"""
+    return df.assign(id=df['id'] + '-' + lang)
+
+def sample(df, n, random_state):
+    return df.sample(n=min(n, len(df)), random_state=random_state)
+
+def head(df, n):
+    return df.iloc[:n]
+
+def concat_shuffled(*dfs, random_state):
+    df = pd.concat(dfs, join='inner')
+    return df.sample(n=len(df), random_state=random_state).reset_index(drop=True)
+
+def undersample(df, random_state):
+    """Samples every label down to the count of the rarest label"""
+    groups = [g for _, g in df.groupby('label', sort=True)]
+    n = min(len(g) for g in groups)
+    return pd.concat([g if len(g) == n else g.sample(n=n, random_state=random_state) for g in groups])
+
+def oversample(df, random_state):
+    """Samples every label up to the count of the most frequent label (with replacement)"""
+    groups = [g for _, g in df.groupby('label', sort=True)]
+    n = max(len(g) for g in groups)
+    return pd.concat([g if len(g) == n else g.sample(n=n, random_state=random_state, replace=True) for g in groups])
+
+
+class BuildGraph():
+    """
+    Named DataFrames, either sources or derivations of other nodes. The key of a source is the hash of its content, the
+    key of a derivation the hash of its function, parameters and input keys, so keys change exactly when the result can.
+    Nodes are only computed when needed and at most once.
+    """
+    def __init__(self):
+        self.nodes = {}
+        self._keys = {}
+        self._values = {}
+
+    def source(self, name, df):
+        self.nodes[name] = None
+        self._values[name] = df
+        self._keys[name] = frame_digest(df)
+        return name
+
+    def derive(self, name, fn, *inputs, **params):
+        for i in inputs:
+            if i not in self.nodes:
+                raise KeyError(f'Unknown input {i} of {name}')
+        self.nodes[name] = (fn, inputs, params)
+        return name
+
+    def key(self, name):
+        if name not in self._keys:
+            fn, inputs, params = self.nodes[name]
+            h = hashlib.sha1(f'{BUILD_VERSION}:{fn.__name__}:{json.dumps(params, sort_keys=True)}'.encode('utf-8'))
+            for i in inputs:
+                h.update(self.key(i).encode('utf-8'))
+            self._keys[name] = h.hexdigest()
+        return self._keys[name]
+
+    def value(self, name):
+        if name not in self._values:
+            fn, inputs, params = self.nodes[name]
+            self._values[name] = fn(*[self.value(i) for i in inputs], **params)
+        return self._values[name]
+
+
+def declare_datasets(graph, annotated, unannotated=None, sample_size=SAMPLE_SIZE, num_unannotated=NUM_UNANNOTATED, random_state=RANDOM_STATE):
+    """Declares the nodes of all datasets. Returns {dataset directory: {file name: (node, columns)}}."""
+    datasets = {}
+    splits = {}
+    for lang in LANGUAGES:
+        name = annotated_column(lang)
+        # one source per language, a changed translation only rebuilds the datasets which contain it
+        graph.source(name, annotated[['id', 'label', 'a', 'group', name]].rename(columns={name: 'text'}))
+        for group in ['train', 'dev', 'test']:
+            graph.derive(f'{name}/{group}-raw', select_group, name, group=group)
+            splits[lang, group] = graph.derive(f'{name}/{group}', with_language, f'{name}/{group}-raw', lang=lang)
+        splits[lang, 'train-sm'] = graph.derive(f'{name}/train-sm', sample, splits[lang, 'train'], n=sample_size, random_state=random_state)
+        # undersampled before the languages are concatenated, so that a dropped tweet is dropped in every language
+        splits[lang, 'train-us'] = graph.derive(f'{name}/train-us', undersample, splits[lang, 'train'], random_state=random_state)
+        for suffix, train in [('', splits[lang, 'train']), ('-sm', splits[lang, 'train-sm'])]:
+            datasets[name + suffix] = {
+                    'train.tsv': (train, COLUMNS),
+                    'dev.tsv': (splits[lang, 'dev'], COLUMNS),
+                    'test.tsv': (splits[lang, 'test'], COLUMNS),
+                    'annotated_test.tsv': (splits[lang, 'test'], COLUMNS)
+                    }
+    for suffix in ['', '-sm', '-us']:
+        graph.derive(MULTILINGUAL_NAME + suffix, concat_shuffled, *[splits[lang, 'train' + suffix] for lang in LANGUAGES], random_state=random_state)
+        datasets[MULTILINGUAL_NAME + suffix] = {'train.tsv': (MULTILINGUAL_NAME + suffix, COLUMNS)}
+    graph.derive(MULTILINGUAL_NAME + '-os-raw', oversample, MULTILINGUAL_NAME, random_state=random_state)
+    graph.derive(MULTILINGUAL_NAME + '-os', concat_shuffled, MULTILINGUAL_NAME + '-os-raw', random_state=random_state)
+    datasets[MULTILINGUAL_NAME + '-os'] = {'train.tsv': (MULTILINGUAL_NAME + '-os', COLUMNS)}
+    if unannotated is not None:
+        files = {}
+        for lang in LANGUAGES:
+            name = unannotated_column(lang)
+            graph.source(name, unannotated[['id', name]].rename(columns={name: 'text'}))
+            files[name + '.tsv'] = (graph.derive(f'{name}/head', head, name, n=num_unannotated), ['id', 'text'])
+        datasets[UNANNOTATED_DIR] = files
+    return datasets
+
+def dataset_key(graph, files):
+    h = hashlib.sha1()
+    for f_name, (node, columns) in sorted(files.items()):
+        h.update(f'{f_name}:{",".join(columns)}:{graph.key(node)}'.encode('utf-8'))
+    return h.hexdigest()
+
+def read_state(output_path):
+    state_path = os.path.join(output_path, STATE_FILE)
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def write_state(output_path, state):
+    state_path = os.path.join(output_path, STATE_FILE)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+    os.replace(state_path + '.tmp', state_path)
+
+def build(graph, datasets, output_path, force=False):
+    """Writes the datasets whose key changed since the last build (or whose files are missing). Returns the names of the rebuilt datasets."""
+    if not os.path.isdir(output_path):
+        os.makedirs(output_path)
+    state = read_state(output_path)
+    rebuilt = []
+    for name, files in datasets.items():
+        key = dataset_key(graph, files)
+        dataset_dir = os.path.join(output_path, name)
+        if not force and state.get(name) == key and all(os.path.isfile(os.path.join(dataset_dir, f_name)) for f_name in files):
+            logger.info(f'{name} is up to date')
+            continue
+        if not os.path.isdir(dataset_dir):
+            os.makedirs(dataset_dir)
+        for f_name, (node, columns) in files.items():
+            f_path = os.path.join(dataset_dir, f_name)
+            graph.value(node).to_csv(f_path + '.tmp', columns=columns, header=False, index=False, sep='\t', encoding='utf-8')
+            os.replace(f_path + '.tmp', f_path)
+        # recorded after every dataset, an interrupted build continues with the remaining ones
+        state[name] = key
+        write_state(output_path, state)
+        rebuilt.append(name)
+        logger.info(f'Built {name} ({", ".join(f"{f_name}: {len(graph.value(node)):,} rows" for f_name, (node, _) in files.items())})')
+    logger.info(f'Rebuilt {len(rebuilt)} of {len(datasets)} datasets in {output_path}')
+    return rebuilt
+
+def upload(output_path, names, destination):
+    """Copies the given dataset directories to a bucket, e.g. gs://perepublic/EPFL_multilang/data/"""
+    for name in names:
+        subprocess.run(['gsutil', '-m', 'cp', '-r', os.path.join(output_path, name), destination.rstrip('/') + '/'], check=True)
+    logger.info(f'Uploaded {len(names)} datasets to {destination}')
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Builds the cb-annot-* datasets from local exports of the annotation sheets. Only datasets whose inputs or parameters changed are rewritten.')
+    parser.add_argument('--annotated', required=True, help='CSV/TSV export of the "unique" worksheet of EPFL_vaccine_sentiment_3fold_agreed')
+    parser.add_argument('--unannotated', default=None, help='Optional. CSV/TSV export of the "raw" worksheet of EPFL unannotated tweets')
+    parser.add_argument('--output_path', default='data', help='Directory of the datasets. Default is data')
+    parser.add_argument('--sample_size', default=SAMPLE_SIZE, type=int, help='Number of train examples of the -sm datasets. Default is {}'.format(SAMPLE_SIZE))
+    parser.add_argument('--num_unannotated', default=NUM_UNANNOTATED, type=int, help='Number of unannotated tweets. Default is {}'.format(NUM_UNANNOTATED))
+    parser.add_argument('--random_state', default=RANDOM_STATE, type=int)
+    parser.add_argument('--force', action='store_true', default=False, help='Rebuild all datasets')
+    parser.add_argument('--upload', default=None, help='Optional. Bucket path the rebuilt datasets are copied to with gsutil')
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+    annotated = read_sheet(args.annotated)
+    unannotated = read_sheet(args.unannotated) if args.unannotated is not None else None
+    graph = BuildGraph()
+    datasets = declare_datasets(graph, annotated, unannotated, sample_size=args.sample_size, num_unannotated=args.num_unannotated, random_state=args.random_state)
+    rebuilt = build(graph, datasets, args.output_path, force=args.force)
+    if args.upload is not None and len(rebuilt) > 0:
+        upload(args.output_path, rebuilt, args.upload)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+import numpy as np
+import hashlib
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+FEATURE_NAMES = ['input_ids', 'input_mask', 'segment_ids', 'label_ids']
+
+def file_digest(f_name, open_fn=open, chunk_size=1 << 20):
+    """Returns the sha1 hex digest of a file's content"""
+    h = hashlib.sha1()
+    with open_fn(f_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def features_to_arrays(features, guid):
+    """Packs a list of `InputFeatures` into padded int32 arrays"""
+    return {
+        'input_ids': np.array([f.input_ids for f in features], dtype=np.int32),
+        'input_mask': np.array([f.input_mask for f in features], dtype=np.int32),
+        'segment_ids': np.array([f.segment_ids for f in features], dtype=np.int32),
+        'label_ids': np.array([f.label_id for f in features], dtype=np.int32),
+        'guid': np.array(guid, dtype=str)
+    }
+
+class FeatureCache:
+    """
+    On-disk cache of tokenized features. Entries are keyed by the content of the data
+    file and vocab file together with the tokenizer settings, so a dataset only gets
+    tokenized once no matter how many experiments and repeats use it.
+    """
+    def __init__(self, cache_dir, open_fn=open):
+        self.cache_dir = cache_dir
+        # open_fn allows reading vocab files from buckets (e.g. tf.gfile.GFile)
+        self.open_fn = open_fn
+        self._digests = {}
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _digest(self, f_name):
+        if f_name not in self._digests:
+            self._digests[f_name] = file_digest(f_name, open_fn=self.open_fn)
+        return self._digests[f_name]
+
+    def key(self, data_file, vocab_file, do_lower_case, max_seq_length):
+        h = hashlib.sha1()
+        for part in [self._digest(data_file), self._digest(vocab_file), str(bool(do_lower_case)), str(max_seq_length)]:
+            h.update(part.encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key):
+        f_name = self.path(key)
+        if not os.path.isfile(f_name):
+            return None
+        with np.load(f_name) as data:
+            return {k: data[k] for k in data.files}
+
+    def save(self, key, arrays):
+        f_name = self.path(key)
+        tmp_f_name = f'{f_name}.{os.getpid()}.tmp'
+        with open(tmp_f_name, 'wb') as f:
+            np.savez(f, **arrays)
+        # Atomic rename so concurrent runs never see a partially written entry
+        os.replace(tmp_f_name, f_name)
+
+    def get_or_create(self, data_file, vocab_file, do_lower_case, max_seq_length, create_fn):
+        """
+        Returns the feature arrays for `data_file`. On a cache miss `create_fn()` is called and
+        has to return the arrays as produced by `features_to_arrays`.
+        """
+        key = self.key(data_file, vocab_file, do_lower_case, max_seq_length)
+        arrays = self.load(key)
+        if arrays is not None:
+            logger.info(f'Loaded cached features for {data_file} ({len(arrays["label_ids"])} examples)')
+            return arrays
+        logger.info(f'No cached features for {data_file}. Tokenizing...')
+        arrays = create_fn()
+        self.save(key, arrays)
+        return arrays
@@ -0,0 +1,46 @@
+import logging
+import mmap
+import multiprocessing
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Below this number of rows per worker, forking costs more than it saves
+MIN_ROWS_PER_WORKER = 1000
+
+
+def shared_array(shape, dtype):
+    """Zero-initialized array in anonymous shared memory. Writes of forked child processes are visible to the parent."""
+    dtype = np.dtype(dtype)
+    num_bytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    buffer = mmap.mmap(-1, num_bytes, flags=mmap.MAP_SHARED, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def shard_ranges(num_rows, num_shards):
+    """Splits rows into `num_shards` contiguous (start, end) ranges of nearly equal size"""
+    bounds = np.linspace(0, num_rows, num_shards + 1).astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+def run_sharded(fill_fn, num_rows, num_workers):
+    """
+    Calls `fill_fn(start, end)` for contiguous row ranges in `num_workers` forked processes. `fill_fn` writes rows
+    [start, end) into arrays shared with this process (`shared_array` or memory-mapped files), so nothing but the
+    exit code is sent back. Rows keep their position, the result is identical to `fill_fn(0, num_rows)`.
+    Forking a process with running threads (e.g. the thread pools of a TensorFlow session or estimator) can deadlock the
+    workers, so this has to be called before any such threads are started.
+    """
+    num_workers = min(num_workers, num_rows // MIN_ROWS_PER_WORKER)
+    if num_workers <= 1:
+        fill_fn(0, num_rows)
+        return
+    logger.info(f'Tokenizing {num_rows:,} examples in {num_workers} processes')
+    # fork, so that the workers inherit the examples and tokenizer without pickling
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=fill_fn, args=shard) for shard in shard_ranges(num_rows, num_workers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    failed = [w.exitcode for w in workers if w.exitcode != 0]
+    if failed:
+        raise Exception(f'{len(failed)} of {len(workers)} tokenization workers failed with exit codes {failed}')
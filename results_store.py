@@ -0,0 +1,203 @@
+import argparse
+import csv
+import logging
+import math
+import os
+import sqlite3
+import sys
+import time
+import numpy as np
+from feature_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB = os.path.join('log_csv', 'results.db')
+TABLE = 'results'
+# Columns which were renamed at some point, old name -> current name
+COLUMN_ALIASES = {'Num_Train_Iterations': 'Num_Train_Steps'}
+INDEXED_COLUMNS = ['Experiment_Name', 'Experiment_Id', 'Train_Annot_Dataset', 'Eval_Annot_Dataset', 'Model']
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+def _parse_value(value):
+    """Values read from csv are strings, store numbers as numbers and empty cells as NULL"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if not isinstance(value, str):
+        return value
+    if value == '':
+        return None
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def _column_type(value):
+    return 'REAL' if isinstance(value, (int, float)) and not isinstance(value, bool) else 'TEXT'
+
+
+class ResultsStore():
+    """
+    Experiment results in a SQLite database (WAL mode), one row per evaluated experiment. Every insert is a
+    single transaction which holds the write lock, so concurrent workers never interleave rows. Columns are
+    added on the fly when a row brings new keys, renamed columns are mapped by `COLUMN_ALIASES`.
+    """
+    def __init__(self, db_path=DEFAULT_DB, timeout=60):
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.isdir(db_dir):
+            os.makedirs(db_dir)
+        self.db_path = db_path
+        # autocommit mode, transactions are started explicitly
+        self.conn = sqlite3.connect(db_path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            columns = ', '.join(f'{_quote(c)} TEXT' for c in INDEXED_COLUMNS)
+            self.conn.execute(f'CREATE TABLE IF NOT EXISTS {TABLE} (id INTEGER PRIMARY KEY AUTOINCREMENT, Source TEXT, Inserted_At REAL, {columns})')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS imports (path TEXT, digest TEXT PRIMARY KEY, num_rows INTEGER, imported_at REAL)')
+            for c in INDEXED_COLUMNS:
+                self.conn.execute(f'CREATE INDEX IF NOT EXISTS {_quote("idx_" + c)} ON {TABLE} ({_quote(c)})')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def _transaction(self):
+        return _Transaction(self.conn)
+
+    def columns(self):
+        return [row[1] for row in self.conn.execute(f'PRAGMA table_info({TABLE})')]
+
+    def insert(self, rows, source=None):
+        """Inserts a result dict or a list of result dicts atomically. Returns the number of inserted rows."""
+        if isinstance(rows, dict):
+            rows = [rows]
+        with self._transaction():
+            return self._insert(rows, source)
+
+    def import_csv(self, f_name):
+        """Imports a csv log (e.g. fulltrainlog.csv). Files which were imported before are skipped."""
+        digest = file_digest(f_name)
+        with open(f_name, newline='') as f:
+            rows = list(csv.DictReader(f))
+        with self._transaction():
+            if self.conn.execute('SELECT 1 FROM imports WHERE digest = ?', (digest,)).fetchone() is not None:
+                logger.info(f'{f_name} was already imported')
+                return 0
+            num_rows = self._insert(rows, os.path.basename(f_name))
+            self.conn.execute('INSERT INTO imports VALUES (?, ?, ?, ?)', (f_name, digest, num_rows, time.time()))
+        logger.info(f'Imported {num_rows} rows from {f_name}')
+        return num_rows
+
+    def _insert(self, rows, source):
+        """Inserts rows within an open transaction"""
+        rows = [{COLUMN_ALIASES.get(k, k): _parse_value(v) for k, v in row.items()} for row in rows]
+        inserted_at = time.time()
+        # columns are read while holding the write lock, another worker may just have added some
+        existing = set(self.columns())
+        for row in rows:
+            for k, v in row.items():
+                if k not in existing:
+                    self.conn.execute(f'ALTER TABLE {TABLE} ADD COLUMN {_quote(k)} {_column_type(v)}')
+                    existing.add(k)
+        for row in rows:
+            keys = ['Source', 'Inserted_At'] + list(row.keys())
+            placeholders = ', '.join('?' for _ in keys)
+            self.conn.execute(f'INSERT INTO {TABLE} ({", ".join(_quote(k) for k in keys)}) VALUES ({placeholders})',
+                    [source, inserted_at] + list(row.values()))
+        return len(rows)
+
+    def aggregate(self, group_by=('Experiment_Name',), metrics=('accuracy', 'f1_macro'), where=None, params=()):
+        """Count, mean and (sample) standard deviation of `metrics` per group, computed by SQLite"""
+        columns = set(self.columns())
+        missing = [c for c in list(group_by) + list(metrics) if c not in columns]
+        if missing:
+            raise ValueError(f'Unknown columns {missing}')
+        selects = [_quote(g) for g in group_by] + ['COUNT(*)']
+        for m in metrics:
+            selects += [f'AVG({_quote(m)})', f'AVG({_quote(m)} * {_quote(m)})', f'COUNT({_quote(m)})']
+        query = f'SELECT {", ".join(selects)} FROM {TABLE}'
+        if where:
+            query += f' WHERE {where}'
+        groups = ', '.join(_quote(g) for g in group_by)
+        query += f' GROUP BY {groups} ORDER BY {groups}'
+        results = []
+        for row in self.conn.execute(query, params):
+            result = dict(zip(group_by, row[:len(group_by)]))
+            result['count'] = row[len(group_by)]
+            for i, m in enumerate(metrics):
+                mean, mean_sq, n = row[len(group_by) + 1 + 3 * i:len(group_by) + 4 + 3 * i]
+                result[m + '_mean'] = mean
+                if mean is None or n < 2:
+                    result[m + '_std'] = None
+                else:
+                    result[m + '_std'] = math.sqrt(max(mean_sq - mean * mean, 0) * n / (n - 1))
+            results.append(result)
+        return results
+
+
+class _Transaction():
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on errors"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+
+
+def markdown_table(results, group_by, metrics):
+    """Formats `ResultsStore.aggregate` output as a markdown table (mean ± std in percent)"""
+    def _fmt(mean, std):
+        if mean is None:
+            return '-'
+        if std is None:
+            return f'{100 * mean:.1f}%'
+        return f'{100 * mean:.1f}% ± {100 * std:.1f}'
+    header = list(group_by) + ['Runs'] + list(metrics)
+    lines = ['| ' + ' | '.join(header) + ' |', '| ' + ' | '.join('-------------' for _ in header) + ' |']
+    for r in results:
+        cells = [f'`{r[g]}`' for g in group_by] + [str(r['count'])] + [_fmt(r[m + '_mean'], r[m + '_std']) for m in metrics]
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Experiment results store')
+    parser.add_argument('--db', help='Path to the results database. Default is {}'.format(DEFAULT_DB), default=DEFAULT_DB)
+    subparsers = parser.add_subparsers(dest='command')
+    import_parser = subparsers.add_parser('import', help='Import csv logs')
+    import_parser.add_argument('csv_files', nargs='+')
+    table_parser = subparsers.add_parser('table', help='Print a markdown table of aggregated results')
+    table_parser.add_argument('--group_by', nargs='+', default=['Experiment_Name'])
+    table_parser.add_argument('--metrics', nargs='+', default=['accuracy', 'f1_macro'])
+    table_parser.add_argument('--where', help='Optional SQL condition, e.g. "Model = \'bert_model.ckpt\'"', default=None)
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+    with ResultsStore(args.db) as store:
+        if args.command == 'import':
+            for f_name in args.csv_files:
+                store.import_csv(f_name)
+        elif args.command == 'table':
+            results = store.aggregate(group_by=args.group_by, metrics=args.metrics, where=args.where)
+            print(markdown_table(results, args.group_by, args.metrics))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
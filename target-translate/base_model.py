@@ -1,9 +1,11 @@
-import numpy as np
-import sklearn.metrics
 import os
+import sys
 import joblib
 import pandas as pd
 import json
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from manifest import load_manifest
+from vac_utils import rank_predictions, PredictionRecords, ConfusionMatrix
 
 class BaseModel:
     def __init__(self):
@@ -33,13 +35,16 @@ class BaseModel:
             raise Exception('No label mapping could be found under {}. Either provide a path with a label mapping or call `set_label_mapping` first.'.format(label_mapping_path))
         return label_mapping
 
+    def get_manifest(self, data_path):
+        """`DatasetManifest` of a data file, cached under the other path"""
+        return load_manifest(data_path, manifest_dir=os.path.join(self.other_path, 'manifests'))
+
     def set_label_mapping(self, labels=None):
-        labels = pd.DataFrame()
-        for path in [self.train_data_path, self.dev_data_path, self.test_data_path]:
-            labels = pd.concat([labels, pd.read_csv(path, delimiter='\t', header=None, usecols=[1])])
-        labels = np.unique(labels[1])
+        """Maps `labels` (by default the sorted labels of the train, dev and test data) to ids in the given order"""
+        if labels is None:
+            labels = sorted(set(label for path in [self.train_data_path, self.dev_data_path, self.test_data_path] for label in self.get_manifest(path).labels))
         label_mapping = {}
-        for i, label in enumerate(np.unique(labels)):
+        for i, label in enumerate(labels):
             label_mapping[label] = i
         with open(os.path.join(self.output_path, 'label_mapping.pkl'), 'wb') as f:
             joblib.dump(label_mapping, f)
@@ -55,58 +60,30 @@ class BaseModel:
             result['label'] = list(map(label_mapping.get, labels))
             result['prediction'] = list(map(label_mapping.get, predictions))
         if test_data_path is not None:
-            df_test_data = pd.read_csv(test_data_path, usecols=['text'])
-            result['text'] = df_test_data.pop('text').tolist()
+            df_test_data = pd.read_csv(test_data_path, delimiter='\t', header=None, usecols=[3])
+            result['text'] = df_test_data.pop(3).tolist()
         return result
 
     def format_predictions(self, probabilities, label_mapping=None):
-        results = []
+        """Returns a lazy list with a {'labels': ..., 'probabilities': ...} dict per example. Use `rank_predictions` for the columnar arrays."""
+        return PredictionRecords(self.rank_predictions(probabilities, label_mapping=label_mapping))
+
+    def rank_predictions(self, probabilities, y_true=None, label_mapping=None):
         if label_mapping is not None:
             label_mapping = self.invert_mapping(label_mapping)
-        for i in range(len(probabilities)):
-            sorted_ids = np.argsort(-probabilities[i])
-            if label_mapping is None:
-                labels = sorted_ids
-            else:
-                labels = [label_mapping[s] for s in sorted_ids]
-            results.append({
-                'labels': labels,
-                'probabilities': probabilities[i][sorted_ids]
-                })
-        return results
+        return rank_predictions(probabilities, y_true=y_true, label_mapping=label_mapping)
 
     def performance_metrics(self, y_true, y_pred, metrics=None, averaging=None, label_mapping=None):
-        def _compute_performance_metric(scoring_function, m, y_true, y_pred):
-            for av in averaging:
-                if av is None:
-                    metrics_by_class = scoring_function(y_true, y_pred, average=av, labels=labels)
-                    for i, class_metric in enumerate(metrics_by_class):
-                        if label_mapping is None:
-                            label_name = labels[i]
-                        else:
-                            label_name = label_mapping[labels[i]]
-                        scores[m + '_' + str(label_name)] = class_metric
-                else:
-                    scores[m + '_' + av] = scoring_function(y_true, y_pred, average=av, labels=labels)
-        if averaging is None:
-            averaging = ['micro', 'macro', 'weighted', None]
-        if metrics is None:
-            metrics = ['accuracy', 'precision', 'recall', 'f1']
-        scores = {}
-        labels = sorted(np.unique(y_true))
+        confusion_matrix = ConfusionMatrix().update(y_true, y_pred)
+        return self.confusion_matrix_scores(confusion_matrix, metrics=metrics, averaging=averaging, label_mapping=label_mapping)
+
+    def confusion_matrix_scores(self, confusion_matrix, metrics=None, averaging=None, label_mapping=None, bootstrap_resamples=0):
+        """Scores of an accumulated `ConfusionMatrix`, over the labels which occur as true labels. Optionally with bootstrap confidence intervals."""
+        labels = confusion_matrix.true_labels()
         label_mapping = self.invert_mapping(label_mapping)
-        if len(labels) <= 2:
-            # binary classification
-            averaging += ['binary']
-        for m in metrics:
-            if m == 'accuracy':
-                scores[m] = sklearn.metrics.accuracy_score(y_true, y_pred)
-            elif m == 'precision':
-                _compute_performance_metric(sklearn.metrics.precision_score, m, y_true, y_pred)
-            elif m == 'recall':
-                _compute_performance_metric(sklearn.metrics.recall_score, m, y_true, y_pred)
-            elif m == 'f1':
-                _compute_performance_metric(sklearn.metrics.f1_score, m, y_true, y_pred)
+        scores = confusion_matrix.scores(metrics=metrics, averaging=averaging, labels=labels, label_mapping=label_mapping)
+        if bootstrap_resamples > 0:
+            scores.update(confusion_matrix.bootstrap_intervals(bootstrap_resamples, seed=self.seed, metrics=metrics, averaging=averaging, labels=labels, label_mapping=label_mapping))
         return scores
 
     def dump_model_state(self, output_path):
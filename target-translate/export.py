@@ -0,0 +1,118 @@
+from score import load_model
+from runtime import ExportedClassifier, EXPORT_MODEL_NAME, EXPORT_CONFIG_NAME, VOCAB_NAME
+from feature_cache import file_digest
+from transformers import BertForSequenceClassification, WEIGHTS_NAME
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class LogitsModule(torch.nn.Module):
+    """Positional (input_ids, attention_mask, token_type_ids) -> logits wrapper, the signature of the exported graph"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)[0]
+
+
+def trace_model(model_path, max_seq_length):
+    """Traces the model of `model_path` into a frozen TorchScript module. Batch size and sequence length stay dynamic."""
+    model = BertForSequenceClassification.from_pretrained(model_path, torchscript=True)
+    model.eval()
+    # example inputs of arbitrary shape, the traced graph reads the shape from the inputs
+    input_ids = torch.ones((2, min(16, max_seq_length)), dtype=torch.long)
+    with torch.no_grad():
+        traced = torch.jit.trace(LogitsModule(model), (input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids)))
+    return torch.jit.freeze(traced.eval())
+
+def parity_check(bert, runtime, texts):
+    """Compares tokenization and logits of the exported runtime with the eager model on `texts`"""
+    eager_features = bert.convert_examples_to_features(bert.processor.get_test_examples(texts))
+    runtime_features = runtime.convert_texts_to_features(texts)
+    token_mismatches = int(np.sum(np.any(eager_features.input_ids != runtime_features.input_ids, axis=1)))
+    for _ in range(2):
+        # the second round is timed without warm-up costs
+        eager_seconds, runtime_seconds = [], []
+        eager_logits = bert._predict_logits(eager_features, batch_seconds=eager_seconds)
+        runtime_logits = runtime.predict_logits(eager_features, batch_seconds=runtime_seconds)
+    return {
+            'num_texts': len(texts),
+            'token_mismatches': token_mismatches,
+            'max_abs_logit_diff': float(np.max(np.abs(eager_logits - runtime_logits))) if len(texts) > 0 else 0.0,
+            'prediction_mismatches': int(np.sum(np.argmax(eager_logits, axis=1) != np.argmax(runtime_logits, axis=1))),
+            'eager_latency_ms_mean': 1000 * float(np.mean(eager_seconds)),
+            'runtime_latency_ms_mean': 1000 * float(np.mean(runtime_seconds))
+            }
+
+def export(args):
+    export_path = args.export_path or os.path.join(args.model_path, 'export')
+    if not os.path.isdir(export_path):
+        os.makedirs(export_path)
+    t_start = time.time()
+    bert = load_model(args.model_path, args.batch_size, no_cuda=True)
+    eager_load_seconds = time.time() - t_start
+    logger.info(f'Tracing {args.model_path}...')
+    torch.jit.save(trace_model(args.model_path, bert.max_seq_length), os.path.join(export_path, EXPORT_MODEL_NAME))
+    vocab_file = bert.tokenizer.save_vocabulary(export_path)[0]
+    # the runtime reads the vocab under a fixed name
+    if os.path.abspath(vocab_file) != os.path.abspath(os.path.join(export_path, VOCAB_NAME)):
+        raise Exception(f'The tokenizer saved its vocab as {vocab_file}, the runtime expects {os.path.join(export_path, VOCAB_NAME)}')
+    config = {
+            'labels': [label for label, _ in sorted(bert.label_mapping.items(), key=lambda x: x[1])],
+            'max_seq_length': bert.max_seq_length,
+            'do_lower_case': bert.do_lower_case,
+            'model_type': bert.model_type,
+            'weights_digest': file_digest(os.path.join(args.model_path, WEIGHTS_NAME))
+            }
+    with open(os.path.join(export_path, EXPORT_CONFIG_NAME), 'w') as f:
+        json.dump(config, f, indent=4)
+    t_start = time.time()
+    runtime = ExportedClassifier(export_path, batch_size=args.batch_size)
+    runtime_load_seconds = time.time() - t_start
+    # parity on the dev data the model was evaluated on, or any TSV given with --parity-data
+    parity_data = args.parity_data or bert.dev_data_path
+    texts = [str(t) for t in bert.processor._read_csv(parity_data)[args.text_column].values[:args.num_parity_texts]]
+    parity = parity_check(bert, runtime, texts)
+    parity.update({'eager_load_seconds': eager_load_seconds, 'runtime_load_seconds': runtime_load_seconds})
+    config['parity'] = parity
+    with open(os.path.join(export_path, EXPORT_CONFIG_NAME), 'w') as f:
+        json.dump(config, f, indent=4)
+    logger.info(f'Parity on {parity["num_texts"]} texts of {parity_data}: max logit difference {parity["max_abs_logit_diff"]:.2e}, '
+            f'{parity["token_mismatches"]} tokenization and {parity["prediction_mismatches"]} prediction mismatches. '
+            f'Batch latency {parity["eager_latency_ms_mean"]:.1f} ms (eager) vs {parity["runtime_latency_ms_mean"]:.1f} ms (exported), '
+            f'load time {eager_load_seconds:.2f} s vs {runtime_load_seconds:.2f} s')
+    if parity['max_abs_logit_diff'] > args.tolerance or parity['token_mismatches'] > 0:
+        shutil.rmtree(export_path)
+        raise Exception(f'Exported model does not match the eager model (max logit difference {parity["max_abs_logit_diff"]:.2e}, '
+                f'{parity["token_mismatches"]} tokenization mismatches), the export was removed.')
+    logger.info(f'Exported {args.model_path} to {export_path}')
+    return config
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Exports a trained model to TorchScript for serving with runtime.ExportedClassifier (no transformers needed) and checks that it matches the eager model.')
+    parser.add_argument('--model-path', dest='model_path', required=True, help='Output path of a trained model (containing args.json, label_mapping.pkl and the weights)')
+    parser.add_argument('--export-path', dest='export_path', default=None, help='Directory of the exported model. Default: <model-path>/export')
+    parser.add_argument('--parity-data', dest='parity_data', default=None, help='TSV file with texts for the parity check. Default: the dev data of the model')
+    parser.add_argument('--text-column', dest='text_column', default=3, type=int, help='Text column in the parity TSV file')
+    parser.add_argument('--num-parity-texts', dest='num_parity_texts', default=1000, type=int)
+    parser.add_argument('--tolerance', default=1e-4, type=float, help='Maximum absolute logit difference between the exported and the eager model')
+    parser.add_argument('--batch-size', dest='batch_size', default=32, type=int)
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+    export(args)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from feature_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+
+class FeatureStore():
+    """Tokenized features stored column-wise in contiguous arrays, memory-mapped from disk if a path is given.
+
+    Only the real tokens of each example are meaningful, the rest of each row is zero padding.
+    The attention mask is not stored but derived from `lengths`.
+    """
+    columns = {
+            'input_ids': np.int32,
+            'segment_ids': np.int16,
+            'lengths': np.int16,
+            'label_ids': np.int16
+            }
+    meta_file = 'meta.json'
+
+    def __init__(self, arrays, path=None):
+        self.arrays = arrays
+        self.path = path
+
+    @classmethod
+    def create(cls, num_examples, max_seq_length, path=None, allocate=None):
+        """Allocates a zero-initialized store for `num_examples` examples. In memory, arrays are created by `allocate(shape, dtype)` (default `np.zeros`)."""
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {}
+        for name, dtype in cls.columns.items():
+            shape = (num_examples, max_seq_length) if name in ['input_ids', 'segment_ids'] else (num_examples,)
+            if path is None:
+                arrays[name] = (allocate or np.zeros)(shape, dtype)
+            else:
+                arrays[name] = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode='w+', dtype=dtype, shape=shape)
+        return cls(arrays, path=path)
+
+    @classmethod
+    def open(cls, path):
+        """Opens a previously finalized store read-only. Returns None if there is no complete store under `path`."""
+        if not os.path.isfile(os.path.join(path, cls.meta_file)):
+            return None
+        arrays = {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in cls.columns}
+        return cls(arrays, path=path)
+
+    def __len__(self):
+        return len(self.arrays['lengths'])
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['arrays'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def max_seq_length(self):
+        return self.arrays['input_ids'].shape[1]
+
+    def set(self, index, input_ids, segment_ids, label_id):
+        """Writes a single (unpadded) example to row `index`"""
+        length = len(input_ids)
+        self.arrays['input_ids'][index, :length] = input_ids
+        self.arrays['segment_ids'][index, :length] = segment_ids
+        self.arrays['lengths'][index] = length
+        self.arrays['label_ids'][index] = label_id
+
+    def finalize(self):
+        """Flushes the arrays to disk and marks the store as complete"""
+        if self.path is None:
+            return
+        for array in self.arrays.values():
+            array.flush()
+        with open(os.path.join(self.path, self.meta_file), 'w') as f:
+            json.dump({'num_examples': len(self), 'max_seq_length': self.max_seq_length}, f)
+
+
+class FeatureDataset(Dataset):
+    """Map-style dataset over a `FeatureStore`, equivalent to a `TensorDataset` of (input_ids, input_mask, segment_ids, label_ids).
+
+    Indexing with a list of indices returns a whole batch at once, so it is meant to be used with a
+    batch sampler as sampler and `batch_size=None` in the `DataLoader`. Only the requested rows are read
+    and the batch is trimmed to its longest real sequence. Rows of `extra_columns` (arrays with one row
+    per example, e.g. teacher logits) are returned after the four standard columns.
+    """
+    def __init__(self, store, extra_columns=()):
+        self.store = store
+        self.extra_columns = extra_columns
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, index):
+        index = np.asarray(index)
+        lengths = self.store.lengths[index]
+        max_length = int(lengths.max(initial=1))
+        input_ids = self.store.input_ids[index, :max_length]
+        segment_ids = self.store.segment_ids[index, :max_length]
+        input_mask = np.arange(max_length) < lengths[..., None]
+        return (torch.from_numpy(input_ids.astype(np.int64)),
+                torch.from_numpy(input_mask.astype(np.int64)),
+                torch.from_numpy(segment_ids.astype(np.int64)),
+                torch.from_numpy(np.asarray(self.store.label_ids[index], dtype=np.int64))) + \
+                tuple(torch.from_numpy(np.asarray(column[index])) for column in self.extra_columns)
+
+
+class LengthBucketBatchSampler(Sampler):
+    """Batch sampler which groups examples of similar token length into the same batch.
+
+    With `shuffle`, examples are shuffled and split into chunks of `bucket_size_multiplier` batches.
+    Each chunk is sorted by length and cut into batches, and the batches of all chunks are shuffled again.
+    With a `seed`, the order only depends on the seed and the epoch set by `set_epoch`, so that an
+    interrupted epoch can be resumed at the same batch.
+    Without `shuffle` all examples are sorted by length, use `restore_order` to get the outputs back in the
+    original order.
+    """
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size_multiplier=100, seed=None):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        """Sets the epoch of the shuffled order. The next iteration starts at batch `start_batch`."""
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def __iter__(self):
+        # only the next iteration starts late
+        start_batch, self.start_batch = self.start_batch, 0
+        for i, batch in enumerate(self._batches()):
+            if i >= start_batch:
+                yield batch
+
+    def _batches(self):
+        if self.shuffle:
+            random_state = np.random if self.seed is None else np.random.RandomState(self.seed + self.epoch)
+            ids = random_state.permutation(len(self.lengths))
+            bucket_size = self.batch_size * self.bucket_size_multiplier
+            batches = []
+            for start in range(0, len(ids), bucket_size):
+                bucket = ids[start:start + bucket_size]
+                bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+                batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+            for i in random_state.permutation(len(batches)):
+                yield batches[i].tolist()
+        else:
+            ids = np.argsort(self.lengths, kind='stable')
+            for i in range(0, len(ids), self.batch_size):
+                yield ids[i:i + self.batch_size].tolist()
+
+    def __len__(self):
+        if self.shuffle:
+            bucket_size = self.batch_size * self.bucket_size_multiplier
+            num_full, rest = divmod(len(self.lengths), bucket_size)
+            return num_full * self.bucket_size_multiplier + (rest + self.batch_size - 1) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def order(self):
+        """Order in which examples are yielded (only deterministic without `shuffle`)"""
+        return np.argsort(self.lengths, kind='stable')
+
+
+def restore_order(values, order):
+    """Puts values computed in `order` back into the original example order"""
+    values = np.asarray(values)
+    restored = np.empty_like(values)
+    restored[order] = values
+    return restored
+
+
+def feature_store_key(data_path, *settings, digest=None):
+    """Key of the feature store for a data file, tokenized with the given settings. `digest` is the file's `file_digest` if already known."""
+    h = hashlib.sha1((digest or file_digest(data_path)).encode('utf-8'))
+    for setting in settings:
+        h.update(b'\0')
+        h.update(str(setting).encode('utf-8'))
+    return h.hexdigest()
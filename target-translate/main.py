@@ -1,15 +1,26 @@
 from base_model import BaseModel
+from feature_store import FeatureStore, FeatureDataset, LengthBucketBatchSampler, restore_order, feature_store_key
+from vac_utils import save_predictions, ConfusionMatrix
+from parallel_tokenization import run_sharded, shared_array
+from wordpiece_cache import cache_wordpieces
+from text_dedup import text_hashes, dedup, dedup_stats
+from prediction_cache import PredictionCache, model_fingerprint
+from manifest import load_manifest
+import contextlib
+import copy
 import csv
+import io
 import logging
 import os
 import random
+import re
+import shutil
 import sys
 import numpy as np
 import pandas as pd
 from tqdm import tqdm, trange
 import torch
-from torch.utils.data import DataLoader, TensorDataset
-from torch.utils.data.sampler import RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 import torch.nn.functional
 from transformers.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
@@ -24,6 +35,19 @@ import json
 
 logger = logging.getLogger(__name__)
 
+QUANTIZED_WEIGHTS_NAME = 'pytorch_model_int8.pt'
+CHECKPOINT_DIR = 'checkpoints'
+# label id of unlabeled examples, ignored by the cross entropy loss
+UNLABELED_ID = -100
+
+def is_lower_cased(model_type):
+    """Casing of a model name (e.g. bert-base-uncased) or, for a local model directory (e.g. from pretrain.py), of its saved tokenizer"""
+    tokenizer_config = os.path.join(model_type, 'tokenizer_config.json')
+    if os.path.isfile(tokenizer_config):
+        with open(tokenizer_config) as f:
+            return json.load(f).get('do_lower_case', 'uncased' in model_type)
+    return 'uncased' in model_type
+
 class BERTModel(BaseModel):
     def __init__(self, args):
         super().__init__()
@@ -33,6 +57,8 @@ class BERTModel(BaseModel):
         self.num_train_optimization_steps = None
         # Hyperparams
         self.max_seq_length = args.max_seq_length
+        self.tokenize_workers = args.tokenize_workers
+        self.wordpiece_cache_size = args.wordpiece_cache_size
         self.train_batch_size = args.train_batch_size
         self.eval_batch_size = args.eval_batch_size
         # Initial learning rate for Adam optimizer
@@ -46,13 +72,31 @@ class BERTModel(BaseModel):
         self.seed = args.seed
         # Use 16 bit float precision (instead of 32bit)
         self.fp16 = args.fp16
+        # autocast precision of the forward passes, weights stay fp32
+        self.precision = args.precision
         # Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.
         # 0 (default value): dynamic loss scaling. Positive power of 2: static loss scaling value.
         self.loss_scale = args.loss_scale
         # Meta params
         self.write_test_output = args.write_test_output
+        self.bootstrap_resamples = args.bootstrap_resamples
+        self.prediction_cache_path = args.prediction_cache
+        self.prediction_cache_size = args.prediction_cache_size
+        self.prediction_cache = None
+        self.quantize = args.quantize
+        # distillation
+        self.distill_from = args.distill_from
+        self.student_layers = args.student_layers
+        self.student_hidden_size = args.student_hidden_size
+        self.distill_temperature = args.distill_temperature
+        self.distill_alpha = args.distill_alpha
+        self.unlabeled_data_paths = [p if p.endswith('.tsv') else os.path.join(args.data_path, p, 'train.tsv') for p in args.unlabeled_data]
+        self.teacher = None
         self.output_attentions = args.output_attentions
         self.eval_after_epoch = args.eval_after_epoch
+        self.checkpoint_steps = args.checkpoint_steps
+        self.keep_checkpoints = args.keep_checkpoints
+        self.resume = args.resume
         self.username = args.username
         # model
         self.model_type = args.model_type
@@ -71,8 +115,21 @@ class BERTModel(BaseModel):
             output_path = os.path.join(self.default_output_folder, f"{time.strftime('%Y_%m_%d-%-H_%M_%S')}-{str(uuid.uuid4())[:4]}-{self.username}")
         return output_path
 
+    @classmethod
+    def from_output_path(cls, output_path, **overrides):
+        """Sets up a trained model from its output path for prediction, with the arguments it was trained with. `overrides` replace single arguments."""
+        with open(os.path.join(output_path, 'args.json')) as f:
+            # arguments added after the model was trained keep their defaults
+            args = argparse.Namespace(**{**vars(parse_args([])), **json.load(f), **overrides})
+        args.output_path = output_path
+        model = cls(args)
+        model._setup_bert(setup_mode='predict')
+        return model
+
     def create_dirs(self):
         for _dir in [self.output_path]:
+            if self.resume and os.path.isdir(_dir):
+                continue
             logger.info(f'Creating directory {_dir}')
             os.makedirs(_dir)
 
@@ -108,28 +165,46 @@ class BERTModel(BaseModel):
         # Run training
         global_step = 0
         tr_loss = 0
-        train_features = self.convert_examples_to_features(self.train_examples)
+        start_epoch, start_step, start_epoch_loss = 0, 0, 0
+        checkpoint = self.load_checkpoint() if self.resume else None
+        if checkpoint is not None:
+            global_step, tr_loss = checkpoint['global_step'], checkpoint['tr_loss']
+            start_epoch, start_step, start_epoch_loss = checkpoint['epoch'], checkpoint['step'], checkpoint['epoch_loss']
+        train_features = self.get_features(self.train_data_path, 'train', examples=self.train_examples, extra_data_paths=self.unlabeled_data_paths)
         logger.debug("***** Running training *****")
         logger.debug("  Num examples = %d", len(self.train_examples))
         logger.debug("  Batch size = %d", self.train_batch_size)
         logger.debug("  Num steps = %d", self.num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-        train_sampler = RandomSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=self.train_batch_size)
+        if self.distill_from is not None:
+            logger.info(f'Computing teacher logits of {len(train_features):,} training examples...')
+            train_data = FeatureDataset(train_features, extra_columns=[self.teacher._predict_logits(train_features)])
+        else:
+            train_data = FeatureDataset(train_features)
+        # the shuffled order of an epoch only depends on the seed, so that a resumed epoch continues at the same batch
+        train_sampler = LengthBucketBatchSampler(train_features.lengths, self.train_batch_size, shuffle=True, seed=self.seed)
+        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=None)
         loss_vs_time = []
-        for epoch in range(int(self.num_epochs)):
+        t_start, num_trained = time.time(), 0
+        for epoch in range(start_epoch, int(self.num_epochs)):
             self.model.train()
             nb_tr_examples, nb_tr_steps = 0, 0
-            epoch_loss = 0
-            pbar = tqdm(train_dataloader)
-            for step, batch in enumerate(pbar):
+            first_step = start_step if epoch == start_epoch else 0
+            epoch_loss = start_epoch_loss if epoch == start_epoch else 0
+            train_sampler.set_epoch(epoch, start_batch=first_step)
+            pbar = tqdm(iter(train_dataloader), initial=first_step, total=len(train_sampler))
+            if checkpoint is not None and epoch == start_epoch:
+                # after creating the epoch's iterator (which draws a seed), so that the random state continues exactly where the checkpoint was written
+                self.restore_random_state(checkpoint['random_state'])
+            for step, batch in enumerate(pbar, start=first_step):
                 batch = tuple(t.to(self.device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
-                loss, logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids)
+                with self.autocast():
+                    if self.distill_from is not None:
+                        input_ids, input_mask, segment_ids, label_ids, teacher_logits = batch
+                        logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids)[0]
+                        loss = self.distillation_loss(logits, teacher_logits, label_ids)
+                    else:
+                        input_ids, input_mask, segment_ids, label_ids = batch
+                        loss, logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids)
                 if self.n_gpu > 1:
                     loss = loss.mean() # mean() to average on multi-gpu.
                 if self.gradient_accumulation_steps > 1:
@@ -144,6 +219,7 @@ class BERTModel(BaseModel):
                 if step > 0:
                     pbar.set_description("Loss: {:8.4f} | Average loss/it: {:8.4f}".format(loss, epoch_loss/step))
                 nb_tr_examples += input_ids.size(0)
+                num_trained += input_ids.size(0)
                 nb_tr_steps += 1
                 if (step + 1) % self.gradient_accumulation_steps == 0:
                     # Gradient clipping
@@ -152,19 +228,24 @@ class BERTModel(BaseModel):
                     self.scheduler.step()
                     self.optimizer.zero_grad()
                     global_step += 1
+                    if self.checkpoint_steps > 0 and global_step % self.checkpoint_steps == 0:
+                        self.save_checkpoint({'epoch': epoch, 'step': step + 1, 'global_step': global_step, 'tr_loss': tr_loss, 'epoch_loss': epoch_loss})
             # evaluate model
             if self.eval_after_epoch:
                 self.model.eval()
                 nb_train_steps, nb_train_examples = 0, 0
                 train_accuracy, train_loss = 0, 0
-                for input_ids, input_mask, segment_ids, label_ids in tqdm(train_dataloader, desc="Evaluating"):
-                    input_ids = input_ids.to(self.device)
-                    input_mask = input_mask.to(self.device)
-                    segment_ids = segment_ids.to(self.device)
-                    label_ids = label_ids.to(self.device)
-                    with torch.no_grad():
+                for batch in tqdm(train_dataloader, desc="Evaluating"):
+                    input_ids, input_mask, segment_ids, label_ids = (t.to(self.device) for t in batch[:4])
+                    if self.distill_from is not None:
+                        # only the labeled examples can be evaluated
+                        labeled = label_ids != UNLABELED_ID
+                        if not labeled.any():
+                            continue
+                        input_ids, input_mask, segment_ids, label_ids = input_ids[labeled], input_mask[labeled], segment_ids[labeled], label_ids[labeled]
+                    with torch.no_grad(), self.autocast():
                         loss, logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids)
-                    train_accuracy += self.accuracy(logits.to('cpu').numpy(), label_ids.to('cpu').numpy())
+                    train_accuracy += self.accuracy(logits.float().to('cpu').numpy(), label_ids.to('cpu').numpy())
                     train_loss += loss.mean().item()
                     nb_train_examples += input_ids.size(0)
                     nb_train_steps += 1
@@ -172,6 +253,10 @@ class BERTModel(BaseModel):
                 train_accuracy = 100 * train_accuracy / nb_train_examples
                 print("{bar}\nEpoch {}:\nTraining loss: {:8.4f} | Training accuracy: {:.2f}%\n{bar}".format(epoch+1, train_loss, train_accuracy, bar=80*'='))
 
+        seconds = time.time() - t_start
+        if seconds > 0:
+            logger.info(f'Trained on {num_trained:,} examples in {seconds:.1f} s ({num_trained / seconds:.1f} examples/sec, precision {self.precision})')
+
         # Save model
         model_to_save = self.model.module if hasattr(self.model, 'module') else self.model  # Only save the model it-self
         output_model_file = os.path.join(self.output_path, WEIGHTS_NAME)
@@ -188,76 +273,334 @@ class BERTModel(BaseModel):
         # Setup
         self._setup_bert(setup_mode='test')
         # Run test
-        eval_examples = self.processor.get_dev_examples(self.dev_data_path)
-        eval_features = self.convert_examples_to_features(eval_examples)
+        eval_features = self.get_features(self.dev_data_path, 'dev')
         logger.debug("***** Running evaluation *****")
-        logger.debug("  Num examples = %d", len(eval_examples))
+        logger.debug("  Num examples = %d", len(eval_features))
         logger.debug("  Batch size = %d", self.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=self.eval_batch_size)
+        eval_data = FeatureDataset(eval_features)
+        eval_sampler = LengthBucketBatchSampler(eval_features.lengths, self.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=None)
         self.model.eval()
         eval_loss = 0
         nb_eval_steps = 0
+        confusion_matrix = ConfusionMatrix(len(self.label_mapping))
+        # full outputs are only kept if they are written
         result = {'prediction': [], 'label': [], 'text': []}
+        all_probabilities = []
         for input_ids, input_mask, segment_ids, label_ids in tqdm(eval_dataloader, desc="Evaluating"):
             input_ids = input_ids.to(self.device)
             input_mask = input_mask.to(self.device)
             segment_ids = segment_ids.to(self.device)
             label_ids = label_ids.to(self.device)
-            tmp_eval_loss, logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids)
+            with self.autocast():
+                tmp_eval_loss, logits = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids, labels=label_ids)
+            logits = logits.float()
+            if self.write_test_output:
+                all_probabilities.append(torch.nn.functional.softmax(logits, dim=1).detach().cpu().numpy())
             logits = logits.detach().cpu().numpy()
             label_ids = label_ids.to('cpu').numpy()
-            result['prediction'].extend(np.argmax(logits, axis=1).tolist())
-            result['label'].extend(label_ids.tolist())
+            predictions = np.argmax(logits, axis=1)
+            confusion_matrix.update(label_ids, predictions)
+            if self.write_test_output:
+                result['prediction'].extend(predictions.tolist())
+                result['label'].extend(label_ids.tolist())
             eval_loss += tmp_eval_loss.mean().item()
             nb_eval_steps += 1
         eval_loss = eval_loss / nb_eval_steps
         label_mapping = self.get_label_mapping()
-        result_out = self.performance_metrics(result['label'], result['prediction'], label_mapping=label_mapping)
+        result_out = self.confusion_matrix_scores(confusion_matrix, label_mapping=label_mapping, bootstrap_resamples=self.bootstrap_resamples)
         if self.write_test_output:
+            # batches were sorted by length
+            for key in ['prediction', 'label']:
+                result[key] = restore_order(result[key], eval_sampler.order()).tolist()
             test_output = self.get_full_test_output(result['prediction'], result['label'], label_mapping=label_mapping,
                     test_data_path=self.dev_data_path)
             result_out = {**result_out, **test_output}
+            probabilities = restore_order(np.concatenate(all_probabilities), eval_sampler.order())
+            guid = pd.read_csv(self.dev_data_path, delimiter='\t', header=None, usecols=[0])[0].values
+            save_predictions(os.path.join(self.output_path, 'dev_predictions.npz'), guid, probabilities, y_true=result['label'],
+                    label_mapping=self.invert_mapping(label_mapping), experiment_id=os.path.basename(os.path.normpath(self.output_path)), dataset='dev')
         return result_out
 
+    def save_checkpoint(self, progress):
+        """Saves model, optimizer, scheduler and random state with the training `progress` (epoch, next step, global step, losses).
+        Only the last `keep_checkpoints` checkpoints are kept."""
+        checkpoint_dir = os.path.join(self.output_path, CHECKPOINT_DIR)
+        checkpoint_path = os.path.join(checkpoint_dir, 'checkpoint-{:08d}'.format(progress['global_step']))
+        model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
+        state = {
+                **progress,
+                'model': model_to_save.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict() if hasattr(self, 'scheduler') else None,
+                'random_state': self.get_random_state()
+                }
+        # written to a temporary directory first, an interrupted write never looks like a complete checkpoint
+        tmp_path = checkpoint_path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        torch.save(state, os.path.join(tmp_path, 'state.pt'))
+        shutil.rmtree(checkpoint_path, ignore_errors=True)
+        os.replace(tmp_path, checkpoint_path)
+        logger.info(f'Saved checkpoint {checkpoint_path}')
+        for old_checkpoint in self.list_checkpoints()[:-max(self.keep_checkpoints, 1)]:
+            shutil.rmtree(old_checkpoint)
+
+    def list_checkpoints(self):
+        """Complete checkpoints in order of their global step"""
+        checkpoint_dir = os.path.join(self.output_path, CHECKPOINT_DIR)
+        if not os.path.isdir(checkpoint_dir):
+            return []
+        return [os.path.join(checkpoint_dir, d) for d in sorted(os.listdir(checkpoint_dir)) if re.fullmatch(r'checkpoint-\d+', d)]
+
+    def load_checkpoint(self):
+        """Loads the latest checkpoint into the model, optimizer and scheduler. Returns it, or None if there is none."""
+        checkpoints = self.list_checkpoints()
+        if len(checkpoints) == 0:
+            logger.info(f'No checkpoint found in {self.output_path}, training from scratch')
+            return None
+        checkpoint = torch.load(os.path.join(checkpoints[-1], 'state.pt'), map_location=self.device)
+        model_to_load = self.model.module if hasattr(self.model, 'module') else self.model
+        model_to_load.load_state_dict(checkpoint['model'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if checkpoint['scheduler'] is not None:
+            self.scheduler.load_state_dict(checkpoint['scheduler'])
+        logger.info(f'Resuming from {checkpoints[-1]} at epoch {checkpoint["epoch"] + 1}, step {checkpoint["step"]} (global step {checkpoint["global_step"]})')
+        return checkpoint
+
+    def get_random_state(self):
+        np_state = np.random.get_state()
+        return {
+                'python': random.getstate(),
+                # as plain lists, so that the checkpoint does not need to unpickle numpy objects
+                'numpy': [np_state[0], np_state[1].tolist()] + list(np_state[2:]),
+                'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []
+                }
+
+    def restore_random_state(self, state):
+        random.setstate(state['python'])
+        np.random.set_state((state['numpy'][0], np.array(state['numpy'][1], dtype=np.uint32), *state['numpy'][2:]))
+        torch.set_rng_state(state['torch'].cpu())
+        if torch.cuda.is_available() and len(state['cuda']) > 0:
+            torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
     def save_results(self, results):
         result_path = os.path.join(self.output_path, 'results.json')
         logger.info(f'Writing output results to {result_path}...')
         with open(result_path, 'w') as f:
             json.dump(results, f)
 
-    def predict(self, data):
-        """Predict data (list of strings)"""
+    def predict(self, data, output_file=None):
+        """Predict data (list of strings). Predictions are also written to `output_file` (.npz) if given."""
         # Setup
         self._setup_bert(setup_mode='predict', data=data)
         # Run predict
-        predict_examples = self.processor.get_test_examples(data)
+        probabilities = self.predict_probabilities(data)
+        if output_file is not None:
+            save_predictions(output_file, np.arange(len(probabilities)), probabilities, label_mapping=self.invert_mapping(self.label_mapping),
+                    experiment_id=os.path.basename(os.path.normpath(self.output_path)), dataset='predict')
+        return self.format_predictions(probabilities, label_mapping=self.label_mapping)
+
+    def predict_probabilities(self, texts):
+        """Class probabilities of a list of strings, in batches of `eval_batch_size`. Expects the model to be set up for prediction.
+        Every distinct text (up to whitespace) is only run through the model once, statistics are kept in `dedup_stats`.
+        Texts found in the prediction cache (if enabled) are not run through the model at all."""
+        hashes = text_hashes(texts)
+        unique_index, inverse = dedup(hashes)
+        self.dedup_stats = dedup_stats(len(texts), len(unique_index))
+        unique_hashes = hashes[unique_index]
+        probabilities = np.zeros((len(unique_index), len(self.label_mapping)), dtype=np.float32)
+        if self.prediction_cache is not None:
+            found, cached_probabilities = self.prediction_cache.get(unique_hashes)
+            if found.any():
+                probabilities[found] = cached_probabilities
+            missing = np.flatnonzero(~found)
+        else:
+            missing = np.arange(len(unique_index))
+        if len(missing) > 0:
+            probabilities[missing] = self._predict_texts([texts[i] for i in unique_index[missing]])
+            if self.prediction_cache is not None:
+                self.prediction_cache.put(unique_hashes[missing], probabilities[missing])
+        self.dedup_stats['num_predicted'] = len(missing)
+        # duplicates get the probabilities of their unique text
+        return probabilities[inverse]
+
+    def _predict_texts(self, texts):
+        predict_examples = self.processor.get_test_examples(texts)
         predict_features = self.convert_examples_to_features(predict_examples)
-        all_input_ids = torch.tensor([f.input_ids for f in predict_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in predict_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in predict_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in predict_features], dtype=torch.long)
-        predict_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-        predict_sampler = SequentialSampler(predict_data)
-        predict_dataloader = DataLoader(predict_data, sampler=predict_sampler, batch_size=self.eval_batch_size)
+        return self._predict_features(predict_features)
+
+    def _predict_features(self, predict_features, batch_seconds=None):
+        """Class probabilities of a `FeatureStore`. The duration of every forward pass is appended to `batch_seconds` if given."""
+        logits = self._predict_logits(predict_features, batch_seconds=batch_seconds)
+        return torch.nn.functional.softmax(torch.from_numpy(logits), dim=1).numpy()
+
+    def _predict_logits(self, predict_features, batch_seconds=None):
+        predict_data = FeatureDataset(predict_features)
+        predict_sampler = LengthBucketBatchSampler(predict_features.lengths, self.eval_batch_size)
+        predict_dataloader = DataLoader(predict_data, sampler=predict_sampler, batch_size=None)
         self.model.eval()
-        result = []
-        for input_ids, input_mask, segment_ids, label_ids in predict_dataloader:
-            input_ids = input_ids.to(self.device)
-            input_mask = input_mask.to(self.device)
-            segment_ids = segment_ids.to(self.device)
-            output = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids)
-            logits = output[0]
-            probabilities = torch.nn.functional.softmax(logits, dim=1)
-            probabilities = probabilities.detach().cpu().numpy()
-            res = self.format_predictions(probabilities, label_mapping=self.label_mapping)
-            result.extend(res)
-        return result
+        all_logits = []
+        with torch.no_grad():
+            for input_ids, input_mask, segment_ids, label_ids in predict_dataloader:
+                input_ids = input_ids.to(self.device)
+                input_mask = input_mask.to(self.device)
+                segment_ids = segment_ids.to(self.device)
+                t_start = time.time()
+                with self.autocast():
+                    output = self.model(input_ids, attention_mask=input_mask, token_type_ids=segment_ids)
+                all_logits.append(output[0].float().detach().cpu().numpy())
+                if batch_seconds is not None:
+                    batch_seconds.append(time.time() - t_start)
+        # batches were sorted by length
+        return restore_order(np.concatenate(all_logits), predict_sampler.order())
+
+    def load_quantized_model(self):
+        """Dynamic int8 quantization of the linear layers (CPU only). The quantized weights are cached next to the fp32 weights in `output_path`,
+        a cache hit skips loading the fp32 weights and only quantizes the freshly initialized model to get the structure."""
+        quantized_model_file = os.path.join(self.output_path, QUANTIZED_WEIGHTS_NAME)
+        # the cache is only valid for the fp32 weights it was quantized from
+        weights_stat = os.stat(os.path.join(self.output_path, WEIGHTS_NAME))
+        weights_version = [weights_stat.st_size, weights_stat.st_mtime_ns]
+        if os.path.isfile(quantized_model_file):
+            try:
+                cached = torch.load(quantized_model_file, weights_only=True)
+                if cached['weights_version'] == weights_version:
+                    model = BertForSequenceClassification(BertConfig.from_pretrained(self.output_path))
+                    model.eval()
+                    quantized_model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+                    quantized_model.load_state_dict(cached['state_dict'])
+                    logger.info(f'Loaded int8 quantized model from {quantized_model_file}')
+                    return quantized_model
+            except Exception as e:
+                # e.g. written by a different torch or transformers version
+                logger.warning(f'Ignoring the int8 quantized model cache {quantized_model_file}: {e}')
+        model = BertForSequenceClassification.from_pretrained(self.output_path)
+        quantized_model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        logger.info(f'Writing int8 quantized model to {quantized_model_file}')
+        torch.save({'weights_version': weights_version, 'state_dict': quantized_model.state_dict()}, quantized_model_file + '.tmp')
+        os.replace(quantized_model_file + '.tmp', quantized_model_file)
+        return quantized_model
+
+    def quantization_report(self):
+        """Compares the fp32 and the int8 quantized model on the dev data: scores and their deltas, latency per batch and throughput.
+        The report is written to quantization_report.json in `output_path`."""
+        return self.comparison_report('quantization_report.json', [('fp32', {'quantize': None}), ('int8', {'quantize': 'int8'})])
+
+    def precision_report(self):
+        """Compares fp32 and bf16 autocast inference on the dev data, written to precision_report.json in `output_path`"""
+        return self.comparison_report('precision_report.json', [('fp32', {'precision': 'fp32'}), ('bf16', {'precision': 'bf16'})])
+
+    def comparison_report(self, f_name, variants):
+        """Benchmarks the trained model on the dev data once per variant, a (name, attributes) pair which is set before the model is set up.
+        The scores, latency and throughput of the second variant are compared with the first. The attributes are restored afterwards
+        and the model is set up again with them."""
+        report = {}
+        original = {key: getattr(self, key) for _, attributes in variants for key in attributes}
+        try:
+            for name, attributes in variants:
+                for key, value in attributes.items():
+                    setattr(self, key, value)
+                self._setup_bert(setup_mode='test')
+                report[name] = self.benchmark(self.get_features(self.dev_data_path, 'dev'))
+        finally:
+            for key, value in original.items():
+                setattr(self, key, value)
+        self._setup_bert(setup_mode='test')
+        (base, _), (other, _) = variants
+        report['delta'] = {key: report[other][key] - report[base][key] for key in report[base] if isinstance(report[base][key], float)}
+        report['speedup'] = report[other]['throughput'] / report[base]['throughput']
+        logger.info(f'{other} vs {base}: accuracy {report["delta"].get("accuracy", 0.0):+.4f}, f1_macro {report["delta"].get("f1_macro", 0.0):+.4f}, '
+                f'{report[other]["throughput"]:.1f} vs {report[base]["throughput"]:.1f} examples/sec ({report["speedup"]:.2f}x)')
+        with open(os.path.join(self.output_path, f_name), 'w') as f:
+            json.dump(report, f, indent=4)
+        return report
+
+    def autocast(self):
+        """Context of all forward passes: bf16 autocast with `precision` bf16, no-op otherwise"""
+        if self.precision == 'bf16':
+            return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16)
+        return contextlib.ExitStack()
+
+    def benchmark(self, features):
+        """Scores, batch latency, throughput and size of the current model on `features`, timed after a warm-up pass"""
+        # the first batches include one-off allocation and kernel selection costs
+        self._predict_features(features)
+        batch_seconds = []
+        t_start = time.time()
+        probabilities = self._predict_features(features, batch_seconds=batch_seconds)
+        seconds = time.time() - t_start
+        scores = self.performance_metrics(np.asarray(features.label_ids), np.argmax(probabilities, axis=1), label_mapping=self.label_mapping)
+        return {
+                **scores,
+                'latency_ms_mean': 1000 * float(np.mean(batch_seconds)),
+                'latency_ms_p95': 1000 * float(np.percentile(batch_seconds, 95)),
+                'throughput': len(features) / seconds,
+                'model_size_mb': self.model_size(self.model) / 2**20
+                }
+
+    def load_teacher(self):
+        return BERTModel.from_output_path(self.distill_from, eval_batch_size=self.eval_batch_size, no_cuda=self.no_cuda,
+                tokenize_workers=self.tokenize_workers, prediction_cache=None, quantize=None)
+
+    def build_student(self):
+        """Student with `student_layers` layers of the teacher's architecture. If the hidden size is kept, the student is initialized
+        with the embeddings, classifier and evenly spaced layers of the teacher, otherwise randomly."""
+        teacher_model = self.teacher.model.module if hasattr(self.teacher.model, 'module') else self.teacher.model
+        config = copy.deepcopy(teacher_model.config)
+        config.num_hidden_layers = self.student_layers or config.num_hidden_layers
+        if self.student_hidden_size is not None and self.student_hidden_size != config.hidden_size:
+            config.hidden_size = self.student_hidden_size
+            config.num_attention_heads = max(1, self.student_hidden_size // 64)
+            config.intermediate_size = 4 * self.student_hidden_size
+            if config.hidden_size % config.num_attention_heads != 0:
+                raise ValueError(f'Student hidden size {config.hidden_size} is not a multiple of its {config.num_attention_heads} attention heads')
+            logger.info(f'Initializing student with {config.num_hidden_layers} layers and hidden size {config.hidden_size} randomly')
+            return BertForSequenceClassification(config)
+        layers = np.linspace(0, teacher_model.config.num_hidden_layers - 1, config.num_hidden_layers).round().astype(int)
+        logger.info(f'Initializing student with teacher layers {layers.tolist()}')
+        student = BertForSequenceClassification(config)
+        teacher_state = teacher_model.state_dict()
+        state_dict = {}
+        for name in student.state_dict():
+            match = re.match(r'(.*encoder\.layer\.)(\d+)(\..*)', name)
+            state_dict[name] = teacher_state[name if match is None else f'{match.group(1)}{layers[int(match.group(2))]}{match.group(3)}']
+        student.load_state_dict(state_dict)
+        return student
+
+    def distillation_loss(self, logits, teacher_logits, label_ids):
+        """`distill_alpha` * KL divergence to the teacher's softened distribution (scaled by T^2) + (1 - `distill_alpha`) * cross entropy of the labeled examples"""
+        temperature = self.distill_temperature
+        logits = logits.float()
+        soft_loss = torch.nn.functional.kl_div(torch.nn.functional.log_softmax(logits / temperature, dim=1),
+                torch.nn.functional.softmax(teacher_logits / temperature, dim=1), reduction='batchmean') * temperature ** 2
+        loss = self.distill_alpha * soft_loss
+        labeled = label_ids != UNLABELED_ID
+        if labeled.any():
+            loss = loss + (1 - self.distill_alpha) * torch.nn.functional.cross_entropy(logits[labeled], label_ids[labeled])
+        return loss
+
+    def distillation_report(self):
+        """Scores, latency and throughput of the trained student and its teacher on the dev data, side by side.
+        The report is written to distillation_report.json in `output_path`."""
+        self._setup_bert(setup_mode='test')
+        features = self.get_features(self.dev_data_path, 'dev')
+        report = {'student': self.benchmark(features), 'teacher': self.load_teacher().benchmark(features)}
+        report['delta'] = {key: report['student'][key] - report['teacher'][key] for key in report['student'] if isinstance(report['student'][key], float)}
+        report['speedup'] = report['student']['throughput'] / report['teacher']['throughput']
+        logger.info(f'Student vs teacher: f1_macro {report["student"].get("f1_macro", 0.0):.4f} vs {report["teacher"].get("f1_macro", 0.0):.4f}, '
+                f'{report["student"]["throughput"]:.1f} vs {report["teacher"]["throughput"]:.1f} examples/sec ({report["speedup"]:.2f}x), '
+                f'{report["student"]["model_size_mb"]:.1f} vs {report["teacher"]["model_size_mb"]:.1f} MB')
+        with open(os.path.join(self.output_path, 'distillation_report.json'), 'w') as f:
+            json.dump(report, f, indent=4)
+        return report
+
+    def model_size(self, model):
+        """Size of the serialized state dict in bytes"""
+        buffer = io.BytesIO()
+        torch.save(model.state_dict(), buffer)
+        return buffer.tell()
 
     def fine_tune(self):
         raise NotImplementedError
@@ -274,9 +617,12 @@ class BERTModel(BaseModel):
             self.n_gpu = 0
         if setup_mode == 'train':
             logger.info("Initialize BERT: device: {}, n_gpu: {}, distributed training: {}, 16-bits training: {}".format(self.device, self.n_gpu, False, self.fp16))
+        if self.fp16 and self.precision != 'fp32':
+            raise ValueError('--fp16 and --precision {} cannot be combined'.format(self.precision))
         if self.gradient_accumulation_steps < 1:
             raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(self.gradient_accumulation_steps))
-        self.train_batch_size = self.train_batch_size // self.gradient_accumulation_steps
+        # from the argument, the model may be set up more than once
+        self.train_batch_size = self.all_args['train_batch_size'] // self.gradient_accumulation_steps
 
         # seed
         random.seed(self.seed)
@@ -286,18 +632,26 @@ class BERTModel(BaseModel):
             torch.cuda.manual_seed_all(self.seed)
 
         # label mapping
-        if setup_mode == 'train':
+        if setup_mode == 'train' and self.distill_from is not None:
+            # the student predicts the teacher's labels and uses its tokenizer
+            self.teacher = self.load_teacher()
+            self.model_type = self.all_args['model_type'] = self.teacher.model_type
+            self.label_mapping = self.set_label_mapping(labels=sorted(self.teacher.label_mapping, key=self.teacher.label_mapping.get))
+        elif setup_mode == 'train':
             self.label_mapping = self.set_label_mapping()
         elif setup_mode in ['test', 'predict']:
             self.label_mapping = self.get_label_mapping()
 
         # Build model
-        self.processor = SentimentClassificationProcessor(self.train_data_path, self.label_mapping)
+        self.processor = SentimentClassificationProcessor(self.train_data_path, self.label_mapping, manifest=self.get_manifest)
         num_labels = len(self.label_mapping)
-        self.do_lower_case = 'uncased' in self.model_type
+        self.do_lower_case = is_lower_cased(self.model_type)
         self.tokenizer = BertTokenizer.from_pretrained(self.model_type, do_lower_case=self.do_lower_case)
+        self.wordpiece_cache = cache_wordpieces(self.tokenizer, max_size=self.wordpiece_cache_size)
         if setup_mode == 'train':
             self.train_examples = self.processor.get_train_examples(self.train_data_path)
+            for data_path in self.unlabeled_data_paths:
+                self.train_examples += self.processor.get_unlabeled_examples(data_path)
             self.num_train_optimization_steps = int(len(self.train_examples) / self.train_batch_size / self.gradient_accumulation_steps) * self.num_epochs
 
         # Prepare model
@@ -310,13 +664,25 @@ class BERTModel(BaseModel):
             # else:
             #     logger.info('Loading pretrained model {}...'.format(self.model_type))
             #     self.model = BertForSequenceClassification.from_pretrained(self.model_type, cache_dir=self.model_path, num_labels = num_labels)
-            self.model = BertForSequenceClassification.from_pretrained(self.model_type, cache_dir=self.model_path, num_labels = num_labels)
+            if self.distill_from is not None:
+                self.model = self.build_student()
+            else:
+                self.model = BertForSequenceClassification.from_pretrained(self.model_type, cache_dir=self.model_path, num_labels = num_labels)
             if self.fp16:
                 self.model.half()
         else:
             # Load a trained model and config that you have trained
-            self.model = BertForSequenceClassification.from_pretrained(self.output_path)
+            if self.quantize == 'int8':
+                # quantized kernels only run on CPU
+                self.device = torch.device('cpu')
+                self.n_gpu = 0
+                self.model = self.load_quantized_model()
+            else:
+                self.model = BertForSequenceClassification.from_pretrained(self.output_path)
         self.model.to(self.device)
+        if setup_mode == 'predict' and self.prediction_cache_path is not None and self.prediction_cache is None:
+            fingerprint = model_fingerprint(self.output_path, self.max_seq_length, self.do_lower_case, self.quantize, self.precision)
+            self.prediction_cache = PredictionCache(self.prediction_cache_path, fingerprint, len(self.label_mapping), max_entries=self.prediction_cache_size)
         if self.n_gpu > 1:
             self.model = torch.nn.DataParallel(self.model)
 
@@ -339,75 +705,92 @@ class BERTModel(BaseModel):
         outputs = np.argmax(out, axis=1)
         return np.sum(outputs == labels)
 
-    def convert_examples_to_features(self, examples):
-        """Loads a data file into a list of `InputBatch`s."""
-        features = []
-        for (ex_index, example) in enumerate(examples):
-            tokens_a = self.tokenizer.tokenize(str(example.text_a))
-            tokens_b = None
-            if example.text_b:
-                tokens_b = self.tokenizer.tokenize(str(example.text_b))
-                # Modifies `tokens_a` and `tokens_b` in place so that the total
-                # length is less than the specified length.
-                # Account for [CLS], [SEP], [SEP] with "- 3"
-                self._truncate_seq_pair(tokens_a, tokens_b, self.max_seq_length - 3)
+    def get_features(self, data_path, set_type, examples=None, extra_data_paths=()):
+        """Returns the memory-mapped `FeatureStore` of a data file (followed by the unlabeled examples of `extra_data_paths`).
+        Examples are only read and tokenized if no store exists yet."""
+        key = feature_store_key(data_path, *[self.get_manifest(p).content_hash for p in extra_data_paths], self.model_type, self.do_lower_case, self.max_seq_length, sorted(self.label_mapping.items()),
+                digest=self.get_manifest(data_path).content_hash)
+        store_path = os.path.join(self.other_path, 'features', key)
+        features = FeatureStore.open(store_path)
+        if features is not None:
+            logger.info(f'Loaded {len(features)} tokenized examples of {data_path} from {store_path}')
+            return features
+        if examples is None:
+            if set_type == 'train':
+                examples = self.processor.get_train_examples(data_path)
+                for extra_data_path in extra_data_paths:
+                    examples += self.processor.get_unlabeled_examples(extra_data_path)
             else:
-                # Account for [CLS] and [SEP] with "- 2"
-                if len(tokens_a) > self.max_seq_length - 2:
-                    tokens_a = tokens_a[:(self.max_seq_length - 2)]
-            # The convention in BERT is:
-            # (a) For sequence pairs:
-            #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
-            #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
-            # (b) For single sequences:
-            #  tokens:   [CLS] the dog is hairy . [SEP]
-            #  type_ids: 0   0   0   0  0     0 0
-            #
-            # Where "type_ids" are used to indicate whether this is the first
-            # sequence or the second sequence. The embedding vectors for `type=0` and
-            # `type=1` were learned during pre-training and are added to the wordpiece
-            # embedding vector (and position vector). This is not *strictly* necessary
-            # since the [SEP] token unambigiously separates the sequences, but it makes
-            # it easier for the model to learn the concept of sequences.
-            #
-            # For classification tasks, the first vector (corresponding to [CLS]) is
-            # used as as the "sentence vector". Note that this only makes sense because
-            # the entire model is fine-tuned.
-            tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-            segment_ids = [0] * len(tokens)
-            if tokens_b:
-                tokens += tokens_b + ["[SEP]"]
-                segment_ids += [1] * (len(tokens_b) + 1)
-            input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-            # Zero-pad up to the sequence length.
-            padding = [0] * (self.max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-            assert len(input_ids) == self.max_seq_length
-            assert len(input_mask) == self.max_seq_length
-            assert len(segment_ids) == self.max_seq_length
-            label_id = self.label_mapping[example.label]
-            if ex_index < 5:
-                logger.debug("*** Example ***")
-                logger.debug("guid: %s" % (example.guid))
-                logger.debug("tokens: %s" % " ".join(
-                        [str(x) for x in tokens]))
-                logger.debug("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-                logger.debug("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-                logger.debug(
-                        "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-                logger.debug("label: %s (id = %d)" % (example.label, label_id))
-            features.append(
-                    InputFeatures(input_ids=input_ids,
-                                  input_mask=input_mask,
-                                  segment_ids=segment_ids,
-                                  label_id=label_id))
+                examples = self.processor.get_dev_examples(data_path)
+        return self.convert_examples_to_features(examples, store_path=store_path)
+
+    def convert_examples_to_features(self, examples, store_path=None):
+        """Tokenizes examples into a `FeatureStore`, memory-mapped under `store_path` if given.
+        With `tokenize_workers` > 1, shards of examples are tokenized in forked processes which write into shared arrays."""
+        allocate = shared_array if self.tokenize_workers > 1 else None
+        features = FeatureStore.create(len(examples), self.max_seq_length, path=store_path, allocate=allocate)
+        def _fill(start, end):
+            for ex_index in range(start, end):
+                self._convert_example(features, ex_index, examples[ex_index])
+            if self.wordpiece_cache is not None:
+                self.wordpiece_cache.log_stats()
+        run_sharded(_fill, len(examples), self.tokenize_workers)
+        features.finalize()
         return features
 
+    def _convert_example(self, features, ex_index, example):
+        """Tokenizes a single example into row `ex_index` of `features`"""
+        tokens_a = self.tokenizer.tokenize(str(example.text_a))
+        tokens_b = None
+        if example.text_b:
+            tokens_b = self.tokenizer.tokenize(str(example.text_b))
+            # Modifies `tokens_a` and `tokens_b` in place so that the total
+            # length is less than the specified length.
+            # Account for [CLS], [SEP], [SEP] with "- 3"
+            self._truncate_seq_pair(tokens_a, tokens_b, self.max_seq_length - 3)
+        else:
+            # Account for [CLS] and [SEP] with "- 2"
+            if len(tokens_a) > self.max_seq_length - 2:
+                tokens_a = tokens_a[:(self.max_seq_length - 2)]
+        # The convention in BERT is:
+        # (a) For sequence pairs:
+        #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
+        #  type_ids: 0   0  0    0    0     0       0 0    1  1  1  1   1 1
+        # (b) For single sequences:
+        #  tokens:   [CLS] the dog is hairy . [SEP]
+        #  type_ids: 0   0   0   0  0     0 0
+        #
+        # Where "type_ids" are used to indicate whether this is the first
+        # sequence or the second sequence. The embedding vectors for `type=0` and
+        # `type=1` were learned during pre-training and are added to the wordpiece
+        # embedding vector (and position vector). This is not *strictly* necessary
+        # since the [SEP] token unambigiously separates the sequences, but it makes
+        # it easier for the model to learn the concept of sequences.
+        #
+        # For classification tasks, the first vector (corresponding to [CLS]) is
+        # used as as the "sentence vector". Note that this only makes sense because
+        # the entire model is fine-tuned.
+        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+        segment_ids = [0] * len(tokens)
+        if tokens_b:
+            tokens += tokens_b + ["[SEP]"]
+            segment_ids += [1] * (len(tokens_b) + 1)
+        input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
+        # Rows of the store are zero-padded up to the sequence length. The mask
+        # (1 for real tokens and 0 for padding tokens) is derived from the length.
+        assert len(input_ids) <= self.max_seq_length
+        label_id = UNLABELED_ID if example.label is None else self.label_mapping[example.label]
+        if ex_index < 5:
+            logger.debug("*** Example ***")
+            logger.debug("guid: %s" % (example.guid))
+            logger.debug("tokens: %s" % " ".join(
+                    [str(x) for x in tokens]))
+            logger.debug("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+            logger.debug(
+                    "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+            logger.debug("label: %s (id = %d)" % (example.label, label_id))
+        features.set(ex_index, input_ids, segment_ids, label_id)
+
 class InputExample():
     """A single training/test example for simple sequence classification."""
 
@@ -427,30 +810,23 @@ class InputExample():
         self.text_b = text_b
         self.label = label
 
-class InputFeatures(object):
-    """A single set of features of data."""
-    def __init__(self, input_ids, input_mask, segment_ids, label_id):
-        self.input_ids = input_ids
-        self.input_mask = input_mask
-        self.segment_ids = segment_ids
-        self.label_id = label_id
-
 class SentimentClassificationProcessor():
     """Processor for the sentiment classification data set."""
-    def __init__(self, train_path, labels):
+    def __init__(self, train_path, labels, manifest=load_manifest):
         self.labels = labels
         self.train_path = train_path
+        # returns the `DatasetManifest` of a data file
+        self.manifest = manifest
 
     def _read_csv(self, input_file):
         return pd.read_csv(input_file, delimiter='\t', header=None)
 
     def train_validation_split(self, validation_size=0.1):
-        with open(self.train_path) as f:
-            num_train_examples =  sum(1 for line in f) - 1
-            ids = np.arange(num_train_examples)
-            np.random.shuffle(ids)
-            split_id = int(num_train_examples*validation_size)
-            return ids[:split_id], ids[split_id:]
+        num_train_examples = self.manifest(self.train_path).num_lines - 1
+        ids = np.arange(num_train_examples)
+        np.random.shuffle(ids)
+        split_id = int(num_train_examples*validation_size)
+        return ids[:split_id], ids[split_id:]
 
     def get_train_examples(self, data_path):
         """See base class."""
@@ -460,27 +836,34 @@ class SentimentClassificationProcessor():
         """See base class."""
         return self._create_examples(self._read_csv(data_path), "dev")
 
+    def get_unlabeled_examples(self, data_path):
+        """Examples of a TSV file without labels (text in the 4th column), e.g. for distillation"""
+        return self._create_examples(self._read_csv(data_path), "unlabeled")
+
     def get_test_examples(self, data_path):
-        """See base class."""
+        """See base class. Also accepts a list of strings instead of a path."""
+        if isinstance(data_path, list):
+            return self._create_examples(data_path, "test")
         return self._create_examples(self._read_csv(data_path), "test")
 
     def _create_examples(self, lines, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
         if isinstance(lines, list):
-            lines = pd.DataFrame({'text': lines})
-        for (i, line) in lines.iterrows():
-            guid = "%{}-{}".format(set_type, i)
-            if set_type in ['train', 'dev']:
-                text = line[3]
-                label = line[1]
-            elif set_type == 'test':
-                text = ''
-                label = list(self.labels)[0]
-            else:
-                raise Exception(f'Unknown set type {set_type}')
-            examples.append(InputExample(guid=guid, text_a=text, text_b=None, label=label))
-        return examples
+            # a list of texts, placed in the text column of the TSV files
+            lines = pd.DataFrame({3: lines})
+        # whole columns instead of row by row
+        if set_type in ['train', 'dev']:
+            texts = lines[3].tolist()
+            labels = lines[1].tolist()
+        elif set_type == 'test':
+            texts = lines[3].tolist()
+            labels = [list(self.labels)[0]] * len(lines)
+        elif set_type == 'unlabeled':
+            texts = lines[3].tolist()
+            labels = [None] * len(lines)
+        else:
+            raise Exception(f'Unknown set type {set_type}')
+        return [InputExample(guid="%{}-{}".format(set_type, i), text_a=text, text_b=None, label=label) for i, text, label in zip(lines.index.tolist(), texts, labels)]
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Target translate method')
@@ -495,6 +878,8 @@ def parse_args(args):
     parser.add_argument('--gradient-accumulation-steps', dest='gradient_accumulation_steps', default=1, type=int)
     parser.add_argument('--comment', help='Optional. Add a Comment to the logfile for internal reference.', default='No Comment')
     parser.add_argument('--max-seq-length', dest='max_seq_length', default=128, type=int)
+    parser.add_argument('--wordpiece-cache-size', dest='wordpiece_cache_size', default=100000, type=int, help='Number of tokens in the wordpiece LRU cache, 0 disables it')
+    parser.add_argument('--tokenize-workers', dest='tokenize_workers', default=1, type=int, help='Number of processes used for tokenization')
     parser.add_argument('--train-batch-size', dest='train_batch_size', default=32, type=int)
     parser.add_argument('--eval-batch-size', dest='eval_batch_size', default=32, type=int)
     parser.add_argument('--lr', dest='learning_rate', default=5e-5, type=float)
@@ -503,11 +888,27 @@ def parse_args(args):
     parser.add_argument('--seed', default=42, type=int)
     parser.add_argument('--fp16', action='store_true', help='Use 16 bit float precision', default=False)
     parser.add_argument('--loss-scale', dest='loss_scale', type=int, default=0, help='Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.')
-    parser.add_argument('--write-test-output', dest='write_test_output', action='store_true', default=False, help='Writes full test output predictions to csv')
+    parser.add_argument('--precision', choices=['fp32', 'bf16'], default='fp32', help='Precision of the forward passes in train, test and predict. bf16 uses autocast (also on CPU) with fp32 weights.')
+    parser.add_argument('--precision-report', dest='precision_report', action='store_true', default=False, help='Compares bf16 with fp32 inference of the model in --output-path on the dev data and exits (no training)')
+    parser.add_argument('--prediction-cache', dest='prediction_cache', default=None, help='SQLite file caching predictions across runs, keyed by model and text. Disabled by default.')
+    parser.add_argument('--prediction-cache-size', dest='prediction_cache_size', default=10000000, type=int, help='Maximum number of cached predictions, the least recently used ones are evicted')
+    parser.add_argument('--quantize', choices=['int8'], default=None, help='Inference with dynamic int8 quantization of the linear layers (CPU only). The quantized model is cached in the output path.')
+    parser.add_argument('--quantize-report', dest='quantize_report', action='store_true', default=False, help='Compares the int8 quantized with the fp32 model in --output-path on the dev data and exits (no training)')
+    parser.add_argument('--distill-from', dest='distill_from', default=None, help='Output path of a trained teacher model. Trains a smaller student on the soft labels of the teacher instead of fine-tuning --model-type.')
+    parser.add_argument('--student-layers', dest='student_layers', default=None, type=int, help='Number of layers of the student. Default: as many as the teacher')
+    parser.add_argument('--student-hidden-size', dest='student_hidden_size', default=None, type=int, help='Hidden size of the student. Default: the teacher\'s (the student is then initialized from the teacher\'s layers)')
+    parser.add_argument('--distill-temperature', dest='distill_temperature', default=2.0, type=float, help='Softmax temperature of teacher and student')
+    parser.add_argument('--distill-alpha', dest='distill_alpha', default=0.5, type=float, help='Weight of the soft teacher loss, the labeled examples get 1 - alpha of the cross entropy loss')
+    parser.add_argument('--unlabeled-data', dest='unlabeled_data', nargs='*', default=[], help='Data folders (train.tsv is used) or TSV files with unlabeled text for distillation, e.g. cb-en-sample')
+    parser.add_argument('--checkpoint-steps', dest='checkpoint_steps', default=0, type=int, help='Saves a checkpoint (model, optimizer, scheduler, random state) every n optimization steps. 0 disables checkpoints.')
+    parser.add_argument('--keep-checkpoints', dest='keep_checkpoints', default=2, type=int, help='Number of most recent checkpoints kept')
+    parser.add_argument('--resume', action='store_true', default=False, help='Continues training from the latest checkpoint in --output-path')
+    parser.add_argument('--write-test-output', dest='write_test_output', action='store_true', default=False, help='Writes full test output predictions to the results and to dev_predictions.npz')
+    parser.add_argument('--bootstrap-resamples', dest='bootstrap_resamples', default=1000, type=int, help='Number of bootstrap resamples for the confidence intervals of the scores, 0 disables them')
     parser.add_argument('--output-attentions', dest='output_attentions', action='store_true', default=False, help='Returns attentions')
     parser.add_argument('--eval-after-epoch', dest='eval_after_epoch', action='store_true', default=False, help='Evaluate after every epoch')
     parser.add_argument('--model-type', dest='model_type', default='bert-base-uncased', help='Model type')
-    args = parser.parse_args()
+    args = parser.parse_args(args)
     return args
 
 def main(args):
@@ -516,9 +917,17 @@ def main(args):
 
     # Run experiments
     bert = BERTModel(args)
+    if args.quantize_report:
+        bert.quantization_report()
+        return
+    if args.precision_report:
+        bert.precision_report()
+        return
     bert.train()
     results = bert.test()
     bert.save_results(results)
+    if args.distill_from is not None:
+        bert.distillation_report()
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+LABEL_COLUMN = 1
+
+
+class DatasetManifest():
+    """
+    Summary of a TSV data file: number of lines and rows, label vocabulary and counts, sha1 of the content (the same as
+    `feature_cache.file_digest`) and the byte offset of every line. Built with one scan of the file and reused as long as
+    the file's size and modification time are unchanged, see `load_manifest`.
+    """
+    def __init__(self, data_path, manifest, offsets_path):
+        self.data_path = data_path
+        self.manifest = manifest
+        self.offsets_path = offsets_path
+        self._offsets = None
+
+    @property
+    def num_lines(self):
+        return self.manifest['num_lines']
+
+    @property
+    def num_rows(self):
+        """Number of rows as read by pandas (blank lines are skipped)"""
+        return self.manifest['num_rows']
+
+    @property
+    def labels(self):
+        """Sorted unique labels, with the types pandas reads them as"""
+        return self.manifest['labels']
+
+    @property
+    def label_counts(self):
+        return dict(zip(self.manifest['labels'], self.manifest['label_counts']))
+
+    @property
+    def content_hash(self):
+        return self.manifest['content_hash']
+
+    @property
+    def offsets(self):
+        """Byte offsets of the line starts, followed by the file size (memory-mapped)"""
+        if self._offsets is None:
+            self._offsets = np.load(self.offsets_path, mmap_mode='r')
+        return self._offsets
+
+    def read_lines(self, indices):
+        """Reads single lines by index without scanning the file"""
+        lines = []
+        with open(self.data_path, 'rb') as f:
+            for i in indices:
+                f.seek(int(self.offsets[i]))
+                lines.append(f.read(int(self.offsets[i + 1] - self.offsets[i])).decode('utf-8').rstrip('\r\n'))
+        return lines
+
+
+def _manifest_paths(data_path, manifest_dir):
+    if manifest_dir is None:
+        prefix = data_path
+    else:
+        path_hash = hashlib.sha1(os.path.abspath(data_path).encode('utf-8')).hexdigest()[:12]
+        prefix = os.path.join(manifest_dir, '{}-{}'.format(os.path.basename(data_path), path_hash))
+    return prefix + '.manifest.json', prefix + '.offsets.npy'
+
+def _write_atomic(path, write):
+    """Writes to a unique temporary file next to `path` and moves it into place, so that neither concurrent readers
+    nor a concurrent build of the same manifest ever see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def build_manifest(data_path, label_column=LABEL_COLUMN):
+    """Scans a TSV file once for its hash and line offsets, labels are read with pandas so their types match the examples"""
+    h = hashlib.sha1()
+    offsets = [0]
+    with open(data_path, 'rb') as f:
+        for line in f:
+            h.update(line)
+            offsets.append(offsets[-1] + len(line))
+    labels = pd.read_csv(data_path, delimiter='\t', header=None, usecols=[label_column])[label_column]
+    label_counts = labels.value_counts().sort_index()
+    manifest = {
+            'version': MANIFEST_VERSION,
+            'num_lines': len(offsets) - 1,
+            'num_rows': len(labels),
+            'labels': [label.item() if isinstance(label, np.generic) else label for label in label_counts.index],
+            'label_counts': [int(c) for c in label_counts.values],
+            'content_hash': h.hexdigest()
+            }
+    return manifest, np.array(offsets, dtype=np.int64)
+
+def load_manifest(data_path, manifest_dir=None, label_column=LABEL_COLUMN):
+    """Returns the `DatasetManifest` of a TSV file, stored next to it (or in `manifest_dir`) and rebuilt when the file changed"""
+    manifest_path, offsets_path = _manifest_paths(data_path, manifest_dir)
+    stat = os.stat(data_path)
+    if os.path.isfile(manifest_path) and os.path.isfile(offsets_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') == MANIFEST_VERSION and manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns \
+                and manifest['label_column'] == label_column:
+            return DatasetManifest(data_path, manifest, offsets_path)
+    logger.info(f'Building manifest of {data_path}')
+    manifest, offsets = build_manifest(data_path, label_column=label_column)
+    manifest.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'label_column': label_column})
+    if manifest_dir is not None and not os.path.isdir(manifest_dir):
+        os.makedirs(manifest_dir, exist_ok=True)
+    _write_atomic(offsets_path, lambda f: np.save(f, offsets))
+    _write_atomic(manifest_path, lambda f: f.write(json.dumps(manifest, indent=4).encode('utf-8')))
+    return DatasetManifest(data_path, manifest, offsets_path)
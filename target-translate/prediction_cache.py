@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import numpy as np
+from feature_cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of parameters of a single statement
+_MAX_PARAMS = 500
+
+
+def model_fingerprint(output_path, *settings):
+    """Hash of the saved model files in `output_path` (weights, config, label mapping) and settings which change predictions"""
+    h = hashlib.sha1()
+    for f_name in sorted(os.listdir(output_path)):
+        if f_name.endswith(('.bin', '.safetensors')) or f_name in ['config.json', 'label_mapping.pkl']:
+            h.update(f_name.encode('utf-8'))
+            h.update(file_digest(os.path.join(output_path, f_name)).encode('utf-8'))
+    for setting in settings:
+        h.update(b'\0')
+        h.update(str(setting).encode('utf-8'))
+    return h.hexdigest()
+
+
+class PredictionCache():
+    """
+    Disk-backed cache of class probabilities over `num_labels` classes, keyed by model fingerprint and text hash (see `text_dedup.text_hashes`).
+    The cache holds at most `max_entries` predictions of all models together, the least recently used ones are evicted.
+    """
+    def __init__(self, path, fingerprint, num_labels, max_entries=10000000, timeout=60):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.num_labels = num_labels
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # rows deleted by INSERT OR REPLACE fire the delete trigger only with recursive triggers
+        self.conn.execute('PRAGMA recursive_triggers=ON')
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS predictions (model TEXT, text_hash BLOB, probabilities BLOB, last_used REAL, UNIQUE (model, text_hash))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON predictions (last_used)')
+            # running number of entries of all models, kept up to date by triggers in the writing transaction
+            self.conn.execute('CREATE TABLE IF NOT EXISTS num_entries (n INTEGER)')
+            self.conn.execute('INSERT INTO num_entries SELECT COUNT(*) FROM predictions WHERE NOT EXISTS (SELECT 1 FROM num_entries)')
+            self.conn.execute('CREATE TRIGGER IF NOT EXISTS count_insert AFTER INSERT ON predictions BEGIN UPDATE num_entries SET n = n + 1; END')
+            self.conn.execute('CREATE TRIGGER IF NOT EXISTS count_delete AFTER DELETE ON predictions BEGIN UPDATE num_entries SET n = n - 1; END')
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, text_hashes):
+        """Returns (found, probabilities): a boolean mask over `text_hashes` and the cached probabilities of the found ones, shape (found.sum(), num_labels)"""
+        text_hashes = [bytes(h) for h in text_hashes]
+        cached = {}
+        for start in range(0, len(text_hashes), _MAX_PARAMS):
+            chunk = text_hashes[start:start + _MAX_PARAMS]
+            rows = self.conn.execute('SELECT text_hash, probabilities FROM predictions WHERE model = ? AND text_hash IN ({})'.format(', '.join('?' for _ in chunk)),
+                    [self.fingerprint] + chunk).fetchall()
+            cached.update(rows)
+        found = np.array([h in cached for h in text_hashes], dtype=bool)
+        probabilities = np.array([np.frombuffer(cached[h], dtype=np.float32) for h in text_hashes if h in cached], dtype=np.float32).reshape(-1, self.num_labels)
+        if len(cached) > 0:
+            now = time.time()
+            with self.conn:
+                self.conn.executemany('UPDATE predictions SET last_used = ? WHERE model = ? AND text_hash = ?',
+                        [(now, self.fingerprint, h) for h in cached])
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+        return found, probabilities
+
+    def put(self, text_hashes, probabilities):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                    [(self.fingerprint, bytes(h), np.asarray(p, dtype=np.float32).tobytes(), now) for h, p in zip(text_hashes, probabilities)])
+            self._evict()
+
+    def _evict(self):
+        num_entries = self.conn.execute('SELECT n FROM num_entries').fetchone()[0]
+        if num_entries > self.max_entries:
+            self.conn.execute('DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY last_used LIMIT ?)',
+                    (num_entries - self.max_entries,))
+            logger.info(f'Evicted {num_entries - self.max_entries:,} least recently used predictions from {self.path}')
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0.0
+        logger.info(f'Prediction cache: {hit_rate:.1%} hit rate ({self.hits:,} hits, {self.misses:,} misses)')
@@ -0,0 +1,237 @@
+from main import is_lower_cased
+from wordpiece_cache import cache_wordpieces
+import argparse
+import glob
+import json
+import logging
+import os
+import random
+import sys
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from tqdm import tqdm
+from transformers import BertForPreTraining, BertTokenizer, AdamW, get_linear_schedule_with_warmup
+
+logger = logging.getLogger(__name__)
+
+TF_CHECKPOINT_DIR = 'tf'
+# label id of tokens without a masked LM loss
+IGNORE_ID = -100
+
+
+class StreamingTextDataset(IterableDataset):
+    """
+    Streams texts from sharded files, tokenized on the fly, so that the corpus is never loaded as a whole. Files are
+    plain text (one text per line), TSV (text in `text_column`) or JSONL (text in `text_field`). Shards are split
+    between DataLoader workers, their order changes with every epoch (see `set_epoch`) and texts are shuffled within
+    a buffer of `shuffle_buffer_size` texts. Yields the token ids of [CLS] text [SEP], truncated to `max_seq_length`.
+    """
+    def __init__(self, files, tokenizer, max_seq_length, shuffle_buffer_size=10000, seed=42, text_column=3, text_field='text'):
+        self.files = sorted(files)
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.text_column = text_column
+        self.text_field = text_field
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _read(self, f_name):
+        with open(f_name, encoding='utf-8') as f:
+            for line in f:
+                line = line.rstrip('\r\n')
+                if not line.strip():
+                    continue
+                if f_name.endswith('.tsv'):
+                    fields = line.split('\t')
+                    if len(fields) <= self.text_column:
+                        continue
+                    yield fields[self.text_column]
+                elif f_name.endswith('.jsonl'):
+                    try:
+                        yield json.loads(line)[self.text_field]
+                    except (ValueError, KeyError):
+                        continue
+                else:
+                    yield line
+
+    def _texts(self, worker_id, num_workers):
+        files = list(self.files)
+        # the same shard order in all workers, so that every shard is read by exactly one worker
+        random.Random(self.seed + self.epoch).shuffle(files)
+        if len(files) >= num_workers:
+            # every worker reads its own shards
+            for f_name in files[worker_id::num_workers]:
+                yield from self._read(f_name)
+        else:
+            # fewer shards than workers, every worker reads every n-th line
+            line_nr = 0
+            for f_name in files:
+                for text in self._read(f_name):
+                    if line_nr % num_workers == worker_id:
+                        yield text
+                    line_nr += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        random_state = random.Random(self.seed + 1000 * self.epoch + worker_id)
+        buffer = []
+        for text in self._texts(worker_id, num_workers):
+            buffer.append(text)
+            if len(buffer) >= self.shuffle_buffer_size:
+                # replace a random text of the full buffer
+                i = random_state.randrange(len(buffer))
+                buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                yield self._convert(buffer.pop())
+        random_state.shuffle(buffer)
+        for text in buffer:
+            yield self._convert(text)
+
+    def _convert(self, text):
+        tokens = self.tokenizer.tokenize(text)[:self.max_seq_length - 2]
+        return self.tokenizer.convert_tokens_to_ids(['[CLS]'] + tokens + ['[SEP]'])
+
+
+class MaskingCollator():
+    """Pads a batch of token ids and masks `mlm_probability` of the real tokens: 80% become [MASK], 10% a random token, 10% stay"""
+    def __init__(self, tokenizer, mlm_probability=0.15):
+        self.mlm_probability = mlm_probability
+        self.mask_id = tokenizer.convert_tokens_to_ids(['[MASK]'])[0]
+        self.pad_id = tokenizer.convert_tokens_to_ids(['[PAD]'])[0]
+        self.special_ids = torch.tensor(tokenizer.convert_tokens_to_ids(['[CLS]', '[SEP]', '[PAD]']))
+        self.vocab_size = len(tokenizer.vocab)
+
+    def __call__(self, examples):
+        lengths = torch.tensor([len(e) for e in examples])
+        input_ids = torch.full((len(examples), int(lengths.max())), self.pad_id, dtype=torch.long)
+        for i, example in enumerate(examples):
+            input_ids[i, :len(example)] = torch.tensor(example)
+        attention_mask = (torch.arange(input_ids.size(1)) < lengths[:, None]).long()
+        labels = input_ids.clone()
+        probabilities = torch.full(input_ids.shape, self.mlm_probability)
+        probabilities[torch.isin(input_ids, self.special_ids)] = 0.0
+        masked = torch.bernoulli(probabilities).bool()
+        labels[~masked] = IGNORE_ID
+        replaced = torch.bernoulli(torch.full(input_ids.shape, 0.8)).bool() & masked
+        input_ids[replaced] = self.mask_id
+        randomized = torch.bernoulli(torch.full(input_ids.shape, 0.5)).bool() & masked & ~replaced
+        input_ids[randomized] = torch.randint(self.vocab_size, input_ids.shape)[randomized]
+        return input_ids, attention_mask, torch.zeros_like(input_ids), labels
+
+
+def save_model(model, tokenizer, output_path, tf_checkpoint=False):
+    """Saves the model and vocab for `--model-type` of target-translate and, with `tf_checkpoint`, as bert_config.json,
+    vocab.txt and bert_model.ckpt for `--bert_model_dir` of Multilingual_Experiments.py (needs tensorflow)"""
+    model.save_pretrained(output_path)
+    tokenizer.save_pretrained(output_path)
+    if tf_checkpoint:
+        from transformers.models.bert.convert_bert_pytorch_checkpoint_to_original_tf import convert_pytorch_checkpoint_to_tf
+        tf_path = os.path.join(output_path, TF_CHECKPOINT_DIR)
+        # the encoder and pooler, the pretraining heads are not needed for fine-tuning
+        convert_pytorch_checkpoint_to_tf(model=model.bert, ckpt_dir=tf_path, model_name='bert_model')
+        config = model.config
+        bert_config = {key: getattr(config, key) for key in ['attention_probs_dropout_prob', 'hidden_act', 'hidden_dropout_prob', 'hidden_size',
+                'initializer_range', 'intermediate_size', 'max_position_embeddings', 'num_attention_heads', 'num_hidden_layers', 'type_vocab_size', 'vocab_size']}
+        with open(os.path.join(tf_path, 'bert_config.json'), 'w') as f:
+            json.dump(bert_config, f, indent=2)
+        tokenizer.save_vocabulary(tf_path)
+    logger.info(f'Saved model to {output_path}')
+
+def pretrain(args):
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    files = sorted(set(f for pattern in args.input for f in glob.glob(pattern)))
+    if len(files) == 0:
+        raise Exception(f'No input files match {args.input}')
+    logger.info(f'Pretraining {args.model_type} on {len(files)} files for {args.max_steps} steps')
+    if not os.path.isdir(args.output_path):
+        os.makedirs(args.output_path)
+    tokenizer = BertTokenizer.from_pretrained(args.model_type, do_lower_case=is_lower_cased(args.model_type))
+    cache_wordpieces(tokenizer, max_size=args.wordpiece_cache_size)
+    # keeps the pooler of the base model, which initializes the classifier input when fine-tuning
+    model = BertForPreTraining.from_pretrained(args.model_type, cache_dir=args.cache_dir)
+    model.to(device)
+    dataset = StreamingTextDataset(files, tokenizer, args.max_seq_length, shuffle_buffer_size=args.shuffle_buffer_size, seed=args.seed,
+            text_column=args.text_column, text_field=args.text_field)
+    dataloader = DataLoader(dataset, batch_size=args.train_batch_size, collate_fn=MaskingCollator(tokenizer, args.mlm_probability), num_workers=args.num_workers)
+    no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
+        {'params': [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+        ]
+    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    scheduler = get_linear_schedule_with_warmup(optimizer, num_warmup_steps=args.warmup_steps, num_training_steps=args.max_steps)
+    model.train()
+    global_step, epoch, num_tokens = 0, 0, 0
+    t_start = time.time()
+    pbar = tqdm(total=args.max_steps)
+    while global_step < args.max_steps:
+        dataset.set_epoch(epoch)
+        num_batches = 0
+        for input_ids, attention_mask, segment_ids, labels in dataloader:
+            input_ids, attention_mask, segment_ids, labels = (t.to(device) for t in (input_ids, attention_mask, segment_ids, labels))
+            output = model(input_ids, attention_mask=attention_mask, token_type_ids=segment_ids)
+            prediction_scores = output[0]
+            loss = torch.nn.functional.cross_entropy(prediction_scores.view(-1, prediction_scores.size(-1)), labels.view(-1), ignore_index=IGNORE_ID)
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            global_step += 1
+            num_batches += 1
+            num_tokens += int(attention_mask.sum())
+            pbar.update(1)
+            pbar.set_description("Epoch {} | MLM loss: {:8.4f}".format(epoch + 1, loss.item()))
+            if args.save_steps > 0 and global_step % args.save_steps == 0:
+                save_model(model, tokenizer, args.output_path)
+            if global_step >= args.max_steps:
+                break
+        if num_batches == 0:
+            raise Exception(f'No texts in {args.input}')
+        epoch += 1
+    pbar.close()
+    seconds = time.time() - t_start
+    logger.info(f'Pretrained {global_step} steps ({epoch} epochs over the corpus) in {seconds:.1f} s, {num_tokens / seconds:.1f} tokens/sec')
+    save_model(model, tokenizer, args.output_path, tf_checkpoint=args.tf_checkpoint)
+    with open(os.path.join(args.output_path, 'pretrain_args.json'), 'w') as f:
+        json.dump(vars(args), f)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Domain-adaptive masked LM pretraining on sharded text files. The output path can be used as --model-type of main.py and (with --tf-checkpoint) its tf/ directory as --bert_model_dir of Multilingual_Experiments.py.')
+    parser.add_argument('--input', nargs='+', required=True, help='Text files or glob patterns of shards (.txt: one text per line, .tsv, .jsonl)')
+    parser.add_argument('--output-path', dest='output_path', required=True)
+    parser.add_argument('--model-type', dest='model_type', default='bert-base-multilingual-cased', help='Model the pretraining starts from')
+    parser.add_argument('--cache-dir', dest='cache_dir', default=os.path.join('other', 'bert'), help='Download cache of pretrained models')
+    parser.add_argument('--max-steps', dest='max_steps', default=100000, type=int, help='Number of optimization steps, the corpus is repeated as often as needed')
+    parser.add_argument('--max-seq-length', dest='max_seq_length', default=128, type=int)
+    parser.add_argument('--train-batch-size', dest='train_batch_size', default=32, type=int)
+    parser.add_argument('--lr', dest='learning_rate', default=5e-5, type=float)
+    parser.add_argument('--warmup-steps', dest='warmup_steps', default=1000, type=int)
+    parser.add_argument('--mlm-probability', dest='mlm_probability', default=0.15, type=float, help='Fraction of tokens which are masked')
+    parser.add_argument('--shuffle-buffer-size', dest='shuffle_buffer_size', default=10000, type=int, help='Number of texts shuffled in memory')
+    parser.add_argument('--text-column', dest='text_column', default=3, type=int, help='Text column in TSV files')
+    parser.add_argument('--text-field', dest='text_field', default='text', help='Text key in JSONL files')
+    parser.add_argument('--num-workers', dest='num_workers', default=0, type=int, help='Number of DataLoader processes reading and tokenizing shards')
+    parser.add_argument('--wordpiece-cache-size', dest='wordpiece_cache_size', default=100000, type=int, help='Number of tokens in the wordpiece LRU cache, 0 disables it')
+    parser.add_argument('--save-steps', dest='save_steps', default=10000, type=int, help='Saves the model every n steps, 0 only saves at the end')
+    parser.add_argument('--tf-checkpoint', dest='tf_checkpoint', action='store_true', default=False, help='Also writes a TensorFlow checkpoint to <output-path>/tf (needs tensorflow)')
+    parser.add_argument('--no-cuda', dest='no_cuda', action='store_true', default=False)
+    parser.add_argument('--seed', default=42, type=int)
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+    pretrain(args)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
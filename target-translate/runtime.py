@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import re
+import sys
+import time
+import unicodedata
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from feature_store import FeatureStore, FeatureDataset, LengthBucketBatchSampler, restore_order
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from vac_utils import rank_predictions, PredictionRecords
+from wordpiece_cache import cache_wordpieces
+from text_dedup import dedup_texts, dedup_stats
+
+logger = logging.getLogger(__name__)
+
+EXPORT_MODEL_NAME = 'model.pt'
+EXPORT_CONFIG_NAME = 'export.json'
+VOCAB_NAME = 'vocab.txt'
+SPECIAL_TOKENS = ['[UNK]', '[SEP]', '[PAD]', '[CLS]', '[MASK]']
+
+
+def load_vocab(vocab_file):
+    with open(vocab_file, encoding='utf-8') as f:
+        return {token.rstrip('\n'): i for i, token in enumerate(f)}
+
+def _is_whitespace(char):
+    if char in [' ', '\t', '\n', '\r']:
+        return True
+    return unicodedata.category(char) == 'Zs'
+
+def _is_control(char):
+    if char in ['\t', '\n', '\r']:
+        return False
+    return unicodedata.category(char).startswith('C')
+
+def _is_punctuation(char):
+    cp = ord(char)
+    # all non-letter/number ASCII characters are treated as punctuation, like in BERT
+    if 33 <= cp <= 47 or 58 <= cp <= 64 or 91 <= cp <= 96 or 123 <= cp <= 126:
+        return True
+    return unicodedata.category(char).startswith('P')
+
+def _is_chinese_char(cp):
+    return (0x4E00 <= cp <= 0x9FFF or 0x3400 <= cp <= 0x4DBF or 0x20000 <= cp <= 0x2A6DF or 0x2A700 <= cp <= 0x2B73F
+            or 0x2B740 <= cp <= 0x2B81F or 0x2B820 <= cp <= 0x2CEAF or 0xF900 <= cp <= 0xFAFF or 0x2F800 <= cp <= 0x2FA1F)
+
+
+class BasicTokenizer():
+    """Whitespace and punctuation splitting, lower casing and accent stripping, the same as BERT's basic tokenizer"""
+    def __init__(self, do_lower_case=True):
+        self.do_lower_case = do_lower_case
+
+    def tokenize(self, text):
+        chars = []
+        for char in text:
+            cp = ord(char)
+            if cp == 0 or cp == 0xFFFD or _is_control(char):
+                continue
+            if _is_whitespace(char):
+                chars.append(' ')
+            elif _is_chinese_char(cp):
+                chars.extend([' ', char, ' '])
+            else:
+                chars.append(char)
+        text = unicodedata.normalize('NFC', ''.join(chars))
+        tokens = []
+        for token in text.split():
+            if token in SPECIAL_TOKENS:
+                tokens.append(token)
+                continue
+            if self.do_lower_case:
+                token = ''.join(c for c in unicodedata.normalize('NFD', token.lower()) if unicodedata.category(c) != 'Mn')
+            tokens.extend(self._split_on_punctuation(token))
+        return tokens
+
+    def _split_on_punctuation(self, token):
+        output = []
+        start_new_word = True
+        for char in token:
+            if _is_punctuation(char):
+                output.append(char)
+                start_new_word = True
+            else:
+                if start_new_word:
+                    output.append('')
+                start_new_word = False
+                output[-1] += char
+        return [t for t in output if t]
+
+
+class WordpieceTokenizer():
+    """Greedy longest-match-first WordPiece tokenization of a single whitespace token"""
+    def __init__(self, vocab, unk_token='[UNK]', max_input_chars_per_word=100):
+        self.vocab = vocab
+        self.unk_token = unk_token
+        self.max_input_chars_per_word = max_input_chars_per_word
+
+    def tokenize(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return [self.unk_token]
+        sub_tokens = []
+        start = 0
+        while start < len(token):
+            end = len(token)
+            current = None
+            while start < end:
+                substr = token[start:end]
+                if start > 0:
+                    substr = '##' + substr
+                if substr in self.vocab:
+                    current = substr
+                    break
+                end -= 1
+            if current is None:
+                return [self.unk_token]
+            sub_tokens.append(current)
+            start = end
+        return sub_tokens
+
+
+class FullTokenizer():
+    """BERT tokenizer from a vocab file, without `transformers`. Produces the same tokens as `BertTokenizer`."""
+    def __init__(self, vocab_file, do_lower_case=True):
+        self.vocab = load_vocab(vocab_file)
+        self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
+        self.wordpiece_tokenizer = WordpieceTokenizer(self.vocab)
+        # special tokens written in the text are kept whole
+        self._special_tokens = re.compile('({})'.format('|'.join(re.escape(t) for t in SPECIAL_TOKENS)))
+
+    def tokenize(self, text):
+        tokens = []
+        for part in self._special_tokens.split(text):
+            if part in SPECIAL_TOKENS:
+                tokens.append(part)
+                continue
+            for token in self.basic_tokenizer.tokenize(part):
+                if token in SPECIAL_TOKENS:
+                    tokens.append(token)
+                else:
+                    tokens.extend(self.wordpiece_tokenizer.tokenize(token))
+        return tokens
+
+    def convert_tokens_to_ids(self, tokens):
+        unk_id = self.vocab['[UNK]']
+        return [self.vocab.get(token, unk_id) for token in tokens]
+
+
+class ExportedClassifier():
+    """
+    Serves predictions from a model exported with export.py (TorchScript, vocab and label mapping) without `transformers`.
+    `predict` returns the same records as `BERTModel.predict`.
+    """
+    def __init__(self, export_path, batch_size=32, wordpiece_cache_size=100000, device='cpu'):
+        with open(os.path.join(export_path, EXPORT_CONFIG_NAME)) as f:
+            self.config = json.load(f)
+        # label names by id
+        self.labels = self.config['labels']
+        self.max_seq_length = self.config['max_seq_length']
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.tokenizer = FullTokenizer(os.path.join(export_path, VOCAB_NAME), do_lower_case=self.config['do_lower_case'])
+        self.wordpiece_cache = cache_wordpieces(self.tokenizer, max_size=wordpiece_cache_size)
+        self.model = torch.jit.load(os.path.join(export_path, EXPORT_MODEL_NAME), map_location=self.device)
+        self.model.eval()
+
+    def convert_texts_to_features(self, texts):
+        features = FeatureStore.create(len(texts), self.max_seq_length)
+        for i, text in enumerate(texts):
+            tokens = ['[CLS]'] + self.tokenizer.tokenize(str(text))[:self.max_seq_length - 2] + ['[SEP]']
+            features.set(i, self.tokenizer.convert_tokens_to_ids(tokens), [0] * len(tokens), 0)
+        return features
+
+    def predict_logits(self, features, batch_seconds=None):
+        """Logits of a `FeatureStore`, in the original order. The duration of every forward pass is appended to `batch_seconds` if given."""
+        data = FeatureDataset(features)
+        sampler = LengthBucketBatchSampler(features.lengths, self.batch_size)
+        all_logits = []
+        with torch.no_grad():
+            for input_ids, input_mask, segment_ids, _ in DataLoader(data, sampler=sampler, batch_size=None):
+                t_start = time.time()
+                logits = self.model(input_ids.to(self.device), input_mask.to(self.device), segment_ids.to(self.device))
+                all_logits.append(logits.cpu().numpy())
+                if batch_seconds is not None:
+                    batch_seconds.append(time.time() - t_start)
+        if len(all_logits) == 0:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        return restore_order(np.concatenate(all_logits), sampler.order())
+
+    def predict_probabilities(self, texts):
+        """Class probabilities of a list of strings, every distinct text is only run through the model once"""
+        unique_index, inverse = dedup_texts(texts)
+        self.dedup_stats = dedup_stats(len(texts), len(unique_index))
+        logits = self.predict_logits(self.convert_texts_to_features([texts[i] for i in unique_index]))
+        probabilities = torch.softmax(torch.from_numpy(logits), dim=1).numpy()
+        return probabilities[inverse]
+
+    def predict(self, texts):
+        return PredictionRecords(rank_predictions(self.predict_probabilities(texts), label_mapping=dict(enumerate(self.labels))))
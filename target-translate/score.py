@@ -0,0 +1,150 @@
+from main import BERTModel
+from vac_utils import save_predictions
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+class LineChunkReader():
+    """Reads a TSV or JSONL file in chunks of lines, starting at a byte offset. Yields (ids, texts, end offset, end line number) per chunk."""
+    def __init__(self, input_file, chunk_size, text_field='text', id_field='id', text_column=3, id_column=0, skip_header=False):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.is_jsonl = input_file.endswith('.jsonl') or input_file.endswith('.json')
+        self.text_field = text_field
+        self.id_field = id_field
+        self.text_column = text_column
+        self.id_column = id_column
+        self.skip_header = skip_header
+
+    def _parse(self, line, line_nr):
+        if self.is_jsonl:
+            record = json.loads(line)
+            return str(record.get(self.id_field, line_nr)), record[self.text_field]
+        fields = line.rstrip('\r\n').split('\t')
+        _id = fields[self.id_column] if self.id_column is not None else line_nr
+        return str(_id), fields[self.text_column]
+
+    def read(self, offset=0, line_nr=0):
+        with open(self.input_file, 'rb') as f:
+            f.seek(offset)
+            if offset == 0 and self.skip_header and not self.is_jsonl:
+                f.readline()
+            ids, texts = [], []
+            for line in iter(f.readline, b''):
+                if line.strip():
+                    try:
+                        # UnicodeDecodeError is a ValueError, a bad byte only skips its line
+                        _id, text = self._parse(line.decode('utf-8'), line_nr)
+                    except (ValueError, KeyError, IndexError):
+                        logger.warning(f'Skipping malformed line {line_nr}')
+                    else:
+                        ids.append(_id)
+                        texts.append(text)
+                line_nr += 1
+                if len(texts) >= self.chunk_size:
+                    yield ids, texts, f.tell(), line_nr
+                    ids, texts = [], []
+            if len(texts) > 0:
+                yield ids, texts, f.tell(), line_nr
+
+
+def read_checkpoint(output_path, input_file):
+    checkpoint_path = os.path.join(output_path, CHECKPOINT_FILE)
+    if not os.path.isfile(checkpoint_path):
+        return {'input_file': os.path.abspath(input_file), 'offset': 0, 'line_nr': 0, 'num_scored': 0, 'num_unique': 0, 'num_predicted': 0, 'num_parts': 0, 'seconds': 0.0}
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    if checkpoint['input_file'] != os.path.abspath(input_file):
+        raise Exception(f'Output path {output_path} belongs to input {checkpoint["input_file"]}, use a different output path.')
+    return checkpoint
+
+def write_checkpoint(output_path, checkpoint):
+    """Written only after a part file is complete, so a restart continues after the last complete part"""
+    checkpoint_path = os.path.join(output_path, CHECKPOINT_FILE)
+    with open(checkpoint_path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=4)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def load_model(model_path, eval_batch_size, no_cuda, tokenize_workers=1, prediction_cache=None, prediction_cache_size=10000000, quantize=None):
+    """Sets up a trained BERTModel from its output path for prediction, with the arguments it was trained with"""
+    return BERTModel.from_output_path(model_path, eval_batch_size=eval_batch_size, no_cuda=no_cuda, tokenize_workers=tokenize_workers,
+            prediction_cache=prediction_cache, prediction_cache_size=prediction_cache_size, quantize=quantize)
+
+def score(args):
+    if not os.path.isdir(args.output_path):
+        os.makedirs(args.output_path)
+    checkpoint = read_checkpoint(args.output_path, args.input_file)
+    if checkpoint.get('finished'):
+        logger.info(f'{args.input_file} was already scored completely, see {args.output_path}')
+        return checkpoint
+    if checkpoint['offset'] > 0:
+        logger.info(f'Resuming at line {checkpoint["line_nr"]} (byte offset {checkpoint["offset"]}), {checkpoint["num_scored"]} examples were scored before')
+    bert = load_model(args.model_path, args.batch_size, args.no_cuda, tokenize_workers=args.tokenize_workers,
+            prediction_cache=args.prediction_cache, prediction_cache_size=args.prediction_cache_size, quantize=args.quantize)
+    label_mapping = bert.invert_mapping(bert.label_mapping)
+    reader = LineChunkReader(args.input_file, args.chunk_size, text_field=args.text_field, id_field=args.id_field,
+            text_column=args.text_column, id_column=args.id_column, skip_header=args.skip_header)
+    dataset = os.path.basename(args.input_file)
+    model_name = os.path.basename(os.path.normpath(args.model_path))
+    for ids, texts, offset, line_nr in reader.read(offset=checkpoint['offset'], line_nr=checkpoint['line_nr']):
+        t_start = time.time()
+        probabilities = bert.predict_probabilities(texts)
+        part_file = os.path.join(args.output_path, 'part-{:05d}.npz'.format(checkpoint['num_parts']))
+        save_predictions(part_file, ids, probabilities, label_mapping=label_mapping, experiment_id=model_name, dataset=dataset)
+        seconds = time.time() - t_start
+        checkpoint.update({
+            'offset': offset,
+            'line_nr': line_nr,
+            'num_scored': checkpoint['num_scored'] + len(texts),
+            'num_unique': checkpoint.get('num_unique', 0) + bert.dedup_stats['num_unique'],
+            # texts which were actually run through the model (the rest were duplicates or cached)
+            'num_predicted': checkpoint.get('num_predicted', 0) + bert.dedup_stats['num_predicted'],
+            'num_parts': checkpoint['num_parts'] + 1,
+            'seconds': checkpoint['seconds'] + seconds
+            })
+        write_checkpoint(args.output_path, checkpoint)
+        logger.info(f'Scored {checkpoint["num_scored"]:,} tweets ({len(texts) / seconds:.1f} tweets/sec in this chunk, '
+                f'{checkpoint["num_scored"] / checkpoint["seconds"]:.1f} tweets/sec overall)')
+    if bert.prediction_cache is not None:
+        bert.prediction_cache.log_stats()
+    checkpoint['finished'] = True
+    write_checkpoint(args.output_path, checkpoint)
+    if checkpoint['seconds'] > 0:
+        logger.info(f'Finished scoring {checkpoint["num_scored"]:,} tweets at {checkpoint["num_scored"] / checkpoint["seconds"]:.1f} tweets/sec '
+                f'({checkpoint.get("num_unique", 0):,} unique texts, {checkpoint.get("num_predicted", 0):,} were run through the model)')
+    return checkpoint
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Scores a large TSV/JSONL file of tweets with a trained model. Results are written as .npz part files (see `vac_utils.load_predictions`), interrupted runs resume from the last complete part.')
+    parser.add_argument('--model-path', dest='model_path', required=True, help='Output path of a trained model (containing args.json, label_mapping.pkl and the weights)')
+    parser.add_argument('--input', dest='input_file', required=True, help='TSV or JSONL (.jsonl) file with one tweet per line')
+    parser.add_argument('--output-path', dest='output_path', required=True, help='Directory for the part files and the checkpoint')
+    parser.add_argument('--chunk-size', dest='chunk_size', default=100000, type=int, help='Number of tweets read, scored and written per part file')
+    parser.add_argument('--batch-size', dest='batch_size', default=64, type=int)
+    parser.add_argument('--text-field', dest='text_field', default='text', help='Text key in JSONL files')
+    parser.add_argument('--id-field', dest='id_field', default='id', help='Id key in JSONL files')
+    parser.add_argument('--text-column', dest='text_column', default=3, type=int, help='Text column in TSV files')
+    parser.add_argument('--id-column', dest='id_column', default=0, type=int, help='Id column in TSV files')
+    parser.add_argument('--skip-header', dest='skip_header', action='store_true', default=False, help='TSV file has a header line')
+    parser.add_argument('--tokenize-workers', dest='tokenize_workers', default=1, type=int, help='Number of processes used for tokenization')
+    parser.add_argument('--prediction-cache', dest='prediction_cache', default=None, help='SQLite file caching predictions across runs, keyed by model and text. Disabled by default.')
+    parser.add_argument('--prediction-cache-size', dest='prediction_cache_size', default=10000000, type=int, help='Maximum number of cached predictions, the least recently used ones are evicted')
+    parser.add_argument('--quantize', choices=['int8'], default=None, help='Inference with dynamic int8 quantization of the linear layers (CPU only)')
+    parser.add_argument('--no-cuda', dest='no_cuda', action='store_true', default=False)
+    return parser.parse_args(args)
+
+def main(args):
+    args = parse_args(args)
+    score(args)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
@@ -0,0 +1,32 @@
+import sys; sys.path.append('..');
+import numpy as np
+
+from bucketing import parse_bucket_lengths, bucket_indices, schedule_train_steps
+
+def test_bucket_indices():
+    bucket_lengths = parse_bucket_lengths('64,32', 128)
+    assert bucket_lengths == [32, 64, 128]
+    lengths = np.array([3, 32, 33, 128, 64, 65])
+    input_mask = (np.arange(128) < lengths[:, None]).astype(np.int32)
+    buckets = bucket_indices(input_mask, bucket_lengths)
+    assert [b.tolist() for b in buckets] == [[0, 1], [2, 4], [3, 5]]
+
+def test_schedule_train_steps():
+    schedule = schedule_train_steps([700, 200, 100], 100, rounds=2)
+    assert sum(steps for _, steps in schedule) == 100
+    steps_by_bucket = np.bincount([b for b, _ in schedule], weights=[s for _, s in schedule])
+    assert steps_by_bucket.tolist() == [70, 20, 10]
+    # every bucket shows up once per round
+    assert [b for b, _ in schedule] == [0, 1, 2, 0, 1, 2]
+    # shuffled bucket order per round, same steps per bucket
+    schedule = schedule_train_steps([700, 200, 100], 100, rounds=10, seed=0)
+    assert len(schedule) == 30
+    assert np.bincount([b for b, _ in schedule], weights=[s for _, s in schedule]).tolist() == [70, 20, 10]
+    assert all(sorted(b for b, _ in schedule[r * 3:r * 3 + 3]) == [0, 1, 2] for r in range(10))
+    assert len(set(tuple(b for b, _ in schedule[r * 3:r * 3 + 3]) for r in range(10))) > 1
+    assert schedule == schedule_train_steps([700, 200, 100], 100, rounds=10, seed=0)
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
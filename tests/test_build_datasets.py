@@ -0,0 +1,56 @@
+import sys; sys.path.append('..');
+import os
+import pandas as pd
+
+from build_datasets import BuildGraph, declare_datasets, build, annotated_column, LANGUAGES, MULTILINGUAL_NAME
+
+def _annotated(num_rows=30):
+    labels = ['positive', 'positive', 'positive', 'neutral', 'neutral', 'negative']
+    df = pd.DataFrame({
+        'id': [str(i) for i in range(num_rows)],
+        'label': [labels[i % len(labels)] for i in range(num_rows)],
+        'group': ['train'] * (num_rows - 10) + ['dev'] * 5 + ['test'] * 5,
+        'a': 'a'})
+    for lang in LANGUAGES:
+        df[annotated_column(lang)] = [f'tweet {i} {lang}' for i in range(num_rows)]
+    return df
+
+def _build(annotated, output_path):
+    graph = BuildGraph()
+    datasets = declare_datasets(graph, annotated, sample_size=5)
+    return build(graph, datasets, output_path)
+
+def _read(output_path, name, f_name='train.tsv'):
+    return pd.read_csv(os.path.join(output_path, name, f_name), sep='\t', header=None, names=['id', 'label', 'a', 'text'])
+
+def test_build_datasets(tmp_path):
+    output_path = str(tmp_path)
+    annotated = _annotated()
+    rebuilt = _build(annotated, output_path)
+    assert len(rebuilt) == 14
+    en = _read(output_path, 'cb-annot-en')
+    assert len(en) == 20 and all(en['id'].str.endswith('-en'))
+    assert all(_read(output_path, 'cb-annot-en-fr', 'dev.tsv')['id'].str.endswith('-fr'))
+    assert len(_read(output_path, 'cb-annot-en-sm')) == 5
+    assert len(_read(output_path, MULTILINGUAL_NAME)) == 100
+    assert len(_read(output_path, MULTILINGUAL_NAME + '-sm')) == 25
+    # 11 positive, 6 neutral and 3 negative train examples, undersampled to 3 per label and language
+    us = _read(output_path, MULTILINGUAL_NAME + '-us')
+    assert us['label'].value_counts().tolist() == [15, 15, 15]
+    assert set(us['id'].str.split('-').str[0].value_counts()) == {5}
+    os_counts = _read(output_path, MULTILINGUAL_NAME + '-os')['label'].value_counts()
+    assert os_counts.tolist() == [55, 55, 55]
+    # nothing changed, nothing is rebuilt
+    assert _build(annotated, output_path) == []
+    # a changed German translation only rebuilds the datasets containing German texts
+    annotated.loc[0, annotated_column('de')] = 'changed'
+    assert sorted(_build(annotated, output_path)) == sorted(['cb-annot-en-de', 'cb-annot-en-de-sm', MULTILINGUAL_NAME,
+            MULTILINGUAL_NAME + '-sm', MULTILINGUAL_NAME + '-us', MULTILINGUAL_NAME + '-os'])
+    # missing files are rebuilt
+    os.remove(os.path.join(output_path, 'cb-annot-en', 'dev.tsv'))
+    assert _build(annotated, output_path) == ['cb-annot-en']
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
@@ -0,0 +1,28 @@
+import sys; sys.path.append('..');
+import numpy as np
+
+from feature_cache import FeatureCache
+
+def test_feature_cache_hit(tmp_path):
+    data_file = tmp_path / 'train.tsv'
+    data_file.write_text('1\tpositive\ta\tgreat vaccine\n')
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('[PAD]\n[CLS]\n[SEP]\n')
+    calls = []
+    def create_fn():
+        calls.append(1)
+        return {'input_ids': np.ones((1, 4), dtype=np.int32), 'label_ids': np.zeros(1, dtype=np.int32), 'guid': np.array(['1'])}
+    cache = FeatureCache(str(tmp_path / 'cache'))
+    first = cache.get_or_create(str(data_file), str(vocab_file), False, 4, create_fn)
+    second = FeatureCache(str(tmp_path / 'cache')).get_or_create(str(data_file), str(vocab_file), False, 4, create_fn)
+    assert len(calls) == 1
+    assert (first['input_ids'] == second['input_ids']).all()
+    assert second['guid'].tolist() == ['1']
+    # different tokenizer settings must not share an entry
+    cache.get_or_create(str(data_file), str(vocab_file), True, 4, create_fn)
+    assert len(calls) == 2
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
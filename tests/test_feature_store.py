@@ -0,0 +1,47 @@
+import sys; sys.path.append('..'); sys.path.append('../target-translate');
+import numpy as np
+
+from feature_store import LengthBucketBatchSampler, restore_order
+
+def _lengths(n=103):
+    return np.random.RandomState(0).randint(1, 128, size=n)
+
+def test_length_bucket_batch_sampler():
+    lengths = _lengths()
+    sampler = LengthBucketBatchSampler(lengths, 8, shuffle=True, bucket_size_multiplier=4, seed=1)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        batches = list(sampler)
+        assert len(batches) == len(sampler)
+        # every example exactly once per epoch
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+        assert all(len(batch) <= 8 for batch in batches)
+    # the order only depends on seed and epoch
+    other = LengthBucketBatchSampler(lengths, 8, shuffle=True, bucket_size_multiplier=4, seed=1)
+    other.set_epoch(2)
+    assert list(other) == batches
+    other.set_epoch(1)
+    assert list(other) != batches
+
+def test_length_bucket_batch_sampler_start_batch():
+    sampler = LengthBucketBatchSampler(_lengths(), 8, shuffle=True, bucket_size_multiplier=4, seed=1)
+    sampler.set_epoch(1)
+    batches = list(sampler)
+    sampler.set_epoch(1, start_batch=5)
+    assert list(sampler) == batches[5:]
+    # only the next iteration is shortened
+    assert list(sampler) == batches
+
+def test_restore_order():
+    lengths = _lengths()
+    sampler = LengthBucketBatchSampler(lengths, 8)
+    batches = list(sampler)
+    assert [i for batch in batches for i in batch] == sampler.order().tolist()
+    # values computed in sampler order, e.g. predictions, are put back in the original order
+    values = np.concatenate([lengths[batch] * 10 for batch in batches])
+    assert restore_order(values, sampler.order()).tolist() == (lengths * 10).tolist()
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
@@ -0,0 +1,97 @@
+import sys; sys.path.append('..'); sys.path.append('../target-translate');
+import os
+import random
+import pytest
+import torch
+from transformers import BertConfig, BertModel, BertTokenizer
+
+import main
+
+WORDS = ['vaccine', 'vaccines', 'great', 'bad', 'kids', 'safe', 'autism', 'flu', 'shot', 'today', 'love', 'hate', 'doctor', 'measles', 'is', 'the', 'not']
+LABELS = ['positive', 'neutral', 'negative']
+
+def _tiny_bert(path):
+    """A randomly initialized 2 layer BERT with a cased vocabulary of `WORDS`"""
+    os.makedirs(path)
+    with open(os.path.join(path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS) + '\n')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(WORDS) + 5, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=37, max_position_embeddings=64, return_dict=False)
+    BertModel(config).save_pretrained(path)
+    BertTokenizer(os.path.join(path, 'vocab.txt'), do_lower_case=False).save_pretrained(path)
+
+def _data(path, sizes={'train': 40, 'dev': 16, 'test': 16}):
+    rng = random.Random(0)
+    os.makedirs(path)
+    for split, n in sizes.items():
+        with open(os.path.join(path, f'{split}.tsv'), 'w') as f:
+            for i in range(n):
+                text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))
+                f.write(f'{i}\t{rng.choice(LABELS)}\ta\t{text}\n')
+
+def _args(tmp_path, *args, output='output'):
+    if not os.path.isdir(tmp_path / 'bert'):
+        _tiny_bert(tmp_path / 'bert')
+        _data(tmp_path / 'data' / 'cb-annot-en')
+    return ['--data-path', str(tmp_path / 'data'), '--model-type', str(tmp_path / 'bert'), '--other-path', str(tmp_path / 'other'),
+            '--output-path', str(tmp_path / output), '--no-cuda', '--epochs', '2', '--train-batch-size', '8', '--eval-batch-size', '8',
+            '--warmup-steps', '2', '--bootstrap-resamples', '0', *args]
+
+def test_comparison_reports_restore_settings(tmp_path):
+    main.main(_args(tmp_path))
+    bert = main.BERTModel(main.parse_args(_args(tmp_path)))
+    bert.quantization_report()
+    bert.precision_report()
+    assert (bert.quantize, bert.precision, bert.train_batch_size) == (None, 'fp32', 8)
+    assert os.path.isfile(tmp_path / 'output' / 'quantization_report.json') and os.path.isfile(tmp_path / 'output' / 'precision_report.json')
+    # the model is set up again with the restored settings
+    assert isinstance(bert.model.classifier, torch.nn.Linear) and next(bert.model.parameters()).dtype == torch.float32
+
+def test_resume_from_checkpoint(tmp_path, monkeypatch):
+    main.main(_args(tmp_path, output='full'))
+    # killed in the second epoch, after the checkpoint of step 6
+    class Killed(Exception):
+        pass
+    step = main.AdamW.step
+    num_steps = [0]
+    kill_at = [8]
+    def counted_step(self, *args, **kwargs):
+        num_steps[0] += 1
+        if num_steps[0] == kill_at[0]:
+            raise Killed()
+        return step(self, *args, **kwargs)
+    monkeypatch.setattr(main.AdamW, 'step', counted_step)
+    resumed = _args(tmp_path, '--checkpoint-steps', '3', output='resumed')
+    with pytest.raises(Killed):
+        main.main(resumed)
+    # 40 examples in batches of 8 for 2 epochs, only the 4 steps after the checkpoint are repeated
+    num_steps[0], kill_at[0] = 0, None
+    main.main(resumed + ['--resume'])
+    assert num_steps[0] == 4
+    full = torch.load(tmp_path / 'full' / main.WEIGHTS_NAME)
+    resumed = torch.load(tmp_path / 'resumed' / main.WEIGHTS_NAME)
+    assert full.keys() == resumed.keys()
+    assert all(torch.equal(full[name], resumed[name]) for name in full)
+
+def _distillation_loss(alpha, temperature, logits, teacher_logits, label_ids):
+    bert = main.BERTModel(main.parse_args(['--distill-alpha', str(alpha), '--distill-temperature', str(temperature), '--output-path', 'unused']))
+    return bert.distillation_loss(torch.tensor(logits), torch.tensor(teacher_logits), torch.tensor(label_ids)).item()
+
+def test_distillation_loss():
+    logits = [[2.0, 0.5, -1.0], [0.0, 1.0, 0.0]]
+    teacher_logits = [[1.0, 1.0, 0.0], [-1.0, 2.0, 0.5]]
+    unlabeled = [main.UNLABELED_ID, main.UNLABELED_ID]
+    # without labels only the soft loss is left: T^2 * KL(teacher || student) at temperature T, averaged over the examples
+    student = torch.log_softmax(torch.tensor(logits) / 2, dim=1)
+    teacher = torch.softmax(torch.tensor(teacher_logits) / 2, dim=1)
+    kl = (teacher * (teacher.log() - student)).sum(dim=1).mean().item() * 4
+    assert _distillation_loss(0.3, 2.0, logits, teacher_logits, unlabeled) == pytest.approx(0.3 * kl)
+    # alpha 0 is plain cross entropy of the labeled examples
+    cross_entropy = torch.nn.functional.cross_entropy(torch.tensor(logits[:1]), torch.tensor([0])).item()
+    assert _distillation_loss(0.0, 2.0, logits, teacher_logits, [0, main.UNLABELED_ID]) == pytest.approx(cross_entropy)
+    # a teacher which agrees with the student adds nothing
+    assert _distillation_loss(1.0, 1.0, logits, logits, [0, 1]) == pytest.approx(0.0, abs=1e-6)
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,40 @@
+import sys; sys.path.append('..'); sys.path.append('../target-translate');
+import os
+import pytest
+
+import manifest
+from manifest import load_manifest
+
+def _write(path, rows):
+    with open(path, 'w') as f:
+        f.write(''.join(f'{i}\t{label}\ta\t{text}\n' for i, (label, text) in enumerate(rows)))
+
+def test_manifest(tmp_path, monkeypatch):
+    data_path = str(tmp_path / 'train.tsv')
+    manifest_dir = str(tmp_path / 'manifests')
+    _write(data_path, [('positive', 'first'), ('negative', 'second'), ('positive', 'third')])
+    m = load_manifest(data_path, manifest_dir=manifest_dir)
+    assert (m.num_lines, m.num_rows, m.label_counts) == (3, 3, {'negative': 1, 'positive': 2})
+    assert m.read_lines([2, 0]) == ['2\tpositive\ta\tthird', '0\tpositive\ta\tfirst']
+    # unchanged files are not scanned again
+    built = []
+    build_manifest = manifest.build_manifest
+    monkeypatch.setattr(manifest, 'build_manifest', lambda *args, **kwargs: built.append(args) or build_manifest(*args, **kwargs))
+    assert load_manifest(data_path, manifest_dir=manifest_dir).content_hash == m.content_hash
+    assert built == []
+    # an edited file gets a new manifest whose offsets point to the new rows
+    _write(data_path, [('neutral', 'a much longer first tweet'), ('negative', 'second'), ('neutral', 'third'), ('positive', 'fourth')])
+    m = load_manifest(data_path, manifest_dir=manifest_dir)
+    assert len(built) == 1
+    assert (m.num_lines, m.label_counts) == (4, {'negative': 1, 'neutral': 2, 'positive': 1})
+    assert m.read_lines([3, 1]) == ['3\tpositive\ta\tfourth', '1\tnegative\ta\tsecond']
+    assert m.offsets[-1] == os.path.getsize(data_path)
+    assert load_manifest(data_path, manifest_dir=manifest_dir).read_lines([0]) == ['0\tneutral\ta\ta much longer first tweet']
+    # no temporary files are left behind, also not by a failed write
+    with pytest.raises(TypeError):
+        manifest._write_atomic(os.path.join(manifest_dir, 'broken.json'), lambda f: f.write('not bytes'))
+    assert sorted(f_name.rsplit('.', 2)[1] for f_name in os.listdir(manifest_dir)) == ['manifest', 'offsets']
+
+
+if __name__ == "__main__":
+    pytest.main()
@@ -0,0 +1,23 @@
+import sys; sys.path.append('..');
+import numpy as np
+
+from parallel_tokenization import run_sharded, shared_array, shard_ranges, MIN_ROWS_PER_WORKER
+
+def test_run_sharded_preserves_order():
+    num_rows = 4 * MIN_ROWS_PER_WORKER + 3
+    texts = [' '.join(['tweet'] * (i % 7)) for i in range(num_rows)]
+    lengths = shared_array((num_rows,), np.int32)
+    def fill(start, end):
+        for i in range(start, end):
+            lengths[i] = len(texts[i].split())
+    run_sharded(fill, num_rows, 4)
+    assert lengths.tolist() == [len(t.split()) for t in texts]
+
+def test_shard_ranges():
+    assert shard_ranges(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert shard_ranges(2, 4) == [(0, 1), (1, 2)]
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
@@ -0,0 +1,48 @@
+import sys; sys.path.append('..'); sys.path.append('../target-translate');
+import itertools
+import numpy as np
+
+import prediction_cache
+from prediction_cache import PredictionCache
+
+def _hashes(*names):
+    return [name.encode('utf-8').ljust(16, b'\0') for name in names]
+
+def _num_entries(cache):
+    return cache.conn.execute('SELECT n FROM num_entries').fetchone()[0]
+
+def test_prediction_cache(tmp_path, monkeypatch):
+    # a strictly increasing clock, so that the least recently used entry is well defined
+    clock = itertools.count()
+    monkeypatch.setattr(prediction_cache.time, 'time', lambda: float(next(clock)))
+    path = str(tmp_path / 'cache.sqlite')
+    cache = PredictionCache(path, 'model-a', 3, max_entries=3)
+    probabilities = np.arange(9, dtype=np.float32).reshape(3, 3)
+    cache.put(_hashes('a', 'b', 'c'), probabilities)
+    found, cached = cache.get(_hashes('x', 'b', 'a'))
+    assert found.tolist() == [False, True, True]
+    assert cached.tolist() == probabilities[[1, 0]].tolist()
+    # reading 'a' and 'b' made 'c' the least recently used entry
+    cache.put(_hashes('d'), probabilities[:1])
+    assert cache.get(_hashes('a', 'b', 'c', 'd'))[0].tolist() == [True, True, False, True]
+    # replaced entries are counted once
+    cache.put(_hashes('a', 'b'), probabilities[:2])
+    cache.put(_hashes('a'), probabilities[2:])
+    assert _num_entries(cache) == 3
+    assert cache.get(_hashes('a'))[1].tolist() == probabilities[2:].tolist()
+    # entries of another model are not shared, but count towards the same limit
+    other = PredictionCache(path, 'model-b', 3, max_entries=3)
+    found, cached = other.get(_hashes('a', 'b'))
+    assert found.tolist() == [False, False]
+    assert cached.shape == (0, 3) and cached.dtype == np.float32
+    other.put(_hashes('a'), probabilities[:1])
+    assert _num_entries(other) == 3
+    assert other.get(_hashes('a'))[1].tolist() == probabilities[:1].tolist()
+    assert (cache.hits, cache.misses, other.hits, other.misses) == (6, 2, 1, 2)
+    cache.close()
+    other.close()
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
@@ -0,0 +1,35 @@
+import sys; sys.path.append('..');
+import csv
+import numpy as np
+
+from results_store import ResultsStore, markdown_table
+
+def test_results_store(tmp_path):
+    log = tmp_path / 'fulltrainlog.csv'
+    with open(str(log), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['Experiment_Name', 'Num_Train_Iterations', 'accuracy'])
+        writer.writeheader()
+        writer.writerows([{'Experiment_Name': 'a', 'Num_Train_Iterations': 100, 'accuracy': 0.8},
+                          {'Experiment_Name': 'a', 'Num_Train_Iterations': 100, 'accuracy': 0.9}])
+    db_path = str(tmp_path / 'results.db')
+    with ResultsStore(db_path) as store:
+        assert store.import_csv(str(log)) == 2
+        # importing the same file twice is a no-op
+        assert store.import_csv(str(log)) == 0
+        # new columns are added on the fly
+        store.insert({'Experiment_Name': 'b', 'Num_Train_Steps': 200, 'accuracy': 0.7, 'accuracy_ci_low': 0.6})
+        assert 'Num_Train_Iterations' not in store.columns()
+        results = store.aggregate(metrics=['accuracy', 'Num_Train_Steps'])
+    assert [r['Experiment_Name'] for r in results] == ['a', 'b']
+    assert results[0]['count'] == 2
+    assert np.isclose(results[0]['accuracy_mean'], 0.85)
+    assert np.isclose(results[0]['accuracy_std'], np.std([0.8, 0.9], ddof=1))
+    assert results[1]['Num_Train_Steps_mean'] == 200
+    assert results[1]['accuracy_std'] is None
+    table = markdown_table(results, ['Experiment_Name'], ['accuracy'])
+    assert table.splitlines()[2] == '| `a` | 2 | 85.0% ± 7.1 |'
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
@@ -0,0 +1,21 @@
+import sys; sys.path.append('..'); sys.path.append('../target-translate');
+
+from score import LineChunkReader
+
+def test_line_chunk_reader_skips_malformed_lines(tmp_path):
+    input_file = tmp_path / 'tweets.tsv'
+    lines = [b'1\tx\ta\tfirst\n', b'2\tx\ta\tbad \xff byte\n', b'3\tonly two columns\n', b'\n', b'4\tx\ta\tlast\n']
+    input_file.write_bytes(b''.join(lines))
+    reader = LineChunkReader(str(input_file), chunk_size=2)
+    chunks = list(reader.read())
+    assert [ids for ids, _, _, _ in chunks] == [['1', '4']]
+    assert chunks[0][1] == ['first', 'last']
+    assert chunks[0][2:] == (sum(len(l) for l in lines), 5)
+    # resuming after the bad line
+    offset = len(lines[0]) + len(lines[1])
+    assert list(reader.read(offset=offset, line_nr=2))[0][:2] == (['4'], ['last'])
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
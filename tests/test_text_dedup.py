@@ -0,0 +1,26 @@
+import sys; sys.path.append('..');
+import numpy as np
+
+from text_dedup import dedup_texts, dedup_rows, duplicate_groups, normalize_text
+
+def test_dedup_texts():
+    texts = ['RT vaccines work', 'flu shot', 'RT  vaccines work\n', 'Flu shot', 'flu shot']
+    unique_index, inverse = dedup_texts(texts)
+    # whitespace is normalized, case is kept (cased models)
+    assert unique_index.tolist() == [0, 1, 3]
+    assert inverse.tolist() == [0, 1, 0, 2, 1]
+    assert [texts[i] for i in unique_index[inverse]] == ['RT vaccines work', 'flu shot', 'RT vaccines work', 'Flu shot', 'flu shot']
+    assert [g.tolist() for g in duplicate_groups(inverse)] == [[0, 2], [1, 4], [3]]
+    assert normalize_text(' a\u00a0 b\t') == 'a b'
+
+def test_dedup_rows():
+    input_ids = np.array([[101, 7, 102], [101, 8, 102], [101, 7, 102], [101, 7, 102]])
+    label_ids = np.array([0, 0, 0, 1])
+    unique_index, inverse = dedup_rows(input_ids, label_ids)
+    assert unique_index.tolist() == [0, 1, 3]
+    assert inverse.tolist() == [0, 1, 0, 2]
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
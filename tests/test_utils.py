@@ -1,7 +1,8 @@
 import sys; sys.path.append('..');
 import uuid
+import numpy as np
 
-from vac_utils import get_predictions_output
+from vac_utils import get_predictions_output, rank_predictions, save_predictions, load_predictions, HiddenStateWriter, ConfusionMatrix, performance_metrics, build_experiment_definitions, plan_experiments
 
 def test_predictions_output():
     experiment_id = str(uuid.uuid4())
@@ -10,11 +11,97 @@ def test_predictions_output():
     label_list = ['positive', 'neutral', 'negtive']
     guids = [str(i) for i in range(3)]
     label_mapping = dict(zip(range(len(label_list)), label_list))
-    output = get_predictions_output(experiment_id, guids, probabilities, y_true, label_mapping)
-    assert len(output) == 2
-    assert list(output['prediction_output'].keys()) == guids
+    output = get_predictions_output(experiment_id, guids, probabilities, y_true, label_mapping=label_mapping)
+    assert list(output['guid'].keys()) == guids
+    assert output['guid']['1'][0] == {'prediction': 'negtive'}
+    assert output['guid']['1'][4] == {'y_true': 'neutral'}
     assert output['Experiment_Id'] == experiment_id
 
+def test_rank_predictions():
+    probabilities = np.array([[0.1, 0.4, 0.5], [0.6, 0.3, 0.1]])
+    ranked = rank_predictions(probabilities, y_true=[0, 1], label_mapping={0: 'positive', 1: 'neutral', 2: 'negative'})
+    assert ranked['prediction'].tolist() == ['negative', 'positive']
+    assert ranked['predictions'][1].tolist() == ['positive', 'neutral', 'negative']
+    assert np.allclose(ranked['probabilities'][0], [0.5, 0.4, 0.1])
+    assert ranked['y_true'].tolist() == ['positive', 'neutral']
+
+def test_save_and_load_predictions(tmp_path):
+    label_mapping = {0: 'positive', 1: 'neutral', 2: 'negative'}
+    for i, dataset in enumerate(['train', 'dev']):
+        save_predictions(str(tmp_path / f'{dataset}.npz'), ['a', 'b'], [[0.1, 0.4, 0.5], [0.6, 0.3, 0.1]], y_true=[0, i],
+                label_mapping=label_mapping, experiment_id='exp', dataset=dataset)
+    df = load_predictions([str(tmp_path / 'train.npz'), str(tmp_path / 'dev.npz')])
+    assert len(df) == 4
+    assert df['dataset'].tolist() == ['train', 'train', 'dev', 'dev']
+    assert df['prediction'].tolist() == ['negative', 'positive'] * 2
+    assert df['y_true'].tolist() == ['positive', 'positive', 'positive', 'neutral']
+    columns = load_predictions(str(tmp_path / 'dev.npz'), as_frame=False)
+    assert columns['predictions'].shape == (2, 3)
+
+def test_hidden_state_writer(tmp_path):
+    writer = HiddenStateWriter(str(tmp_path / 'cls.npy'), 3, chunk_size=2)
+    for i in [2, 0, 1]:
+        writer.write(i, np.full(4, i, dtype=np.float32))
+    writer.close()
+    hidden_states = np.load(str(tmp_path / 'cls.npy'), mmap_mode='r')
+    assert hidden_states.dtype == np.float16
+    assert hidden_states[:, 0].tolist() == [0, 1, 2]
+
+def _sklearn_scores(y_true, y_pred, labels, binary):
+    import sklearn.metrics
+    scores = {'accuracy': sklearn.metrics.accuracy_score(y_true, y_pred)}
+    for m, scoring_function in [('precision', sklearn.metrics.precision_score), ('recall', sklearn.metrics.recall_score), ('f1', sklearn.metrics.f1_score)]:
+        for av in ['micro', 'macro', 'weighted'] + (['binary'] if binary else []):
+            scores[m + '_' + av] = scoring_function(y_true, y_pred, average=av, labels=labels, zero_division=0)
+        for label, class_metric in zip(labels, scoring_function(y_true, y_pred, average=None, labels=labels, zero_division=0)):
+            scores[m + '_' + str(label)] = class_metric
+    return scores
+
+def test_performance_metrics_match_sklearn():
+    rng = np.random.RandomState(0)
+    for num_labels in [2, 3, 5]:
+        y_true = rng.randint(num_labels, size=200)
+        # never predict the last label, so zero division occurs
+        y_pred = rng.randint(num_labels - 1, size=200)
+        labels = list(range(num_labels))
+        scores = performance_metrics(y_true.tolist(), y_pred.tolist(), label_mapping=dict(zip(labels, labels)))
+        expected = _sklearn_scores(y_true, y_pred, labels, binary=num_labels <= 2)
+        assert scores.keys() == expected.keys()
+        for k, v in expected.items():
+            assert np.isclose(scores[k], v), k
+
+def test_confusion_matrix_merge():
+    y_true, y_pred = [0, 1, 2, 2, 1], [0, 2, 2, 1, 1]
+    streamed = ConfusionMatrix().update(y_true[:2], y_pred[:2]).merge(ConfusionMatrix().update(y_true[2:], y_pred[2:]))
+    assert (streamed.counts == ConfusionMatrix(3).update(y_true, y_pred).counts).all()
+    assert streamed.scores() == ConfusionMatrix().update(y_true, y_pred).scores()
+
+def test_bootstrap_intervals():
+    rng = np.random.RandomState(0)
+    y_true = rng.randint(3, size=500)
+    y_pred = np.where(rng.rand(500) < 0.7, y_true, rng.randint(3, size=500))
+    scores = performance_metrics(y_true.tolist(), y_pred.tolist(), label_mapping={0: 'a', 1: 'b', 2: 'c'}, bootstrap_resamples=500)
+    for k in ['accuracy', 'f1_macro', 'precision_b', 'recall_weighted']:
+        assert scores[k + '_ci_low'] <= scores[k] <= scores[k + '_ci_high']
+    # roughly the normal approximation of the accuracy interval
+    width = scores['accuracy_ci_high'] - scores['accuracy_ci_low']
+    expected_width = 2 * 1.96 * np.sqrt(scores['accuracy'] * (1 - scores['accuracy']) / 500)
+    assert abs(width - expected_width) < 0.02
+
+def test_plan_experiments():
+    experiment_matrix = [
+        {'prefix': 'zeroshot', 'train_annot_dataset': 'cb-annot-en', 'train_name': 'cb-annot-en', 'eval': ['en', 'de']},
+        {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en', 'train_name': 'cb-annot-en', 'eval': ['en']},
+        {'prefix': 'translate', 'train_annot_dataset': 'cb-annot-en-de', 'train_name': 'cb-annot-de', 'eval': ['de']},
+        {'prefix': 'translate-lr', 'train_annot_dataset': 'cb-annot-en', 'train_name': 'cb-annot-en', 'eval': ['en'], 'hyperparameters': {'learning_rate': 1e-5}}
+    ]
+    experiment_definitions = build_experiment_definitions(experiment_matrix, {'en': 'cb-annot-en', 'de': 'cb-annot-en-de'})
+    assert list(experiment_definitions.keys()) == ['1', '2', '3', '4', '5']
+    assert experiment_definitions['2']['name'] == 'zeroshot-cb-annot-en-cb-annot-de'
+    assert experiment_definitions['4']['eval_annot_dataset'] == 'cb-annot-en-de'
+    plan = plan_experiments(['1', '4', '3', '5', '2'], experiment_definitions)
+    assert plan == [('cb-annot-en', {}, ['1', '3', '2']), ('cb-annot-en-de', {}, ['4']), ('cb-annot-en', {'learning_rate': 1e-5}, ['5'])]
+
 
 if __name__ == "__main__":
     import pytest
@@ -0,0 +1,36 @@
+import sys; sys.path.append('..');
+
+from wordpiece_cache import cache_wordpieces
+
+class _Wordpiece():
+    vocab = {'vacc': 0, '##ine': 1, '[UNK]': 2}
+    def __init__(self):
+        self.calls = 0
+    def tokenize(self, token):
+        self.calls += 1
+        return ['vacc', '##ine'] if token == 'vaccine' else ['[UNK]']
+
+class _Tokenizer():
+    def __init__(self):
+        self.wordpiece_tokenizer = _Wordpiece()
+    def tokenize(self, text):
+        return [piece for token in text.split() for piece in self.wordpiece_tokenizer.tokenize(token)]
+
+def test_cache_wordpieces():
+    tokenizer = _Tokenizer()
+    wordpiece = tokenizer.wordpiece_tokenizer
+    cache = cache_wordpieces(tokenizer, max_size=1)
+    assert tokenizer.tokenize('vaccine vaccine') == ['vacc', '##ine', 'vacc', '##ine']
+    assert tokenizer.tokenize('the vaccine') == ['[UNK]', 'vacc', '##ine']
+    assert wordpiece.calls == 3
+    assert cache.stats()['hits'] == 1 and cache.stats()['size'] == 1
+    # attributes of the wrapped tokenizer are still available
+    assert tokenizer.wordpiece_tokenizer.vocab['##ine'] == 1
+    # wrapping twice keeps the same cache
+    assert cache_wordpieces(tokenizer) is cache
+    assert cache_wordpieces(_Tokenizer(), max_size=0) is None
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main()
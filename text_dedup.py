@@ -0,0 +1,58 @@
+import hashlib
+import logging
+import re
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Characters BERT's basic tokenizer splits on (space, \t, \n, \r and unicode category Zs). Collapsing runs of them
+# does not change the tokens, other normalizations (e.g. unicode NFC) would for cased models.
+_WHITESPACE = re.compile('[ \t\n\r\u00a0\u1680\u2000-\u200a\u202f\u205f\u3000]+')
+
+
+def normalize_text(text):
+    return _WHITESPACE.sub(' ', str(text)).strip()
+
+def text_hashes(texts):
+    """16 byte hash of every normalized text"""
+    return np.array([hashlib.blake2b(normalize_text(t).encode('utf-8'), digest_size=16).digest() for t in texts], dtype='S16')
+
+def dedup(keys):
+    """
+    Returns (unique_index, inverse): `unique_index` are the positions of the first occurrence of every distinct key,
+    in order of appearance, and `keys[unique_index][inverse]` equals `keys`. Results computed for the unique
+    entries are fanned back out to all entries with `results[inverse]`.
+    """
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    _, unique_index, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    # np.unique sorts by key, restore the order of first appearance
+    order = np.argsort(unique_index, kind='stable')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return unique_index[order], rank[inverse.ravel()]
+
+def dedup_texts(texts):
+    return dedup(text_hashes(texts))
+
+def dedup_rows(*arrays):
+    """Deduplicates examples by the raw bytes of their rows across all given arrays (e.g. input_ids, segment_ids, label_ids)"""
+    num_rows = len(arrays[0])
+    rows = np.concatenate([np.asarray(a, dtype=np.int64).reshape(num_rows, -1) for a in arrays], axis=1)
+    rows = np.ascontiguousarray(rows)
+    keys = rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+    return dedup(keys)
+
+def duplicate_groups(inverse):
+    """Positions of all entries of every unique entry, as a list of index arrays"""
+    inverse = np.asarray(inverse)
+    order = np.argsort(inverse, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+
+def dedup_stats(num_total, num_unique, what='texts'):
+    """Logs and returns how much inference work deduplication saved"""
+    num_duplicates = num_total - num_unique
+    saved = num_duplicates / num_total if num_total > 0 else 0.0
+    logger.info(f'Dedup: {num_unique:,} unique of {num_total:,} {what}, {num_duplicates:,} duplicates ({saved:.1%}) are not run through the model')
+    return {'num_total': num_total, 'num_unique': num_unique, 'num_duplicates': num_duplicates, 'saved_fraction': saved}
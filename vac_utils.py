@@ -1,89 +1,343 @@
 import numpy as np
-import sklearn.metrics
-import os
-import csv
+import pandas as pd
 import json
 import logging
 import time
+from collections.abc import Mapping, Sequence
 
 logger = logging.getLogger(__name__)
 
 #Define some custom functions
-def performance_metrics(y_true, y_pred, metrics=None, averaging=None, label_mapping=None):
+def performance_metrics(y_true, y_pred, metrics=None, averaging=None, label_mapping=None, bootstrap_resamples=0):
     """
-    Compute performance metrics
+    Compute performance metrics. With `bootstrap_resamples`, every score gets `_ci_low`/`_ci_high` 95% confidence bounds.
     """
-    def _compute_performance_metric(scoring_function, m, y_true, y_pred):
-        for av in averaging:
-            if av is None:
-                metrics_by_class = scoring_function(y_true, y_pred, average=av, labels=labels)
-                for i, class_metric in enumerate(metrics_by_class):
-                    if label_mapping is None:
-                        label_name = labels[i]
-                    else:
-                        label_name = label_mapping[labels[i]]
-                    scores[m + '_' + str(label_name)] = class_metric
-            else:
-                scores[m + '_' + av] = scoring_function(y_true, y_pred, average=av, labels=labels)
-    if averaging is None:
-        averaging = ['micro', 'macro', 'weighted', None]
-    if metrics is None:
-        metrics = ['accuracy', 'precision', 'recall', 'f1']
-    scores = {}
     if label_mapping is None:
         # infer labels from data
-        labels = sorted(list(set(y_true + y_pred)))
+        labels = None
     else:
         labels = sorted(list(label_mapping.keys()))
+    confusion_matrix = ConfusionMatrix().update(y_true, y_pred)
+    scores = confusion_matrix.scores(metrics=metrics, averaging=averaging, labels=labels, label_mapping=label_mapping)
+    if bootstrap_resamples > 0:
+        scores.update(confusion_matrix.bootstrap_intervals(bootstrap_resamples, metrics=metrics, averaging=averaging, labels=labels, label_mapping=label_mapping))
+    return scores
+
+class ConfusionMatrix():
+    """
+    Confusion matrix of integer label ids (rows: true label, columns: predicted label). Counts are accumulated
+    batch by batch with `update` and can be combined across workers with `merge`. All scores are derived from
+    the counts and match sklearn's (zero division gives 0).
+    """
+    def __init__(self, num_labels=0):
+        self.counts = np.zeros((num_labels, num_labels), dtype=np.int64)
+
+    @property
+    def num_labels(self):
+        return len(self.counts)
+
+    def _resize(self, num_labels):
+        if num_labels > self.num_labels:
+            counts = np.zeros((num_labels, num_labels), dtype=np.int64)
+            counts[:self.num_labels, :self.num_labels] = self.counts
+            self.counts = counts
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=np.int64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.int64).ravel()
+        if len(y_true) > 0:
+            self._resize(int(max(y_true.max(), y_pred.max())) + 1)
+        n = self.num_labels
+        self.counts += np.bincount(y_true * n + y_pred, minlength=n * n).reshape(n, n)
+        return self
+
+    def merge(self, other):
+        self._resize(other.num_labels)
+        self.counts[:other.num_labels, :other.num_labels] += other.counts
+        return self
+
+    def present_labels(self):
+        """Labels which occur as true or predicted label"""
+        return np.flatnonzero(self.counts.sum(axis=0) + self.counts.sum(axis=1)).tolist()
+
+    def true_labels(self):
+        """Labels which occur as true label"""
+        return np.flatnonzero(self.counts.sum(axis=1)).tolist()
+
+    def scores(self, metrics=None, averaging=None, labels=None, label_mapping=None):
+        """
+        Accuracy and precision/recall/f1 for every averaging mode (None gives per-class scores). Labels default to
+        the present labels, 'binary' averaging is added for at most two labels. Per-class scores are named by `label_mapping`.
+        """
+        if labels is None:
+            labels = self.present_labels()
+        self._resize(max(list(labels) + [1]) + 1)
+        scores = _scores_from_counts(self.counts, labels, metrics=metrics, averaging=averaging, label_mapping=label_mapping)
+        return {k: float(v) for k, v in scores.items()}
+
+    def bootstrap_intervals(self, num_resamples=1000, confidence=0.95, seed=42, metrics=None, averaging=None, labels=None, label_mapping=None):
+        """
+        Percentile bootstrap confidence intervals of all scores, as `<score>_ci_low` and `<score>_ci_high`.
+        Resampling the examples with replacement is the same as drawing the confusion counts from a multinomial
+        over the cells, so all resamples are drawn in one call and scored as a batch of confusion matrices.
+        """
+        if labels is None:
+            labels = self.present_labels()
+        self._resize(max(list(labels) + [1]) + 1)
+        n = self.num_labels
+        total = self.counts.sum()
+        if total == 0:
+            return {}
+        rng = np.random.RandomState(seed)
+        resampled = rng.multinomial(total, self.counts.ravel() / total, size=num_resamples).reshape(num_resamples, n, n)
+        scores = _scores_from_counts(resampled, labels, metrics=metrics, averaging=averaging, label_mapping=label_mapping)
+        alpha = (1 - confidence) / 2
+        intervals = {}
+        for k, v in scores.items():
+            low, high = np.percentile(v, [100 * alpha, 100 * (1 - alpha)])
+            intervals[k + '_ci_low'] = float(low)
+            intervals[k + '_ci_high'] = float(high)
+        return intervals
+
+def _scores_from_counts(counts, labels, metrics=None, averaging=None, label_mapping=None):
+    """Scores of a confusion matrix or of a batch of confusion matrices (leading axes of `counts`)"""
+    if averaging is None:
+        averaging = ['micro', 'macro', 'weighted', None]
+    if metrics is None:
+        metrics = ['accuracy', 'precision', 'recall', 'f1']
     if len(labels) <= 2:
         # binary classification
-        averaging += ['binary']
+        averaging = averaging + ['binary']
+    tp_all = np.diagonal(counts, axis1=-2, axis2=-1)
+    pred_all = counts.sum(axis=-2)
+    true_all = counts.sum(axis=-1)
+    labels = np.asarray(labels, dtype=int)
+    tp, pred_sum, true_sum = tp_all[..., labels], pred_all[..., labels], true_all[..., labels]
+    scores = {}
     for m in metrics:
         if m == 'accuracy':
-            scores[m] = sklearn.metrics.accuracy_score(y_true, y_pred)
-        elif m == 'precision':
-            _compute_performance_metric(sklearn.metrics.precision_score, m, y_true, y_pred)
-        elif m == 'recall':
-            _compute_performance_metric(sklearn.metrics.recall_score, m, y_true, y_pred)
-        elif m == 'f1':
-            _compute_performance_metric(sklearn.metrics.f1_score, m, y_true, y_pred)
+            scores[m] = _safe_divide(tp_all.sum(axis=-1), counts.sum(axis=(-2, -1)))
+            continue
+        for av in averaging:
+            if av is None:
+                class_scores = _prf(m, tp, pred_sum, true_sum)
+                for i, label in enumerate(labels):
+                    label_name = label if label_mapping is None else label_mapping[label]
+                    scores[m + '_' + str(label_name)] = class_scores[..., i]
+            elif av == 'micro':
+                scores[m + '_' + av] = _prf(m, tp.sum(axis=-1), pred_sum.sum(axis=-1), true_sum.sum(axis=-1))
+            elif av == 'macro':
+                scores[m + '_' + av] = _prf(m, tp, pred_sum, true_sum).mean(axis=-1) if len(labels) else np.zeros(counts.shape[:-2])
+            elif av == 'weighted':
+                scores[m + '_' + av] = _safe_divide((_prf(m, tp, pred_sum, true_sum) * true_sum).sum(axis=-1), true_sum.sum(axis=-1))
+            elif av == 'binary':
+                # positive label is 1
+                scores[m + '_' + av] = _prf(m, tp_all[..., 1], pred_all[..., 1], true_all[..., 1])
     return scores
 
+def _safe_divide(numerator, denominator):
+    """Element-wise division which gives 0 where the denominator is 0"""
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape), where=denominator != 0)
+
+def _prf(metric, tp, pred_sum, true_sum):
+    if metric == 'precision':
+        return _safe_divide(tp, pred_sum)
+    elif metric == 'recall':
+        return _safe_divide(tp, true_sum)
+    elif metric == 'f1':
+        return _safe_divide(2 * np.asarray(tp), np.asarray(pred_sum) + np.asarray(true_sum))
+    raise ValueError(f'Unknown metric {metric}')
+
+def build_experiment_definitions(experiment_matrix, eval_annot_datasets):
+    """
+    Expands a train x eval matrix into numbered experiment definitions. Every row of the matrix
+    is one trained model, evaluated on each of its eval languages.
+    """
+    experiment_definitions = {}
+    for row in experiment_matrix:
+        for lang in row['eval']:
+            definition = {
+                'name': '{}-{}-cb-annot-{}'.format(row['prefix'], row['train_name'], lang),
+                'train_annot_dataset': row['train_annot_dataset'],
+                'eval_annot_dataset': eval_annot_datasets[lang]
+            }
+            if 'hyperparameters' in row:
+                definition['hyperparameters'] = row['hyperparameters']
+            experiment_definitions[str(len(experiment_definitions) + 1)] = definition
+    return experiment_definitions
+
+def plan_experiments(exp_list, experiment_definitions):
+    """
+    Groups experiments which train the same model (same train dataset and hyperparameters), so
+    every model is only trained once. Returns a list of (train_annot_dataset, hyperparameters, exp_nrs)
+    in order of first appearance in `exp_list`.
+    """
+    plan = {}
+    for exp_nr in exp_list:
+        definition = experiment_definitions[exp_nr]
+        hyperparameters = definition.get('hyperparameters', {})
+        key = (definition['train_annot_dataset'], tuple(sorted(hyperparameters.items())))
+        if key not in plan:
+            plan[key] = (definition['train_annot_dataset'], hyperparameters, [])
+        plan[key][2].append(exp_nr)
+    return list(plan.values())
+
+def rank_predictions(probabilities, y_true=None, label_mapping=None):
+    """
+    Ranks the labels of all examples at once. Returns columnar arrays: `prediction` (top label),
+    `predictions` (labels sorted by probability), `probability` (top probability), `probabilities`
+    (sorted probabilities) and `y_true` if given. Label ids are mapped to names with `label_mapping` (id -> name).
+    """
+    probabilities = np.asarray(probabilities)
+    sorted_ids = np.argsort(-probabilities, axis=1, kind='stable')
+    sorted_probabilities = np.take_along_axis(probabilities, sorted_ids, axis=1)
+    if label_mapping is None:
+        lookup = np.arange(probabilities.shape[1])
+    else:
+        lookup = np.array([label_mapping[i] for i in range(max(label_mapping.keys()) + 1)])
+    ranked = {
+        'prediction': lookup[sorted_ids[:, 0]],
+        'predictions': lookup[sorted_ids],
+        'probability': sorted_probabilities[:, 0],
+        'probabilities': sorted_probabilities
+    }
+    if y_true is not None:
+        ranked['y_true'] = lookup[np.asarray(y_true, dtype=int)]
+    return ranked
+
+class GuidPredictions(Mapping):
+    """
+    Lazy dict-per-guid view of ranked predictions as it was written to the prediction json files:
+    guid -> list of single-key dicts. Entries are only built when accessed.
+    """
+    def __init__(self, guid, ranked, cls_hidden_state=None):
+        self.ranked = ranked
+        self.cls_hidden_state = cls_hidden_state
+        self._index = {g: i for i, g in enumerate(guid)}
+
+    def __getitem__(self, g):
+        i = self._index[g]
+        entry = [
+            {'prediction': self.ranked['prediction'][i]},
+            {'predictions': self.ranked['predictions'][i].tolist()},
+            {'probability': self.ranked['probability'][i]},
+            {'probabilities': self.ranked['probabilities'][i].tolist()},
+            {'y_true': self.ranked['y_true'][i]}
+        ]
+        if self.cls_hidden_state is not None:
+            entry.append({'cls_hidden_state': self.cls_hidden_state[i]})
+        return entry
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+class PredictionRecords(Sequence):
+    """Lazy list view of ranked predictions with a {'labels': ..., 'probabilities': ...} dict per example"""
+    def __init__(self, ranked):
+        self.ranked = ranked
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return {'labels': self.ranked['predictions'][i].tolist(), 'probabilities': self.ranked['probabilities'][i]}
+
+    def __len__(self):
+        return len(self.ranked['probabilities'])
+
 def get_predictions_output(experiment_id, guid, probabilities, y_true, cls_hidden_state=None, label_mapping=None, dataset='train'):
-    probabilities = np.array(probabilities)
     guid = np.array(guid)
     assert len(probabilities) == len(y_true)
     assert len(guid) == len(y_true)
-    output = {'Experiment_Id': experiment_id, 'dataset': dataset, 'created_at': time.time(), 'guid': {}}
-    for g in guid:
-        output['guid'][g] = []
-    for i, g in enumerate(guid):
-        sorted_ids = np.argsort(-probabilities[i])
-        if label_mapping is None:
-            labels = sorted_ids
-        else:
-            labels = [label_mapping[s] for s in sorted_ids]
-        output['guid'][g].append({'prediction' : labels[0]})
-        output['guid'][g].append({'predictions' : labels})
-        output['guid'][g].append({'probability' : probabilities[i][sorted_ids][0]})
-        output['guid'][g].append({'probabilities' : probabilities[i][sorted_ids].tolist()})
-        output['guid'][g].append({'y_true' : label_mapping[y_true[i]]})
-        if cls_hidden_state is not None:
-            output['guid'][g].append({'cls_hidden_state' : cls_hidden_state[i]})
-    return output
-
-def append_to_csv(data, f_name):
-    datafields = sorted(data.keys())
-    def _get_dict_writer(f):
-        return csv.DictWriter(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=datafields) 
-    if not os.path.isfile(f_name):
-        with open(f_name, mode='w') as f:
-            output_writer = _get_dict_writer(f)
-            output_writer.writeheader()
-    with open(f_name, mode='a+') as f:
-        output_writer = _get_dict_writer(f)
-        output_writer.writerow(data)
-    logger.info(f'Wrote log to csv {f_name}')
+    ranked = rank_predictions(probabilities, y_true=y_true, label_mapping=label_mapping)
+    return {'Experiment_Id': experiment_id, 'dataset': dataset, 'created_at': time.time(), 'guid': GuidPredictions(guid, ranked, cls_hidden_state=cls_hidden_state)}
+
+def save_predictions(f_name, guid, probabilities, y_true=None, label_mapping=None, experiment_id='', dataset='', cls_hidden_state=None):
+    """
+    Writes predictions as a columnar .npz bundle: the guid index, the (unsorted) probability matrix,
+    y_true label ids and the label names in id order. Ranking is done on load by `load_predictions`.
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float32)
+    columns = {
+        'experiment_id': np.array(experiment_id),
+        'dataset': np.array(dataset),
+        'created_at': np.array(time.time()),
+        'guid': np.asarray(guid).astype(str),
+        'probabilities': probabilities
+    }
+    assert len(columns['guid']) == len(probabilities)
+    if label_mapping is not None:
+        columns['label_names'] = np.array([label_mapping[i] for i in range(max(label_mapping.keys()) + 1)]).astype(str)
+    if y_true is not None:
+        columns['y_true'] = np.asarray(y_true, dtype=np.int32)
+        assert len(columns['y_true']) == len(probabilities)
+    if cls_hidden_state is not None:
+        columns['cls_hidden_state'] = np.asarray(cls_hidden_state)
+    with open(f_name, 'wb') as f:
+        np.savez(f, **columns)
+    logger.info(f'Wrote predictions to {f_name}')
+
+def load_predictions(f_names, as_frame=True):
+    """
+    Loads one or more prediction bundles written by `save_predictions` and concatenates them. Returns a
+    DataFrame with a row per example or, with `as_frame=False`, a dict of columnar arrays.
+    """
+    if isinstance(f_names, str):
+        f_names = [f_names]
+    parts = []
+    for f_name in f_names:
+        with np.load(f_name) as bundle:
+            num_examples = len(bundle['guid'])
+            label_mapping = dict(enumerate(bundle['label_names'])) if 'label_names' in bundle else None
+            y_true = bundle['y_true'] if 'y_true' in bundle else None
+            part = {
+                'experiment_id': np.repeat(bundle['experiment_id'], num_examples),
+                'dataset': np.repeat(bundle['dataset'], num_examples),
+                'guid': bundle['guid'],
+                **rank_predictions(bundle['probabilities'], y_true=y_true, label_mapping=label_mapping)
+            }
+            if 'cls_hidden_state' in bundle:
+                part['cls_hidden_state'] = bundle['cls_hidden_state']
+        parts.append(part)
+    columns = {k: np.concatenate([part[k] for part in parts]) for k in parts[0] if all(k in part for part in parts)}
+    if not as_frame:
+        return columns
+    return pd.DataFrame({k: list(v) if v.ndim > 1 else v for k, v in columns.items()})
+
+class HiddenStateWriter():
+    """
+    Streams hidden state vectors row by row into a memory-mapped float16 .npy file. Row i belongs to the
+    i-th guid of the corresponding prediction bundle, rows may be written in any order. The file is created
+    on the first write and flushed every `chunk_size` rows, so host memory stays bounded.
+    """
+    def __init__(self, f_name, num_examples, dtype=np.float16, chunk_size=4096):
+        self.f_name = f_name
+        self.num_examples = num_examples
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.array = None
+        self._unflushed = 0
+
+    def write(self, index, vector):
+        """Writes `vector` to row `index`, or to all rows of an index array"""
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.f_name, mode='w+', dtype=self.dtype, shape=(self.num_examples, len(vector)))
+        self.array[index] = vector
+        self._unflushed += 1
+        if self._unflushed >= self.chunk_size:
+            self.array.flush()
+            self._unflushed = 0
+
+    def close(self):
+        if self.array is None:
+            return
+        self.array.flush()
+        self.array = None
+        logger.info(f'Wrote hidden states to {self.f_name}')
 
 def save_to_json(data, f_name):
     with open(f_name, mode='w') as f:
@@ -98,5 +352,7 @@ class JSONEncoder(json.JSONEncoder):
             return float(obj)
         elif isinstance(obj, np.ndarray):
             return obj.tolist()
+        elif isinstance(obj, Mapping):
+            return dict(obj)
         else:
-            return super(MyEncoder, self).default(obj)
+            return super(JSONEncoder, self).default(obj)
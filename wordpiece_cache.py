@@ -0,0 +1,44 @@
+import functools
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 100000
+
+
+class CachedWordpieceTokenizer():
+    """
+    Wraps the `WordpieceTokenizer` of a BERT tokenizer (`tokenization.FullTokenizer` or transformers' `BertTokenizer`)
+    with a bounded LRU cache from a whitespace token to its wordpieces. Greedy longest-match WordPiece is a pure
+    function of the token, so the output does not change.
+    """
+    def __init__(self, wordpiece_tokenizer, max_size=DEFAULT_CACHE_SIZE):
+        self.wordpiece_tokenizer = wordpiece_tokenizer
+        self.max_size = max_size
+        self._tokenize = functools.lru_cache(maxsize=max_size)(lambda token: tuple(wordpiece_tokenizer.tokenize(token)))
+
+    def tokenize(self, text):
+        return list(self._tokenize(text))
+
+    def stats(self):
+        info = self._tokenize.cache_info()
+        lookups = info.hits + info.misses
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': self.max_size,
+                'hit_rate': info.hits / lookups if lookups > 0 else 0.0}
+
+    def log_stats(self, prefix='Wordpiece cache'):
+        stats = self.stats()
+        logger.info(f'{prefix}: {stats["hit_rate"]:.1%} hit rate ({stats["hits"]:,} hits, {stats["misses"]:,} misses, {stats["size"]:,} cached tokens)')
+
+    def __getattr__(self, name):
+        # vocab, unk_token, ... of the wrapped tokenizer
+        return getattr(self.__dict__['wordpiece_tokenizer'], name)
+
+
+def cache_wordpieces(tokenizer, max_size=DEFAULT_CACHE_SIZE):
+    """Replaces `tokenizer.wordpiece_tokenizer` by a cached one (in place). Returns the cache, or None if `max_size` is 0."""
+    if max_size == 0:
+        return None
+    if not isinstance(tokenizer.wordpiece_tokenizer, CachedWordpieceTokenizer):
+        tokenizer.wordpiece_tokenizer = CachedWordpieceTokenizer(tokenizer.wordpiece_tokenizer, max_size=max_size)
+    return tokenizer.wordpiece_tokenizer